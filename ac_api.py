@@ -1,30 +1,952 @@
+import atexit
+import gzip
+import importlib.util
 import json
 import os
+import threading
+import time
 
-from dataclasses import dataclass, field
-from dataclasses_json import dataclass_json
-from dotenv import load_dotenv
-from typing import Dict, List
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
-from requests import Request, Session
-from marshmallow import Schema, fields
-
-# get the Asset Central config
-load_dotenv()
-client_id = os.getenv("CLIENT_ID")
-client_secret = os.getenv("CLIENT_SECRET")
-base_url = os.getenv("BASE_URL")
-token_url = os.getenv("TOKEN_URL")
-
-
-def get_oauth_session():
-    """call the service using the config to get an OAuth2 token and authenticate"""
-    client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client)
-    oauth.fetch_token(token_url=token_url, client_id=client_id, client_secret=client_secret)
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields as dataclass_fields, is_dataclass
+from dataclasses_json import config, dataclass_json
+from functools import lru_cache, wraps
+from typing import Dict, Iterable, List, NamedTuple, get_args, get_origin
+from urllib.parse import quote
+
+# orjson is optional, it decodes the large list responses several times faster
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+from profiling import emit, stage
+
+# the Asset Central config of the default client, read by configure() before it is first used
+client_id = None
+client_secret = None
+base_url = None
+token_url = None
+_configured = False
+_config_lock = threading.Lock()
+
+
+def configure():
+    """ read the Asset Central config from the environment and the .env file
+        runs once, the settings that were set before (e.g. by a test) are kept
+    """
+    global client_id, client_secret, base_url, token_url, _configured
+    with _config_lock:
+        if _configured:
+            return
+        from dotenv import load_dotenv
+        load_dotenv()
+        client_id = client_id or os.getenv("CLIENT_ID")
+        client_secret = client_secret or os.getenv("CLIENT_SECRET")
+        base_url = base_url or os.getenv("BASE_URL")
+        token_url = token_url or os.getenv("TOKEN_URL")
+        _configured = True
+
+def _base_url():
+    """ the base url of the ACAPI of the current client, the config is read on first use """
+    return current_client().url()
+
+
+def get_oauth_session(client: "ACClient" = None):
+    """call the service using the config to get an OAuth2 token and authenticate
+        arguments:
+            client: the ACClient with the config, the current client if not given
+    """
+    # oauthlib and requests are only imported when AC is called
+    from oauthlib.oauth2 import BackendApplicationClient
+    from requests_oauthlib import OAuth2Session
+    client = client or current_client()
+    client.configure()
+    oauth = OAuth2Session(client=BackendApplicationClient(client_id=client.client_id))
+    with stage("token"):
+        oauth.fetch_token(token_url=client.token_url, client_id=client.client_id,
+            client_secret=client.client_secret)
     return oauth
 
+
+# request bodies of at least this size are gzip compressed when compression is on
+GZIP_MIN_SIZE = 1024
+
+def _accept_encoding():
+    """ the response encodings that can be decoded, br needs the brotli package """
+    if importlib.util.find_spec("brotli") is None:
+        return "gzip, deflate"
+    return "gzip, deflate, br"
+
+def _compress(data, headers, enabled: bool):
+    """ gzip the request body if compression is enabled and the body is large enough """
+    if enabled and data is not None and len(data) >= GZIP_MIN_SIZE:
+        if isinstance(data, str):
+            data = data.encode()
+        data = gzip.compress(data)
+        headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+    return data, headers
+
+
+class SessionTransport():
+    """ requests transport with one pooled session per thread and a shared token
+
+    Attributes:
+        compress: gzip the request bodies (see GZIP_MIN_SIZE)
+        client: the ACClient whose credentials are used, the current client if None
+    """
+
+    def __init__(self, compress: bool = False):
+        self.compress = compress
+        self.client = None
+        self._token = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            with self._lock:
+                if self._token is None:
+                    self._token = get_oauth_session(self.client).token
+                token = self._token
+            from requests_oauthlib import OAuth2Session
+            session = OAuth2Session(client_id=(self.client or current_client()).client_id,
+                token=token)
+            session.headers["Accept-Encoding"] = _accept_encoding()
+            self._local.session = session
+        return session
+
+    def _expire(self, session):
+        """ drop the token of the session so that the next request fetches a new one """
+        with self._lock:
+            if self._token is session.token:
+                self._token = None
+        self._local.session = None
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        from oauthlib.oauth2 import TokenExpiredError
+        data, headers = _compress(data, headers, self.compress)
+        session = self._session()
+        try:
+            res = session.request(method, url, data=data, headers=headers)
+            if res.status_code != 401:
+                return res
+        except TokenExpiredError:
+            pass
+        self._expire(session)
+        return self._session().request(method, url, data=data, headers=headers)
+
+
+class Http2Transport():
+    """ httpx transport that multiplexes concurrent requests over one HTTP/2 connection
+
+    Needs the optional httpx[http2] package. HTTP/2 is negotiated with TLS, plain
+    http urls (e.g. the mock server) fall back to HTTP/1.1.
+
+    Attributes:
+        compress: gzip the request bodies (see GZIP_MIN_SIZE)
+        client: the ACClient whose credentials are used, the current client if None
+    """
+
+    def __init__(self, compress: bool = False, max_connections: int = 32):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("Http2Transport needs httpx, install with pip install .[http2]")
+        self.compress = compress
+        self.client = None
+        self._client = httpx.Client(http2=True, timeout=60.0,
+            headers={"Accept-Encoding": _accept_encoding()},
+            limits=httpx.Limits(max_connections=max_connections))
+        self._token = None
+        self._lock = threading.Lock()
+
+    def _access_token(self, refresh: bool = False):
+        with self._lock:
+            if self._token is None or refresh:
+                self._token = get_oauth_session(self.client).token["access_token"]
+            return self._token
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        data, headers = _compress(data, headers, self.compress)
+        headers = dict(headers or {})
+        headers["Authorization"] = "Bearer " + self._access_token()
+        res = self._client.request(method, url, content=data, headers=headers)
+        if res.status_code == 401:
+            headers["Authorization"] = "Bearer " + self._access_token(refresh=True)
+            res = self._client.request(method, url, content=data, headers=headers)
+        return res
+
+
+class CassetteResponse():
+    """ response replayed from a cassette, has the parts of requests.Response used here """
+
+    def __init__(self, status_code: int, content: bytes, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return _loads(self.content)
+
+
+class CassetteTransport():
+    """ records the exchanges with AC to a cassette file and replays them offline
+
+    In record mode the requests are sent with the inner transport and every
+    exchange is kept; save() writes them to the cassette (done at exit too).
+    In replay mode nothing is sent: each request is answered with the next
+    recorded response for the same method, url and body. The urls are kept
+    relative to the base url of the client so a cassette can be replayed for
+    any tenant.
+
+    Attributes:
+        path: the cassette json file
+        mode: record or replay
+        keep_latency: in replay, wait as long as the recorded request took
+        client: the ACClient whose base url the urls are relative to, the current client if None
+    """
+
+    # response headers kept in the cassette
+    HEADERS = ["Content-Type", "ETag", "Last-Modified", "Retry-After"]
+
+    def __init__(self, path: str, mode: str = "replay", inner=None, keep_latency: bool = False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown cassette mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.keep_latency = keep_latency
+        self.client = None
+        self._interactions = []
+        self._lock = threading.Lock()
+        if mode == "record":
+            self._inner = inner or SessionTransport()
+            atexit.register(self.save)
+        else:
+            # a missing cassette replays nothing, every request is a CassetteMiss
+            if os.path.exists(path):
+                with open(path) as f:
+                    self._interactions = json.load(f)["interactions"]
+            self._queues = defaultdict(deque)
+            for interaction in self._interactions:
+                self._queues[self._key(interaction)].append(interaction)
+
+    @staticmethod
+    def _key(interaction):
+        return interaction["method"], interaction["url"], interaction["body"]
+
+    @staticmethod
+    def _body(data):
+        if isinstance(data, bytes):
+            return data.decode("utf-8")
+        return data
+
+    def _relative(self, url):
+        root = (self.client or current_client()).base_url
+        if root and url.startswith(root):
+            return url[len(root):]
+        return url
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        interaction = {"method": method, "url": self._relative(url), "body": self._body(data)}
+        if self.mode == "replay":
+            with self._lock:
+                queue = self._queues.get(self._key(interaction))
+                if not queue:
+                    raise CassetteMiss(f"{method} {url} is not in cassette {self.path}")
+                interaction = queue.popleft()
+            if self.keep_latency:
+                time.sleep(interaction["elapsed"])
+            return CassetteResponse(interaction["status_code"],
+                interaction["content"].encode("utf-8"), interaction["headers"])
+
+        start = time.perf_counter()
+        res = self._inner.request(method, url, data=data, headers=headers)
+        interaction.update(status_code=res.status_code,
+            headers={k: res.headers[k] for k in self.HEADERS if k in res.headers},
+            content=res.text, elapsed=round(time.perf_counter() - start, 4))
+        with self._lock:
+            self._interactions.append(interaction)
+        return res
+
+    def save(self):
+        """ write the recorded exchanges to the cassette """
+        if self.mode == "record" and self._interactions:
+            with self._lock:
+                with open(self.path, "w") as f:
+                    json.dump({"version": 1, "interactions": self._interactions}, f, indent=1)
+
+
+# retries of a request that AC answered with 429 Too Many Requests
+MAX_THROTTLE_RETRIES = 5
+
+def _retry_after(res, attempt: int):
+    """ seconds to wait after a 429, from Retry-After or an exponential backoff """
+    try:
+        return max(0.0, float(res.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return min(30.0, 0.5 * 2 ** attempt)
+
+
+class ResponseCache():
+    """ LRU cache of GET responses that are revalidated with ETag / Last-Modified
+
+    A cached url is requested with If-None-Match / If-Modified-Since and the
+    cached body is used when AC answers 304 Not Modified.
+
+    Attributes:
+        max_entries: number of responses kept, least recently used are evicted
+        max_bytes: size of the cached bodies, least recently used are evicted
+            and larger bodies are not cached
+        path: optional json file the cache is read from and saved to
+        hits: requests answered with 304
+        misses: requests that returned a new body
+    """
+
+    def __init__(self, max_entries: int = 1024, path: str = None, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for url, entry in json.load(f).items():
+                    self._add(url, entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def validators(self, url: str):
+        """ the cached entry of the url (None if not cached) and its conditional request headers """
+        with self._lock:
+            entry = self._entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return entry, headers
+
+    def hit(self, url: str, entry: dict):
+        """ the cached body of a url that was not modified
+            arguments:
+                entry: the entry returned by validators, used even if it was evicted since
+        """
+        with self._lock:
+            if url in self._entries:
+                self._entries.move_to_end(url)
+            self.hits += 1
+        return entry["content"]
+
+    def store(self, url: str, res):
+        """ cache a 200 response if it can be revalidated """
+        etag = res.headers.get("ETag")
+        last_modified = res.headers.get("Last-Modified")
+        with self._lock:
+            self.misses += 1
+            if not etag and not last_modified:
+                return
+            self._add(url, {"etag": etag, "last_modified": last_modified, "content": res.text})
+
+    def _add(self, url: str, entry: dict):
+        """ add an entry and evict the least recently used ones over the limits """
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= len(old["content"])
+        size = len(entry["content"])
+        if size > self.max_bytes:
+            return
+        self._entries[url] = entry
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted["content"])
+
+    def stats(self):
+        """ hit and miss counts and the hit rate of the cache """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+            "bytes": self._bytes, "hit_rate": self.hits / total if total else 0.0}
+
+    def summary(self):
+        stats = self.stats()
+        return (f"response cache: {stats['hits']} hit(s), {stats['misses']} miss(es), "
+            f"hit rate {stats['hit_rate']:.0%}")
+
+    def save(self):
+        """ write the cache to its file """
+        if self.path:
+            with self._lock:
+                with open(self.path, "w") as f:
+                    json.dump(self._entries, f)
+
+
+class ACClient():
+    """ the configuration and the connections for the requests to one AC tenant
+
+    A client can be shared by threads, its transport keeps a session per thread
+    and one token. It can be passed to other processes: it is pickled without
+    its transport, rate limiter and response cache, and a client that was
+    pickled or forked opens new connections on its first request. Several
+    clients can be used in one process for several tenants, see use_client.
+
+    Attributes:
+        base_url: the url of the ACAPI
+        token_url: the url of the OAuth token endpoint
+        client_id: the OAuth client
+        client_secret: the secret of the OAuth client
+        transport: transport for the requests, a SessionTransport is created on first use
+        rate_limiter: optional ratelimit.RateLimiter that paces the requests
+        response_cache: optional ResponseCache for the GET requests
+    """
+
+    def __init__(self, base_url: str = None, token_url: str = None, client_id: str = None,
+            client_secret: str = None, transport=None, rate_limiter=None,
+            response_cache: ResponseCache = None):
+        self.base_url = base_url
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if transport is not None and getattr(transport, "client", False) is None:
+            transport.client = self
+
+    @classmethod
+    def from_env(cls, prefix: str = "", **kwargs):
+        """ a client with the settings of the environment and the .env file
+            arguments:
+                prefix: prefix of the variables, e.g. TENANT2_ for TENANT2_CLIENT_ID
+                kwargs: the other arguments of ACClient
+        """
+        from dotenv import load_dotenv
+        load_dotenv()
+        return cls(os.getenv(prefix + "BASE_URL"), os.getenv(prefix + "TOKEN_URL"),
+            os.getenv(prefix + "CLIENT_ID"), os.getenv(prefix + "CLIENT_SECRET"), **kwargs)
+
+    def __getstate__(self):
+        # connections, locks and open files stay in the process that has them
+        state = dict(self.__dict__, transport=None, rate_limiter=None, response_cache=None)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def configure(self):
+        """ the settings of a client are given when it is created """
+
+    def url(self, path: str = "") -> str:
+        """ the url of a path of the ACAPI, e.g. /indicators """
+        if self.base_url is None:
+            self.configure()
+        return self.base_url + path
+
+    def _transport(self):
+        if self._pid != os.getpid():
+            # forked, the connections of the parent process can not be shared
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self.transport = None
+        transport = self.transport
+        if transport is None:
+            with self._lock:
+                if self.transport is None:
+                    self.transport = SessionTransport()
+                    self.transport.client = self
+                transport = self.transport
+        return transport
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        """ send a request to AC with the transport of the client, calling the request hooks
+
+        Requests are paced by the rate limiter if there is one and retried when AC
+        answers 429 Too Many Requests.
+        """
+        transport = self._transport()
+        limiter = self.rate_limiter
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            if limiter is not None:
+                limiter.acquire(method, url)
+            emit("before_request", method, url)
+            start = time.perf_counter()
+            res = transport.request(method, url, data=data, headers=headers)
+            emit("after_request", method, url, res.status_code, time.perf_counter() - start)
+            if res.status_code != 429 or attempt == MAX_THROTTLE_RETRIES:
+                return res
+            delay = _retry_after(res, attempt)
+            if limiter is not None:
+                limiter.throttle(method, url, delay)
+            else:
+                time.sleep(delay)
+
+    def get_json(self, url: str):
+        """ GET the url and decode the json, revalidating against the response cache """
+        cache = self.response_cache
+        if cache is None:
+            res = self.request("GET", url)
+            if res.status_code != 200:
+                raise ValueError
+            return _loads(res.content)
+        entry, headers = cache.validators(url)
+        res = self.request("GET", url, headers=headers)
+        if res.status_code == 304:
+            if entry is not None:
+                return _loads(cache.hit(url, entry))
+            # nothing to revalidate, ask for the body
+            res = self.request("GET", url)
+        if res.status_code != 200:
+            raise ValueError
+        cache.store(url, res)
+        return _loads(res.content)
+
+
+def _module_setting(name: str):
+    """ a property of the default client that is kept in the module variable of the same name """
+    def get(self):
+        return globals()[name]
+
+    def set(self, value):
+        globals()[name] = value
+
+    return property(get, set)
+
+
+class _DefaultClient(ACClient):
+    """ the client used when no other client is in use
+
+    Its settings are the module variables (client_id, base_url, transport, ...),
+    read from the environment on first use and changed with set_transport,
+    set_rate_limiter and enable_response_cache.
+    """
+    base_url = _module_setting("base_url")
+    token_url = _module_setting("token_url")
+    client_id = _module_setting("client_id")
+    client_secret = _module_setting("client_secret")
+    transport = _module_setting("transport")
+    rate_limiter = _module_setting("rate_limiter")
+    response_cache = _module_setting("response_cache")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def configure(self):
+        configure()
+
+
+# transport used for the requests of the default client, see set_transport
+transport = None
+
+def set_transport(new_transport):
+    """ use a different transport (e.g. Http2Transport) for the requests to AC """
+    global transport
+    transport = new_transport
+
+# rate limiter for the requests of the default client, see set_rate_limiter
+rate_limiter = None
+
+def set_rate_limiter(limiter):
+    """ pace the requests to AC with a ratelimit.RateLimiter, None to send them right away """
+    global rate_limiter
+    rate_limiter = limiter
+
+# response cache used by the GET requests, see enable_response_cache
+response_cache = None
+
+def enable_response_cache(max_entries: int = 1024, path: str = None, max_bytes: int = 64 << 20):
+    """ cache the GET responses of the load functions
+        arguments:
+            max_entries: number of responses kept in memory
+            path: optional json file to keep the cache between runs (saved at exit)
+            max_bytes: size of the bodies kept in memory
+        returns:
+            the ResponseCache, use stats() for the hit rate
+    """
+    global response_cache
+    response_cache = ResponseCache(max_entries, path, max_bytes)
+    if path:
+        atexit.register(response_cache.save)
+    return response_cache
+
+def disable_response_cache():
+    global response_cache
+    response_cache = None
+
+_default_client = _DefaultClient()
+
+# the client of the current thread or task, see use_client
+_current_client = ContextVar("ac_client", default=None)
+
+def current_client() -> ACClient:
+    """ the client the requests are sent with, the default client unless use_client set another """
+    return _current_client.get() or _default_client
+
+@contextmanager
+def use_client(client: ACClient):
+    """ send the requests of the current thread to the tenant of the client
+
+        with use_client(ACClient.from_env("TENANT2_")):
+            Indicator.load("voltage_out")
+
+    Threads started inside the block use the default client unless their
+    function is wrapped with bind_client.
+    """
+    token = _current_client.set(client)
+    try:
+        yield client
+    finally:
+        _current_client.reset(token)
+
+def bind_client(fn):
+    """ fn running with the client of the caller, for the worker threads of a pool """
+    client = _current_client.get()
+    if client is None:
+        return fn
+
+    @wraps(fn)
+    def run(*args, **kwargs):
+        with use_client(client):
+            return fn(*args, **kwargs)
+    return run
+
+def _request(method: str, url: str, data=None, headers=None):
+    """ send a request to AC with the current client """
+    return current_client().request(method, url, data=data, headers=headers)
+
+def _get_json(url: str):
+    """ GET the url with the current client and decode the json """
+    return current_client().get_json(url)
+
+# limits for the $filter of load_many, keeps the url well under the usual 2k-8k limits
+MAX_FILTER_LENGTH = 1500
+MAX_FILTER_IDS = 50
+
+def _internal_id_filter(internal_id: str):
+    """ the $filter term for one internal id, quotes doubled and url encoded """
+    return "internalId+eq+'%s'" % quote(str(internal_id).replace("'", "''"), safe="")
+
+def _filter_chunks(internal_ids: Iterable[str], max_length: int = MAX_FILTER_LENGTH,
+        max_ids: int = MAX_FILTER_IDS):
+    """ build internalId $filter expressions joined with or, each short enough for a url """
+    chunks = []
+    terms = []
+    length = 0
+    # drop duplicates but keep the order
+    for internal_id in dict.fromkeys(internal_ids):
+        term = _internal_id_filter(internal_id)
+        if terms and (length + len(term) > max_length or len(terms) == max_ids):
+            chunks.append("+or+".join(terms))
+            terms = []
+            length = 0
+        terms.append(term)
+        length += len(term) + len("+or+")
+    if terms:
+        chunks.append("+or+".join(terms))
+    return chunks
+
+def _select(fields: Iterable[str], *required: str):
+    """ $select query option for the fields, the required fields are always selected """
+    if not fields:
+        return ""
+    return "&$select=" + ",".join(dict.fromkeys([*required, *fields]))
+
+def _load_many(path: str, cls, internal_ids: Iterable[str], max_workers: int = 8,
+        select: str = ""):
+    """ load the objects for many internal ids with a few concurrent filtered GETs
+        arguments:
+            path: collection of the objects, e.g. /indicators
+            cls: the class of the objects
+            internal_ids: the internal ids to look up
+            max_workers: number of concurrent requests
+            select: $select query option from _select
+        returns:
+            dict of internal id and object, ids that do not exist in AC are left out
+    """
+    def fetch(chunk):
+        return _get_json(_base_url() + f"{path}?$filter={chunk}{select}")
+
+    objects = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(bind_client(fetch), _filter_chunks(internal_ids)):
+            for obj in decode_objects(cls, result):
+                objects[obj.internalId] = obj
+    return objects
+
+# objects per request of read_pages
+PAGE_SIZE = 1000
+
+def read_pages(path: str, changed_since: str = None, page_size: int = PAGE_SIZE,
+        fields: Iterable[str] = None):
+    """ read a whole collection from AC page by page with $top and $skip
+        arguments:
+            path: collection of the objects, e.g. /equipment
+            changed_since: only the objects with a changedOn at or after this time
+            page_size: number of objects per request
+            fields: only read these fields (and internalId), None reads all of them
+        yields:
+            the json of each page, a list of objects
+    """
+    query = ""
+    if changed_since:
+        query = "&$filter=changedOn+ge+'%s'" % quote(changed_since, safe="")
+    query += _select(fields, "internalId")
+    skip = 0
+    while True:
+        page = _get_json(_base_url() + f"{path}?$top={page_size}&$skip={skip}{query}")
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        skip += page_size
+
+def _snapshot(obj):
+    """ remember the state of the object in AC for the field-level diff in update """
+    obj._remote = obj.to_dict()
+    return obj
+
+def _changes(obj, exclude: Iterable[str] = ()):
+    """ the fields that differ from the last known state in AC
+        returns:
+            dict of the changed fields, None if the state in AC is not known
+    """
+    remote = getattr(obj, "_remote", None)
+    if remote is None:
+        return None
+    return {k: v for k, v in obj.to_dict().items() if k not in exclude and remote.get(k) != v}
+
+
+def _converter(typ):
+    """ the function that converts the json of a field of type typ, None if there is nothing to convert """
+    if is_dataclass(typ):
+        decode = _decoder(typ)
+        return lambda value: decode(value) if isinstance(value, dict) else value
+    if get_origin(typ) is list:
+        args = get_args(typ)
+        item = _converter(args[0]) if args else None
+        if item is None:
+            # copy, the json list is also kept in the snapshot
+            return lambda value: list(value) if isinstance(value, list) else value
+        return lambda value: [item(v) for v in value] if isinstance(value, list) else value
+    return None
+
+
+def _has_dataclass(typ):
+    """ True if a field of type typ holds dataclasses, directly or in a list """
+    if is_dataclass(typ):
+        return True
+    args = get_args(typ) if get_origin(typ) is list else ()
+    return bool(args) and _has_dataclass(args[0])
+
+def _plain(value):
+    """ the to_dict() form of a decoded field value """
+    if is_dataclass(value):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+class _Decoder():
+    """ creates objects of a dataclass from the AC json
+
+    The json names of the fields (e.g. "class" for class_) and the converters
+    of the nested dataclasses and lists are worked out once per class, so
+    decoding is a loop over the keys without any schema work. Keys that the
+    class does not have are ignored.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        # json name -> (field name, converter)
+        self.fields = {}
+        # json name -> field name of the nested dataclasses
+        self.nested = {}
+        for f in dataclass_fields(cls):
+            override = f.metadata.get("dataclasses_json", {}).get("letter_case")
+            key = override(f.name) if override else f.name
+            self.fields[key] = (f.name, _converter(f.type))
+            if _has_dataclass(f.type):
+                self.nested[key] = f.name
+        self._defaults = None
+
+    def __call__(self, d: dict):
+        fields = self.fields
+        kwargs = {}
+        for key, value in d.items():
+            f = fields.get(key)
+            if f is not None:
+                name, convert = f
+                kwargs[name] = value if convert is None or value is None else convert(value)
+        return self.cls(**kwargs)
+
+    def load(self, d: dict):
+        """ decode an object read from AC and snapshot it for update """
+        obj = self(d)
+        if self._defaults is None:
+            self._defaults = self.cls().to_dict()
+        # the json is the to_dict() of the object, the fields not read keep their defaults
+        remote = dict(self._defaults)
+        fields = self.fields
+        remote.update((k, v) for k, v in d.items() if k in fields)
+        # the json of a nested dataclass may have keys that the class drops
+        for key, name in self.nested.items():
+            if key in d:
+                remote[key] = _plain(getattr(obj, name))
+        obj._remote = remote
+        return obj
+
+@lru_cache(maxsize=None)
+def _decoder(cls):
+    """ the decoder of the class, built on first use """
+    return _Decoder(cls)
+
+def decode_objects(cls, data):
+    """ create objects of cls from the AC json
+        arguments:
+            cls: the dataclass to create
+            data: a json object or a list of json objects
+        returns:
+            the object or the list of objects, with the snapshot for update
+    """
+    load = _decoder(cls).load
+    if isinstance(data, dict):
+        return load(data)
+    return [load(d) for d in data]
+
+
+
+class Result(NamedTuple):
+    """ the outcome of a create or remove
+
+    Attributes:
+        status_code: status code of the response
+        id: the id of the object in AC, "" after it was removed
+    """
+    status_code: int
+    id: str = ""
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+
+class _Entity():
+    """ load, create, remove, insert and delete of the AC objects
+
+    create and remove return a Result and do not change the object, so an
+    object can be used by several threads; insert and delete also set or clear
+    the id of the object.
+    """
+    # the id field, the path of the collection and the path of one object, set by each class
+    ID_FIELD = "id"
+    COLLECTION = ""
+    ITEM_PATH = ""
+
+    @classmethod
+    def load(cls, internal_id: str, fields: Iterable[str] = None):
+        """ load an object from AC
+            arguments:
+                internal_id: the internal id of the object
+                fields: optional list of the fields to read, the others keep their defaults
+        """
+        url = _base_url() + f"{cls.COLLECTION}?$filter={_internal_id_filter(internal_id)}" + \
+            _select(fields, cls.ID_FIELD, "internalId")
+        d = _get_json(url)[0]
+        return decode_objects(cls, d)
+
+    @classmethod
+    def load_many(cls, internal_ids: Iterable[str], fields: Iterable[str] = None,
+            max_workers: int = 8):
+        """ load many objects from AC with a few concurrent requests
+            arguments:
+                internal_ids: the internal ids of the objects
+                fields: optional list of the fields to read, the others keep their defaults
+                max_workers: number of concurrent requests
+            returns:
+                dict of internal id and object, missing ids are left out
+        """
+        return _load_many(cls.COLLECTION, cls, internal_ids, max_workers,
+            _select(fields, cls.ID_FIELD, "internalId"))
+
+    # PUT replaces the object and is sent the whole object, PATCH only the changed fields
+    UPDATE_METHOD = "PUT"
+
+    def _payload(self) -> str:
+        """ the json of the whole object that update sends """
+        return self.to_json()
+
+    def create(self) -> Result:
+        raise NotImplementedError
+
+    def update(self):
+        """ updates the object in AC
+            nothing is sent if no field changed since the object was loaded or
+            inserted; without a known state in AC the whole object is sent
+            returns:
+                the status code, None if nothing changed and no request was made
+        """
+        id = getattr(self, self.ID_FIELD)
+        if not id:
+            raise ValueError
+        changes = _changes(self, exclude=[self.ID_FIELD])
+        if changes == {}:
+            return None
+        if changes is None or self.UPDATE_METHOD == "PUT":
+            data = self._payload()
+        else:
+            data = json.dumps(changes)
+        res = _request(self.UPDATE_METHOD, _base_url() + self.ITEM_PATH.format(id), data=data,
+            headers={"Content-Type": "application/json"})
+        if res.status_code in (200, 204):
+            _snapshot(self)
+        return res.status_code
+
+    def remove(self) -> Result:
+        """ deletes the object from AC, the object itself is not changed """
+        id = getattr(self, self.ID_FIELD)
+        if not id:
+            raise ValueError
+        res = _request("DELETE", _base_url() + self.ITEM_PATH.format(id))
+        result = Result(res.status_code)
+        return result if result.ok else result._replace(id=id)
+
+    def insert(self):
+        """ inserts the object into AC and sets its id
+            returns:
+                the status code
+        """
+        result = self.create()
+        setattr(self, self.ID_FIELD, result.id)
+        _snapshot(self)
+        return result.status_code
+
+    def delete(self):
+        """ deletes the object from AC and clears its id
+            returns:
+                the status code
+        """
+        result = self.remove()
+        setattr(self, self.ID_FIELD, result.id)
+        return result.status_code
+
+
 @dataclass_json
 @dataclass
 class Dimension():
@@ -38,14 +960,20 @@ class Dimension():
     unitIsoCode: str = ""
 
 def load_dimensions():
-    url = base_url + f"/uom/dimensions?isFlat=true"
-    res = get_oauth_session().get(url)
-    # if we get a successful result, load the list
-    if res.status_code == 200:
-        dims = res.json()
-        return [Dimension(**d) for d in dims]
-    else:
-        raise ValueError
+    url = _base_url() + f"/uom/dimensions?isFlat=true"
+    dims = _get_json(url)
+    decode = _decoder(Dimension)
+    return [decode(d) for d in dims]
+
+def dump_dimensions(dimensions: List[Dimension], path: str):
+    """ save the dimensions to a local cache file so they can be used offline """
+    with open(path, "w") as f:
+        f.write(Dimension.schema().dumps(dimensions, many=True))
+
+def read_dimensions(path: str):
+    """ read the dimensions from a cache file written by dump_dimensions """
+    with open(path) as f:
+        return Dimension.schema().loads(f.read(), many=True)
 
 
 @dataclass_json
@@ -75,15 +1003,18 @@ def indicator_type_factory():
 
 @dataclass_json
 @dataclass
-class Indicator():
+class Indicator(_Entity):
     """ Indicator as defined in AC
 
     The fields are best defined in AC and can mirrored here
 
     """
+    COLLECTION = "/indicators"
+    ITEM_PATH = "/indicators/{}"
+
     id: str = ""
     internalId: str = ""
-    description: Description = Description
+    description: Description = field(default_factory=Description)
     indicatorType: List[IndicatorType] = field(default_factory=indicator_type_factory)
     dataType: str = "numeric"
     aggregationConcept: str = "6"
@@ -93,64 +1024,19 @@ class Indicator():
     dimension1: str = ""
     indicatorUom: str = ""
 
-    def insert(self):
-        """ inserts the indicator into AC """
-        url = base_url + "/indicators"
+    def _payload(self, exclude=()) -> str:
         # modify schema to not serialize dimension1 and indicatorUom unless both are populated (fails on insert)
-        exclude = ["id", "dimension1", "indicatorUom"]
-        if self.dimension1 and self.indicatorUom:
-            exclude = ["id"]
-        schema = self.schema(exclude=exclude)
-        data = schema.dumps(self)
-        s = get_oauth_session()
-        res = s.request("POST", url, data=data, headers={"Content-Type": "application/json"})
-        status_code = res.status_code
-        res_val = json.loads(res.content)
-        self.id = res_val["id"]
-        return status_code
+        exclude = list(exclude)
+        if not (self.dimension1 and self.indicatorUom):
+            exclude += ["dimension1", "indicatorUom"]
+        return self.schema(exclude=exclude).dumps(self)
 
-    def update(self):
-        """ updates the indicator in AC """
-        if self.id:
-            url = base_url + f"/indicators/{self.id}"
-            # modify schema to not serialize dimension1 and indicatorUom unless both are populated
-            exclude = ["dimension1", "indicatorUom"]
-            if self.dimension1 and self.indicatorUom:
-                exclude = []
-            schema = self.schema(exclude=exclude)
-            data = schema.dumps(self)
-            s = get_oauth_session()
-            res = s.request("PUT", url, data=data, headers={"Content-Type": "application/json"})
-            status_code = res.status_code
-            return status_code
-        else:
-            raise ValueError
-
-    def delete(self):
-        """ deletes the indicator from AC """
-        if self.id:
-            url = base_url + f"/indicators/{self.id}"
-            res = get_oauth_session().delete(url)
-            if res.status_code == 200:
-                self.id = ""
-            return res.status_code
-        else:
-            raise ValueError
-
-    @classmethod
-    def load(cls, internal_id: str):
-        """ load an indicator from AC
-            arguments:
-                internal_id: the internal id for the indicator
-        """
-        url = base_url + f"/indicators?$filter=internalId+eq+'{internal_id}'"
-        res = get_oauth_session().get(url)
-        # if we get a successful result and the internalId matches then we load the indicator
-        if res.status_code == 200:
-            d = res.json()[0]
-            return Indicator(**d)
-        else:
-            raise ValueError
+    def create(self) -> Result:
+        """ creates the indicator in AC, the indicator itself is not changed """
+        url = _base_url() + self.COLLECTION
+        data = self._payload(exclude=["id"])
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, json.loads(res.content)["id"])
 
 @dataclass_json
 @dataclass
@@ -160,66 +1046,77 @@ class IdString():
 
 @dataclass_json
 @dataclass
-class IndicatorGroup():
+class IndicatorGroup(_Entity):
+    COLLECTION = "/indicatorgroups"
+    ITEM_PATH = "/indicatorgroups/{}"
+
     id: str = ""
     internalId: str = ""
-    description: Description = Description
+    description: Description = field(default_factory=Description)
     indicators: List[str] = field(default_factory=list)
 
-    def insert(self):
-        """ inserts the indicator group into AC """
-        url = base_url + "/indicatorgroups"
+    def create(self) -> Result:
+        """ creates the indicator group in AC, the indicator group itself is not changed """
+        url = _base_url() + self.COLLECTION
         data = self.to_json()
-        s = get_oauth_session()
-        res = s.request("POST", url, data=data, headers={"Content-Type": "application/json"})
-        status_code = res.status_code
-        res_val = json.loads(res.content)
-        self.id = res_val["id"]
-        return status_code
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, json.loads(res.content)["id"])
 
-    def update(self):
-        """ updates the indicator group in AC """
-        if self.id:
-            url = base_url + f"/indicatorgroups/{self.id}"
-            data = self.to_json()
-            s = get_oauth_session()
-            res = s.request("PUT", url, data=data, headers={"Content-Type": "application/json"})
-            status_code = res.status_code
-            return status_code
-        else:
-            raise ValueError
+@dataclass_json
+@dataclass
+class Attribute(_Entity):
+    """ Attribute as defined in AC, the characteristics of equipment (e.g. rated power) """
+    COLLECTION = "/attributes"
+    ITEM_PATH = "/attributes/{}"
 
-    def delete(self):
-        """ deletes the indicator group from AC """
-        if self.id:
-            url = base_url + f"/indicatorgroups/{self.id}"
-            res = get_oauth_session().delete(url)
-            if res.status_code == 200:
-                self.id = ""
-            return res.status_code
-        else:
-            raise ValueError
+    id: str = ""
+    internalId: str = ""
+    description: Description = field(default_factory=Description)
+    dataType: str = "numeric"
+    dimension1: str = ""
+    attributeUom: str = ""
 
-    @classmethod
-    def load(cls, internal_id: str):
-        """ load an indicator group from AC
-            arguments:
-                internal_id: the internal id for the indicator group
-        """
-        url = base_url + f"/indicatorgroups?$filter=internalId+eq+'{internal_id}'"
-        res = get_oauth_session().get(url)
-        if res.status_code == 200:
-            d = res.json()[0]
-            return IndicatorGroup(**d)
-        else:
-            raise ValueError
+    def _payload(self, exclude=()) -> str:
+        # dimension1 and attributeUom can only be sent together
+        exclude = list(exclude)
+        if not (self.dimension1 and self.attributeUom):
+            exclude += ["dimension1", "attributeUom"]
+        return self.schema(exclude=exclude).dumps(self)
+
+    def create(self) -> Result:
+        """ creates the attribute in AC, the attribute itself is not changed """
+        url = _base_url() + self.COLLECTION
+        data = self._payload(exclude=["id"])
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, json.loads(res.content)["id"])
 
 @dataclass_json
 @dataclass
-class Template():
+class AttributeGroup(_Entity):
+    COLLECTION = "/attributegroups"
+    ITEM_PATH = "/attributegroups/{}"
+
     id: str = ""
     internalId: str = ""
-    description: Description = Description
+    description: Description = field(default_factory=Description)
+    attributes: List[str] = field(default_factory=list)
+
+    def create(self) -> Result:
+        """ creates the attribute group in AC, the attribute group itself is not changed """
+        url = _base_url() + self.COLLECTION
+        data = self.to_json()
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, json.loads(res.content)["id"])
+
+@dataclass_json
+@dataclass
+class Template(_Entity):
+    COLLECTION = "/templates"
+    ITEM_PATH = "/templates/{}"
+
+    id: str = ""
+    internalId: str = ""
+    description: Description = field(default_factory=Description)
     indicatorGroups: List[IdString] = field(default_factory=list)
     industryStandards: List[str] = field(default_factory=list)
     attributeGroups: List[IdString] = field(default_factory=list)
@@ -236,56 +1133,15 @@ class Template():
     standardIDs: str = ""
     typeCode: str = ""
 
-    def insert(self):
-        """ inserts the template into AC """
-        url = base_url + "/templates"
+    def create(self) -> Result:
+        """ creates the template in AC, the template itself is not changed """
+        url = _base_url() + self.COLLECTION
         # modify schema to not serialize unecessary fields
         schema = self.schema(only=["internalId", "description", "attributeGroups",
             "indicatorGroups", "type"])
         data = schema.dumps(self)
-        s = get_oauth_session()
-        res = s.request("POST", url, data=data, headers={"Content-Type": "application/json"})
-        status_code = res.status_code
-        res_val = json.loads(res.content)
-        self.id = res_val[0]["id"]
-        return status_code
-
-    def update(self):
-        """ updates the template in AC """
-        if self.id:
-            url = base_url + f"/templates/{self.id}"
-            data = self.to_json()
-            s = get_oauth_session()
-            res = s.request("PUT", url, data=data, headers={"Content-Type": "application/json"})
-            status_code = res.status_code
-            return status_code
-        else:
-            raise ValueError
-
-    def delete(self):
-        """ deletes the templates from AC """
-        if self.id:
-            url = base_url + f"/templates/{self.id}"
-            res = get_oauth_session().delete(url)
-            if res.status_code == 200:
-                self.id = ""
-            return res.status_code
-        else:
-            raise ValueError
-
-    @classmethod
-    def load(cls, internal_id: str):
-        """ load an template from AC
-            arguments:
-                internal_id: the internal id for the template
-        """
-        url = base_url + f"/templates?$filter=internalId+eq+'{internal_id}'"
-        res = get_oauth_session().get(url)
-        if res.status_code == 200:
-            d = res.json()[0]
-            return Template(**d)
-        else:
-            raise ValueError
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, json.loads(res.content)[0]["id"])
 
 
 @dataclass_json
@@ -300,7 +1156,12 @@ def primary_template_factory():
 
 @dataclass_json
 @dataclass
-class Model():
+class Model(_Entity):
+    ID_FIELD = "modelId"
+    COLLECTION = "/models"
+    ITEM_PATH = "/models({})"
+    UPDATE_METHOD = "PATCH"
+
     internalId: str = ""
     description: str = ""
     templates: List[PrimaryTemplate] = field(default_factory=primary_template_factory)
@@ -332,7 +1193,8 @@ class Model():
     modelSearchTerms: str = ""
     sourceSearchTerms: str = ""
     manufacturerSearchTerms: str = ""
-    #class: str = "" - this is part of the AC model, but breaks serialization because it is a Python keyword
+    # class is a Python keyword, the field is named class_ and keeps its name in the json
+    class_: str = field(default="", metadata=config(field_name="class"))
     image: str = ""
     isClientValid: bool = True
     consume: str = ""
@@ -340,66 +1202,64 @@ class Model():
     def publish(self):
         """ publish the model so that equipment can be added
             need to have the id from AC
+            returns:
+                the status code
+            raises:
+                ElementCouldNotBePublished if AC did not publish the model
         """
         if self.modelId:
-            url = base_url + f"/models({self.modelId})/publish"
-            res = get_oauth_session().put(url)
+            url = _base_url() + f"/models({self.modelId})/publish"
+            res = _request("PUT", url)
+            if not 200 <= res.status_code < 300:
+                raise ElementCouldNotBePublished(
+                    f"publish of model {self.modelId} failed with status {res.status_code}")
             return res.status_code
         else:
             raise ValueError
 
-    def insert(self):
-        """ inserts the model into AC """
-        url = base_url + "/models"
+    @classmethod
+    def publish_many(cls, models, max_workers: int = 8):
+        """ publish several models concurrently
+            arguments:
+                models: the models to publish, need to have the id from AC
+                max_workers: number of concurrent publish requests
+            returns:
+                dict of modelId and the status code, or the exception raised
+                (ElementCouldNotBePublished for a status that is not 2xx)
+        """
+        def publish(model):
+            try:
+                return model.publish()
+            except Exception as ex:
+                return ex
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(bind_client(publish), models)
+            return {model.modelId: result for model, result in zip(models, results)}
+
+    def _payload(self) -> str:
         # modify schema to not serialize unecessary fields
         schema = self.schema(only=["internalId", "description", "templates",
             "organizationID", "equipmentTracking"])
-        data = schema.dumps(self)
-        s = get_oauth_session()
-        res = s.request("POST", url, data=data, headers={"Content-Type": "application/json"})
-        status_code = res.status_code
-        res_val = res.json()
-        self.modelId = res_val["modelId"]
-        return status_code
+        return schema.dumps(self)
 
-    def update(self):
-        """ updates the model in AC """
-        raise NotImplementedError
-
-    def delete(self):
-        """ deletes the model from AC """
-        if self.modelId:
-            url = base_url + f"/models({self.modelId})"
-            res = get_oauth_session().delete(url)
-            if res.status_code == 204:
-                self.modelId = ""
-            return res.status_code
-        else:
-            raise ValueError
-
-    @classmethod
-    def load(cls, internal_id: str):
-        """ load an model from AC
-            arguments:
-                internal_id: the internal id for the model
-        """
-        url = base_url + f"/models?$filter=internalId+eq+'{internal_id}'"
-        res = get_oauth_session().get(url)
-        if res.status_code == 200:
-            d = res.json()[0]
-            # remove class as it kills serialization
-            # might be able to find a workaroud to load
-            # could rename to class_ and change the name back on serialization
-            d.pop("class")
-            return Model(**d)
-        else:
-            raise ValueError
+    def create(self) -> Result:
+        """ creates the model in AC, the model itself is not changed """
+        url = _base_url() + self.COLLECTION
+        data = self._payload()
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, res.json()["modelId"])
 
 @dataclass_json
 @dataclass
-class Equipment():
+class Equipment(_Entity):
+    ID_FIELD = "equipmentId"
+    COLLECTION = "/equipment"
+    ITEM_PATH = "/equipment({})"
+    UPDATE_METHOD = "PATCH"
+
     equipmentId: str = ""
-    description: Description = Description
+    description: Description = field(default_factory=Description)
     internalId: str = ""
     operatorID: str = ""
     modelId: str = ""
@@ -447,53 +1307,69 @@ class Equipment():
     sourceSearchTerms: str = ""
     manufacturerSearchTerms: str = ""
     operatorSearchTerms: str = ""
+    # class is a Python keyword, the field is named class_ and keeps its name in the json
+    class_: str = field(default="", metadata=config(field_name="class"))
 
-    def insert(self):
-        """ inserts the equipment  into AC """
-        url = base_url + "/equipment"
+    def _payload(self) -> str:
         # modify schema to not serialize unecessary fields
         schema = self.schema(only=["internalId", "modelId", "sourceBPRole", "modelKnown",
             "lifeCycle", "description", "operatorID"])
-        data = schema.dumps(self)
-        s = get_oauth_session()
-        res = s.request("POST", url, data=data, headers={"Content-Type": "application/json"})
-        status_code = res.status_code
-        res_val = res.json()
-        self.equipmentId = res_val["equipmentId"]
-        return status_code
+        return schema.dumps(self)
 
-    def update(self):
-        """ updates the equipment in AC """
-        raise NotImplementedError
+    def create(self) -> Result:
+        """ creates the equipment in AC, the equipment itself is not changed """
+        url = _base_url() + self.COLLECTION
+        data = self._payload()
+        res = _request("POST", url, data=data, headers={"Content-Type": "application/json"})
+        return Result(res.status_code, res.json()["equipmentId"])
 
-    def delete(self):
-        """ deletes the equipment from AC """
-        if self.equipmentId:
-            url = base_url + f"/equipment({self.equipmentId})"
-            res = get_oauth_session().delete(url)
-            if res.status_code == 204:
-                self.modelId = ""
-            return res.status_code
-        else:
-            raise ValueError
+# attribute values per bulk request
+VALUE_BATCH_SIZE = 500
+
+@dataclass_json
+@dataclass
+class AttributeValue():
+    """ the value of an attribute of an equipment, written in bulk with write_many """
+    equipmentId: str = ""
+    attributeGroupId: str = ""
+    attributeId: str = ""
+    value: str = ""
 
     @classmethod
-    def load(cls, internal_id: str):
-        """ load an equiment from AC
+    def write_many(cls, values, batch_size: int = VALUE_BATCH_SIZE, max_workers: int = 8):
+        """ write the values of many equipment with a few concurrent bulk requests
             arguments:
-                internal_id: the internal id for the model
+                values: the AttributeValues, any number per equipment
+                batch_size: values per request
+                max_workers: number of concurrent requests
+            returns:
+                list of the batches and their status code (or the exception raised)
         """
-        url = base_url + f"/equipment?$filter=internalId+eq+'{internal_id}'"
-        res = get_oauth_session().get(url)
-        if res.status_code == 200:
-            d = res.json()[0]
-            # remove class as it kills serialization
-            # might be able to find a workaroud to load
-            # could rename to class_ and change the name back on serialization
-            d.pop("class")
-            return Equipment(**d)
-        else:
-            raise ValueError
+        url = _base_url() + "/equipment/values"
+        batches = [values[start:start + batch_size] for start in range(0, len(values), batch_size)]
+
+        def write(batch):
+            try:
+                data = json.dumps([value.to_dict() for value in batch])
+                res = _request("PUT", url, data=data, headers={"Content-Type": "application/json"})
+                return res.status_code
+            except Exception as ex:
+                return ex
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(zip(batches, executor.map(bind_client(write), batches)))
+
+def post_readings(readings: List[dict]):
+    """ send a batch of indicator readings to AC
+        arguments:
+            readings: {"equipmentId", "indicatorId", "timestamp", "value"} dicts
+        returns:
+            the status code
+    """
+    url = _base_url() + "/timeseries/readings"
+    res = _request("POST", url, data=json.dumps(readings),
+        headers={"Content-Type": "application/json"})
+    return res.status_code
 
 class ElementAlreadyExists(Exception):
     """ The element specified for insert already exists in asset central """
@@ -503,11 +1379,14 @@ class ElementDoesNotExist(Exception):
     """ The element specified does not exist in Asset Central """
     pass
 
+class CassetteMiss(Exception):
+    """ The request was not recorded in the cassette that is replayed """
+    pass
+
 class ElementCouldNotBeCreated(Exception):
     """ The element could not be created (probably an issue with dependency) """
     pass
 
-
-
-
-
+class ElementCouldNotBePublished(Exception):
+    """ The model was inserted but AC did not publish it """
+    pass
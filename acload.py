@@ -1,392 +1,455 @@
 """Loads Asset Central data from a xlsx file into the webservice
 
+The CLI only imports what a command needs when the command runs (openpyxl,
+the ACAPI client and the .env settings are not read for --help), the stages
+of the commands are in loader.py.
+
 """
 
 # standard imports
-from typing import List
+import os
 
 # third party imports
 import click
-from openpyxl import load_workbook
 
 # local imports
-
-from ac_api import Description, IndicatorType, Indicator, IndicatorGroup, \
-    IdString, Template, Model, PrimaryTemplate, Equipment
 from mapping import *
+from profiling import stage
 
 
 @click.group()
-def cli():
+@click.option("--compress", is_flag=True, help="gzip compress the request bodies")
+@click.option("--http2", is_flag=True, help="use HTTP/2 (needs pip install .[http2])")
+@click.option("--profile", is_flag=True,
+        help="write a cProfile dump, folded stacks and a per-stage time report")
+@click.option("--profile-output", default="acload_profile", show_default=True,
+        help="path prefix of the profile files")
+@click.option("--rate-limit", help="request quotas, e.g. POST=5/s,GET=600/min,POST:equipment=2/s@10")
+@click.option("--rate-limit-file", type=click.Path(),
+        help="file that shares the rate limit between acload processes")
+@click.option("--auto-tune", is_flag=True,
+        help="adjust the concurrent requests of each entity type to the tenant, starting at --workers")
+@click.option("--max-workers", default=64, show_default=True,
+        help="most concurrent requests of an entity type with --auto-tune")
+@click.option("--response-cache", is_flag=True,
+        help="revalidate the GET responses with ETag instead of reading them again")
+@click.option("--response-cache-file", type=click.Path(),
+        help="file that keeps the response cache between runs (implies --response-cache)")
+@click.pass_context
+def cli(ctx, compress, http2, profile, profile_output, rate_limit, rate_limit_file, auto_tune,
+        max_workers, response_cache, response_cache_file):
     """ Root for the CLI """
-    pass
+    if http2 or compress:
+        from ac_api import set_transport, SessionTransport, Http2Transport
+    if http2:
+        set_transport(Http2Transport(compress=compress))
+    elif compress:
+        set_transport(SessionTransport(compress=True))
+    if auto_tune:
+        import ac_api
+        from autotune import AutoTuner, AdaptiveTransport
+        tuner = AutoTuner(maximum=max_workers)
+        ac_api.set_transport(AdaptiveTransport(ac_api.transport or ac_api.SessionTransport(), tuner))
+        ctx.obj = tuner
+        ctx.call_on_close(lambda: print(tuner.summary()))
+    if rate_limit:
+        from ac_api import set_rate_limiter
+        from ratelimit import RateLimiter, parse_quotas
+        try:
+            set_rate_limiter(RateLimiter(parse_quotas(rate_limit), rate_limit_file))
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint="--rate-limit")
+    if response_cache or response_cache_file:
+        from ac_api import enable_response_cache
+        cache = enable_response_cache(path=response_cache_file)
+
+        def close_cache():
+            cache.save()
+            print(cache.summary())
+
+        ctx.call_on_close(close_cache)
+    if profile:
+        from profiling import Profiler
+        profiler = Profiler(profile_output)
+        profiler.start()
+        ctx.call_on_close(lambda: print(profiler.stop()))
+
+
+def _pool_size(workers: int):
+    """ the threads of a command's pools, the most requests in flight with --auto-tune
+
+    With --auto-tune the pools have a thread for each request that may be in
+    flight and the limits start at workers.
+    """
+    tuner = click.get_current_context().find_root().obj
+    if tuner is None:
+        return workers
+    tuner.initial = min(workers, tuner.maximum)
+    return tuner.maximum
 
 
 @cli.command()
 @click.argument("datafile", type=click.Path(exists=True))
-def load(datafile):
+@click.option("--dimensions", type=click.Path(exists=True),
+        help="dimension cache file used to check dimension/UoM pairs")
+@click.option("--no-validate", is_flag=True, help="skip the pre-flight validation")
+@click.option("--quarantine", "quarantine_file", type=click.Path(),
+        help="xlsx file for the rows that could not be loaded (default: <datafile>_quarantine.xlsx)")
+@click.option("--workers", default=8, show_default=True,
+        help="concurrent publish and equipment requests")
+@click.option("--catalog", "catalog_file", type=click.Path(exists=True),
+        help="catalog of the AC objects (see the catalog command) for references outside the workbook")
+def load(datafile, dimensions, no_validate, quarantine_file, workers, catalog_file):
     """ Load AC data from a spreadsheet
     Inserts all of the given data into AC.
     Writes the AC ids back into spreadsheet.
 
     Args:
         datafile - xlsx file that contains the data to be loaded
+        dimensions - optional dimension cache file for validation
+        no_validate - skip the validation of the workbook
+        quarantine_file - where to write the rows that failed and their dependents
+        workers - number of concurrent publish and equipment requests
+        catalog_file - optional catalog used for validation and to resolve the
+            references to objects that are in AC but not in the workbook
     """
+    from ac_api import read_dimensions
+    from catalog import Catalog
+    from loader import open_workbook, load_attributes, load_attribute_groups, load_indicators, \
+        load_indicator_groups, load_templates, load_models_and_equipment, load_attribute_values, \
+        read_equipment_ids, stream_workbook, with_catalog, with_catalog_ids, write_ids
+    from quarantine import Quarantine
+    from validation import validate_workbook
+    from xlsx_patch import IdWriter
+
     click.echo("Opening %s..." % datafile)
-    wb = load_workbook(filename=datafile)
-    indicators = load_indicators(wb["Indicator"])
-    update_worksheet(indicators, wb["Indicator"])
-    indicator_groups = load_indicator_groups(indicators, wb["Indicator Group"])
-    update_worksheet(indicator_groups, wb["Indicator Group"])
-    templates = load_templates(indicator_groups, wb["Model Template"])
-    update_worksheet(templates, wb["Model Template"])
-    models = load_models(templates, wb["Model"])
-    update_worksheet(models, wb["Model"])
-    equipment = load_equipment(models, wb["Equipment"])
-    update_worksheet(equipment, wb["Equipment"])
-    # save the changes
-    wb.save(filename=datafile)
+    with stage("read workbook"):
+        wb = open_workbook(datafile)
+    ids = IdWriter(datafile)
+    catalog = Catalog(catalog_file) if catalog_file else None
+    if not no_validate:
+        with stage("validate"):
+            report = validate_workbook(wb, read_dimensions(dimensions) if dimensions else None,
+                catalog)
+        if report.issues:
+            print(report.summary())
+        if not report.ok:
+            raise click.ClickException("validation failed, nothing was loaded")
+    quarantine = Quarantine()
+    workers = _pool_size(workers)
+    # the attribute sheets are optional
+    attributes, attribute_groups = [], []
+    if "Attribute" in wb.sheetnames:
+        with stage("attributes"):
+            attributes = load_attributes(wb["Attribute"], quarantine)
+        with stage("write ids"):
+            write_ids(ids, attributes, wb["Attribute"])
+    if "Attribute Group" in wb.sheetnames:
+        with stage("attribute groups"):
+            attribute_groups = load_attribute_groups(attributes, wb["Attribute Group"], quarantine)
+        with stage("write ids"):
+            write_ids(ids, attribute_groups, wb["Attribute Group"])
+    with stage("indicators"):
+        indicators = load_indicators(wb["Indicator"], quarantine)
+    with stage("write ids"):
+        write_ids(ids, indicators, wb["Indicator"])
+    with stage("indicator groups"):
+        indicator_groups = load_indicator_groups(
+            with_catalog(indicators, catalog, "indicators", wb["Indicator Group"], IG_INDICATOR),
+            wb["Indicator Group"], quarantine)
+    with stage("write ids"):
+        write_ids(ids, indicator_groups, wb["Indicator Group"])
+    with stage("templates"):
+        templates = load_templates(
+            with_catalog(indicator_groups, catalog, "indicatorgroups", wb["Model Template"],
+                TEM_INDICATOR_GROUP),
+            wb["Model Template"], quarantine, attribute_groups)
+    with stage("write ids"):
+        write_ids(ids, templates, wb["Model Template"])
+    with stage("models and equipment"):
+        models, equipment = load_models_and_equipment(
+            with_catalog(templates, catalog, "templates", wb["Model"], MOD_TEMPLATE),
+            wb["Model"], wb["Equipment"], quarantine, workers,
+            with_catalog([], catalog, "models", wb["Equipment"], EQU_MODEL), ids)
+    with stage("write ids"):
+        # the ids of the equipment were written while it was loaded
+        write_ids(ids, models, wb["Model"])
+    if "Attribute Value" in wb.sheetnames:
+        # the ids are all written, the sheets are streamed from the file from here on
+        with stream_workbook(datafile) as patched:
+            # the equipment is not kept by the load, its ids are read back from the file
+            with stage("read equipment ids"):
+                equipment_ids = read_equipment_ids(patched["Equipment"])
+            with stage("attribute values"):
+                load_attribute_values(
+                    with_catalog_ids(equipment_ids, catalog, "equipment", patched["Attribute Value"],
+                        VAL_EQUIPMENT),
+                    attribute_groups, attributes, patched["Attribute Value"], quarantine,
+                    workers=workers)
+    # save the rows that could not be loaded so they can be fixed and retried
+    if len(quarantine):
+        if not quarantine_file:
+            quarantine_file = os.path.splitext(datafile)[0] + "_quarantine.xlsx"
+        # the file has the ids of the loaded rows now
+        quarantine.save(open_workbook(datafile), quarantine_file)
+        print(f"{len(quarantine)} object(s) could not be loaded, see {quarantine_file}")
 
 @cli.command()
 @click.argument("datafile", type=click.Path(exists=True))
-def delete(datafile):
-    """ Delete AC data defined in spreadsheet
-    Requires ids in the first column of each object to be deleted
+@click.option("--dimensions", type=click.Path(exists=True),
+        help="dimension cache file used to check dimension/UoM pairs")
+@click.option("--catalog", "catalog_file", type=click.Path(exists=True),
+        help="catalog of the AC objects (see the catalog command)")
+def validate(datafile, dimensions, catalog_file):
+    """ Validate a spreadsheet without calling AC
+    Checks required fields, codes, duplicates and references in all sheets.
 
     Args:
-        datafile - the xlsx file that contains the data to be deleted
-     """
+        datafile - xlsx file that contains the data to be checked
+        dimensions - optional dimension cache file (see the dimensions command)
+        catalog_file - optional catalog, references to objects in AC are accepted
+            and rows that are already in AC are reported
+    """
+    from openpyxl import load_workbook
+    from validation import validate_workbook
+    if dimensions:
+        from ac_api import read_dimensions
+    if catalog_file:
+        from catalog import Catalog
+
+    wb = load_workbook(filename=datafile, read_only=True)
+    report = validate_workbook(wb, read_dimensions(dimensions) if dimensions else None,
+        Catalog(catalog_file) if catalog_file else None)
+    wb.close()
+    print(report.summary())
+    if not report.ok:
+        raise SystemExit(1)
 
-    print(f"Opening {datafile}...")
-    wb = load_workbook(filename=datafile)
-    # do this in the reverse order of the loads due to dependencies
-    equip_sheet = wb["Equipment"]
-    for row in equip_sheet.iter_rows(min_row=2):
-        if row[ID].value:
-            equip = Equipment(equipmentId=row[ID].value)
-            status = equip.delete()
-            if status == 204:
-                row[ID].value = ""
-                print(f"Deleted {row[INTERNAL_ID].value}")
-            else:
-                print(f"Could not delete {row[ID].value}")
-
-    model_sheet = wb["Model"]
-    for row in model_sheet.iter_rows(min_row=2):
-        if row[ID].value:
-            model = Model(modelId=row[ID].value)
-            status = model.delete()
-            if status == 204:
-                row[ID].value = ""
-                print(f"Deleted {row[INTERNAL_ID].value}")
-            else:
-                print(f"Could not delete {row[ID].value}")
-
-    template_sheet = wb["Model Template"]
-    for row in template_sheet.iter_rows(min_row=2):
-        if row[ID].value:
-            template = Template(id=row[ID].value)
-            status = template.delete()
-            if status == 200:
-                row[ID].value = ""
-                print(f"Deleted {row[INTERNAL_ID].value}")
-            else:
-                print(f"Could not delete {row[ID].value}")
-
-    indicator_group_sheet = wb["Indicator Group"]
-    previous_id = ""
-    for row in indicator_group_sheet.iter_rows(min_row=2):
-        # check for duplicate IDs in the column and clear them
-        if previous_id == row[ID].value:
-            row[ID].value = ""
-
-        if row[ID].value:
-            indicator_group = IndicatorGroup(id=row[ID].value)
-            status = indicator_group.delete()
-            if status == 200:
-                previous_id = row[ID].value
-                row[ID].value = ""
-                print(f"Deleted {row[INTERNAL_ID].value}")
-            else:
-                print(f"Could not delete {row[ID].value}")
-
-    indicator_sheet = wb["Indicator"]
-    for row in indicator_sheet.iter_rows(min_row=2):
-        if row[ID].value:
-            indicator = Indicator(id=row[ID].value)
-            status = indicator.delete()
-            if status == 200:
-                row[ID].value = ""
-                print(f"Deleted {row[INTERNAL_ID].value}")
-            else:
-                print(f"Could not delete {row[ID].value}")
-
-
-    # save the changes
-    wb.save(filename=datafile)
-
-
-
-def load_indicators(indicator_sheet):
-    """ Loads all of the indicators into AC
+@cli.command()
+@click.argument("cachefile", type=click.Path())
+def dimensions(cachefile):
+    """ Save the AC dimensions and units of measure to a cache file
+    The file can be passed to validate and load with --dimensions.
 
     Args:
-        indicator_sheet - worksheet containing the required datafields
-
-    Returns:
-        List of indicators that were loaded
-
+        cachefile - json file to write the dimensions to
     """
-    indicators = []
-
-    # open the indicator sheet and load the objects
-    for row in indicator_sheet.iter_rows(min_row=2, values_only=True):
-        indicator = Indicator(internalId=row[IND_INTERNAL_ID],
-                                description=Description(row[IND_DESCRIPTION]),
-                                dataType=row[IND_DATA_TYPE],
-                                dimension1=row[IND_DIMENSION],
-                                indicatorUom=row[IND_UOM],
-                                expectedBehaviour=str(row[IND_EXPECTED_BEHAVIOR]),
-                                indicatorColorCode=row[IND_COLOR],
-                                id=4)
-
-        indicators.append(indicator)
-
-    # insert into AC
-    for indicator in indicators:
-        print(f"inserting indicator {indicator.internalId}...")
-        try:
-            indicator.insert()
-        except Exception as ex:
-            print(f"failed...error:{ex}")
-        else:
-            print(f"sucess...id = {indicator.id}")
+    from ac_api import load_dimensions, dump_dimensions
 
-    return indicators
+    dims = load_dimensions()
+    dump_dimensions(dims, cachefile)
+    print(f"Saved {len(dims)} dimensions to {cachefile}")
 
-def load_indicator_groups(indicators: List[Indicator], ig_sheet):
-    """ Loads all of the indicator groups into AC
+@cli.command()
+@click.argument("catalogfile", type=click.Path())
+@click.option("--full", is_flag=True, help="read everything again instead of the changes")
+@click.option("--page-size", default=1000, show_default=True, help="objects per request")
+def catalog(catalogfile, full, page_size):
+    """ Create or refresh the local catalog of the AC objects
+    The first refresh reads all of the objects, later ones only read the
+    objects changed since. Use --full to drop the objects deleted in AC.
 
     Args:
-        indicators - list of indicators that were loaded
-        ig_sheet - worksheet containing the required datafields
-
-
-    Returns:
-        List of indicator groups that were loaded
+        catalogfile - SQLite file of the catalog
+        full - read all of the objects again
+        page_size - number of objects per request
     """
+    from catalog import Catalog
 
-    # open the indicator group sheet and load the objects
-    # loop through the row and get the distinct indicator group identifiers
-    indicator_groups = []
-    internal_id = ""
-    desc = ""
-    ig_indicators = []
-    for iteration, row in enumerate(ig_sheet.iter_rows(min_row=2, values_only=True)):
-        # first iteration
-        if iteration == 0:
-            internal_id = row[IG_INTERNAL_ID]
-            desc = row[IG_DESCRIPTION]
-            ig_indicators.append(row[IG_INDICATOR])
-        else:
-            # new internal id?
-            if internal_id != row[IG_INTERNAL_ID]:
-                # create indicator group and add to list
-                indicator_groups.append(IndicatorGroup(internalId=internal_id,
-                    description=Description(desc), indicators=ig_indicators))
-                ig_indicators = []
-                internal_id = row[IG_INTERNAL_ID]
-                desc = row[IG_DESCRIPTION]
-                ig_indicators.append(row[IG_INDICATOR])
-            else: # same internal id, append the indicator
-                ig_indicators.append(row[IG_INDICATOR])
-
-    # out of the loop, we should have at least one indicator group
-    indicator_groups.append(IndicatorGroup(internalId=internal_id,
-        description=Description(desc), indicators=ig_indicators))
-
-    # get the ids for each indicator in each indicator group
-    for indicator_group in indicator_groups:
-        # loop through the temp_ids in the indicator group
-        for iteration, temp_id in enumerate(indicator_group.indicators):
-            for ind in indicators:
-                # get the real id from the indicators list and replace the temp_id
-                if ind.internalId == temp_id:
-                    indicator_group.indicators[iteration] = ind.id
-                    break
-
-    # insert into AC
-    for indicator_group in indicator_groups:
-        print(f"inserting indicator group {indicator_group.internalId}...")
-        try:
-            indicator_group.insert()
-        except Exception as ex:
-            print(f"failed...error: {ex}")
-        else:
-            print(f"success...id = {indicator_group.id}")
+    with Catalog(catalogfile) as cat:
+        with stage("refresh catalog"):
+            counts = cat.refresh(full=full, page_size=page_size)
+            dims = cat.refresh_dimensions()
+        for collection, count in counts.items():
+            print(f"{collection}: {count} read")
+        print(f"dimensions: {dims} read")
 
-    return indicator_groups
+@cli.command()
+@click.argument("datafile", type=click.Path(exists=True))
+@click.option("--changes", "changes_file", type=click.Path(),
+        help="json lines file for the inserts, updates and deletes that make AC match the workbook")
+@click.option("--limit", default=20, show_default=True,
+        help="differences listed per sheet, 0 for all of them")
+@click.option("--page-size", default=1000, show_default=True, help="objects per request")
+def diff(datafile, changes_file, limit, page_size):
+    """ Compare a spreadsheet with the objects in AC
+    Reports the rows that are missing or different in AC and the objects in AC
+    that are not in the spreadsheet (orphaned).
 
-def load_templates(indicator_groups, template_sheet):
-    """ Loads all of the templates into AC
+    Args:
+        datafile - xlsx file to compare
+        changes_file - optional file for the change set, one json object per change
+        limit - number of differences listed per sheet
+        page_size - number of objects per request
+    """
+    from diff import diff_workbook, write_changes, KINDS
+    from loader import open_workbook
+
+    wb = open_workbook(datafile)
+    counts = {}
+    differences = diff_workbook(wb, page_size, counts)
+    if changes_file:
+        differences = write_changes(differences, changes_file)
+    listed = {}
+    with stage("diff"):
+        for difference in differences:
+            listed[difference.sheet] = listed.get(difference.sheet, 0) + 1
+            if not limit or listed[difference.sheet] <= limit:
+                print(f"{difference.sheet}: {difference.describe()}")
+    for sheet, count in counts.items():
+        print(f"{sheet}: " + ", ".join(f"{count[kind]} {kind}" for kind in KINDS))
+    if sum(listed.values()):
+        raise SystemExit(1)
 
-    Supports model templates only.
+@cli.command()
+@click.argument("datafile", type=click.Path(exists=True))
+def delete(datafile):
+    """ Delete AC data defined in spreadsheet
+    Requires ids in the first column of each object to be deleted
 
     Args:
-        indicator_groups - list of indicator groups that were loaded
-        template_sheet - worksheet that contains required datafields
+        datafile - the xlsx file that contains the data to be deleted
+     """
+    from ac_api import Attribute, AttributeGroup, Indicator, IndicatorGroup, Template, Model, \
+        Equipment
+    from loader import open_workbook, delete_rows
+    from xlsx_patch import IdWriter
 
-    Returns:
-        list of the templates that were loaded
+    print(f"Opening {datafile}...")
+    wb = open_workbook(datafile)
+    ids = IdWriter(datafile)
+    # do this in the reverse order of the loads due to dependencies
+    with stage("delete equipment"):
+        delete_rows(ids, wb, "Equipment", lambda id: Equipment(equipmentId=id), 204)
 
-    """
-    # open the template sheet and load the objects
-    # loop through the row and get the distinct template identifiers
-    templates = []
-    internal_id = ""
-    desc = ""
-    template_ig = []
-    for iteration, row in enumerate(template_sheet.iter_rows(min_row=2, values_only=True)):
-        # first iteration
-        if iteration == 0:
-            internal_id = row[TEM_INTERNAL_ID]
-            desc = row[TEM_DESCRIPTION]
-            template_ig.append(row[TEM_INDICATOR_GROUP])
-        else:
-            # new internal id?
-            if internal_id != row[TEM_INTERNAL_ID]:
-                # create template and add to list
-                templates.append(Template(internalId=internal_id,
-                    description=Description(desc), indicatorGroups=template_ig))
-                template_ig = []
-                internal_id = row[TEM_INTERNAL_ID]
-                desc = row[TEM_DESCRIPTION]
-                template_ig.append(row[TEM_INDICATOR_GROUP])
-            else: # same internal id, append the indicator group
-                template_ig.append(row[TEM_INDICATOR_GROUP])
-
-    # out of the loop, we should have at least one indicator group
-    templates.append(Template(internalId=internal_id,
-        description=Description(desc), indicatorGroups=template_ig))
-
-    # get the ids for each indicator group in each template
-    for template in templates:
-        # loop through the temp_ids in the template
-        for iteration, temp_id in enumerate(template.indicatorGroups):
-            for ig in indicator_groups:
-                # get the real id from the indicator group list and replace the temp_id
-                if ig.internalId == temp_id:
-                    template.indicatorGroups[iteration] = IdString(ig.id)
-                    break
-
-    # insert into AC
-    for template in templates:
-        print(f"inserting template {template.internalId}...")
-        try:
-            template.insert()
-        except Exception as ex:
-            print(f"failed...error: {ex}")
-        else:
-            print(f"success...id = {template.id}")
+    with stage("delete models"):
+        delete_rows(ids, wb, "Model", lambda id: Model(modelId=id), 204)
 
-    return templates
+    with stage("delete templates"):
+        delete_rows(ids, wb, "Model Template", lambda id: Template(id=id), 200)
 
-def load_models(templates, model_sheet):
-    """ Loads all of the models into AC
+    with stage("delete indicator groups"):
+        delete_rows(ids, wb, "Indicator Group", lambda id: IndicatorGroup(id=id), 200)
 
-    Args:
-        templates - list of templates that were loaded
-        model_sheet - worksheet that contains required datafields
+    with stage("delete indicators"):
+        delete_rows(ids, wb, "Indicator", lambda id: Indicator(id=id), 200)
 
-    Returns:
-        list of the models that were loaded
+    if "Attribute Group" in wb.sheetnames:
+        with stage("delete attribute groups"):
+            delete_rows(ids, wb, "Attribute Group", lambda id: AttributeGroup(id=id), 200)
 
-    """
-    # open the model sheet and load the objects
-    # loop through the row and get the distinct identifiers
-    models = []
-    for row in model_sheet.iter_rows(min_row=2, values_only=True):
-       # create model and add to list
-       models.append(Model(internalId=row[MOD_INTERNAL_ID],
-            description=row[MOD_DESCRIPTION],
-            templates=row[MOD_TEMPLATE],
-            equipmentTracking=row[MOD_TRACKING],
-            organizationID=row[MOD_ORG]))
-
-    # get the ids for the template in each row
-    for model in models:
-        for template in templates:
-            # get the real id from the indicator group list and replace the temp_id
-            if model.templates == template.internalId:
-                model.templates = [PrimaryTemplate(template.id)]
-                break
-
-    # insert into AC
-    for model in models:
-        print(f"inserting and publishing model {model.internalId}...")
-        try:
-            model.insert()
-            model.publish()
-        except Exception as ex:
-            print(f"failed...error: {ex}")
-        else:
-            print(f"success...id = {model.modelId}")
-
-    return models
-
-
-def load_equipment(models, equipment_sheet):
-    equipment_list = []
-    for row in equipment_sheet.iter_rows(min_row=2, values_only=True):
-        equipment_list.append(Equipment(internalId=row[EQU_INTERNAL_ID],
-            description=Description(row[EQU_DESCRIPTION]),
-            modelId=row[EQU_MODEL],
-            operatorID=row[EQU_OPERATOR],
-            lifeCycle=row[EQU_LIFECYCLE]))
-
-    for equipment in equipment_list:
-        for model in models:
-            if equipment.modelId == model.internalId:
-                equipment.modelId = model.modelId
-                break
-
-    for equipment in equipment_list:
-        print(f"inserting {equipment.internalId}...")
-        try:
-            equipment.insert()
-        except Exception as ex:
-            print(f"failed...error: {ex}")
-        else:
-            print(f"success...id = {equipment.equipmentId}")
+    if "Attribute" in wb.sheetnames:
+        with stage("delete attributes"):
+            delete_rows(ids, wb, "Attribute", lambda id: Attribute(id=id), 200)
 
-    return equipment_list
+@cli.command()
+@click.argument("readingsfile", type=click.Path(exists=True))
+@click.option("--batch-size", default=1000, show_default=True, help="readings per request")
+@click.option("--workers", default=8, show_default=True, help="concurrent requests")
+@click.option("--chunk-size", default=50000, show_default=True, help="rows read from the file at a time")
+@click.option("--retries", default=3, show_default=True, help="attempts of a failed batch")
+@click.option("--catalog", "catalog_file", type=click.Path(exists=True),
+        help="catalog with the ids of the equipment and indicators")
+@click.option("--rejects", "rejects_file", type=click.Path(),
+        help="CSV file for the readings that could not be posted")
+def ingest(readingsfile, batch_size, workers, chunk_size, retries, catalog_file, rejects_file):
+    """ Post indicator readings from a CSV or Parquet file
+    The file has the columns equipment, indicator, timestamp and value.
 
+    Args:
+        readingsfile - the readings, with the internal ids of the equipment and indicators
+        batch_size - readings per request
+        workers - number of concurrent requests
+        chunk_size - rows read from the file at a time
+        retries - attempts of a batch before its readings are rejected
+        catalog_file - optional catalog, the ids not in it are looked up in AC
+        rejects_file - where to write the readings that were skipped or failed
+    """
+    from catalog import Catalog
+    from ingest import ingest as ingest_readings
 
+    catalog = Catalog(catalog_file) if catalog_file else None
+    with stage("ingest"):
+        try:
+            stats = ingest_readings(readingsfile, batch_size, _pool_size(workers), chunk_size,
+                retries, catalog, rejects_file)
+        except (ImportError, ValueError) as ex:
+            raise click.ClickException(str(ex))
+    print(stats.summary())
+    if stats.failed:
+        raise SystemExit(1)
 
-def update_worksheet(asset_central_objects: List, worksheet):
-    """ Update the worksheet with returned IDs in the first column
+@cli.command()
+@click.option("--socket", "socket_path", help="unix socket for the jobs (default: acload.sock in the temp dir)")
+@click.option("--drop-dir", type=click.Path(exists=True, file_okay=False),
+        help="folder watched for *.json job files")
+@click.option("--jobs", default=4, show_default=True, help="jobs that run at the same time")
+@click.option("--max-requests", default=16, show_default=True,
+        help="concurrent requests to AC of all jobs together")
+@click.option("--catalog", "catalog_file", type=click.Path(exists=True),
+        help="catalog passed to the load and validate jobs")
+@click.option("--refresh-interval", default=0.0, show_default=True,
+        help="seconds between catalog refreshes, 0 to never refresh")
+def serve(socket_path, drop_dir, jobs, max_requests, catalog_file, refresh_interval):
+    """ Run a daemon that keeps the AC session and caches warm and runs
+    load, delete, validate, dimensions, catalog and ingest jobs
 
     Args:
-        asset_central_objects - a list of objects with ids
-        worksheet - the worksheet to be updated
+        socket_path - the unix socket that accepts jobs from acload submit
+        drop_dir - optional folder with job files
+        jobs - number of jobs that run at the same time
+        max_requests - limit of concurrent requests shared by the jobs
+        catalog_file - optional catalog for the jobs, refreshed every refresh_interval seconds
     """
-    # check that we have a list to delete
-    if asset_central_objects is None:
-        return
-    # get the internal ids from the spreadsheet
-    for iteration, row in enumerate(worksheet.iter_rows(min_row=2, values_only=True)):
-        internal_id = row[INTERNAL_ID]
-        for obj in asset_central_objects:
-            if obj.internalId == internal_id:
-                # check for model since it has a different id
-                if isinstance(obj, Model):
-                    value = obj.modelId
-                elif isinstance(obj, Equipment):
-                    value = obj.equipmentId
-                else:
-                    value = obj.id
-                # adjust cells to account for header row and 1-based counting
-                worksheet.cell(column=ID+1, row=iteration+2, value=value)
-                break
-
+    from daemon import Daemon, DEFAULT_SOCKET
+
+    daemon = Daemon(max_jobs=jobs, max_requests=max_requests, catalog=catalog_file,
+        refresh_interval=refresh_interval)
+    daemon.warm()
+    socket_path = socket_path or DEFAULT_SOCKET
+    daemon.serve_socket(socket_path)
+    print(f"Accepting jobs on {socket_path}")
+    if drop_dir:
+        daemon.watch(drop_dir)
+        print(f"Watching {drop_dir} for jobs")
+    daemon.refresh_catalog()
+    daemon.wait()
+
+@cli.command(context_settings={"ignore_unknown_options": True})
+@click.option("--socket", "socket_path", help="unix socket of the daemon (default: acload.sock in the temp dir)")
+@click.option("--priority", type=click.Choice(["high", "normal", "low"]), default="normal",
+        show_default=True, help="queued jobs and requests of a higher priority go first")
+@click.option("--weight", default=1.0, show_default=True,
+        help="share of the requests among the running jobs of the same priority")
+@click.option("--metrics", is_flag=True, help="print the queue wait and the requests of the job")
+@click.argument("command")
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def submit(socket_path, priority, weight, metrics, command, args):
+    """ Run a command in the acload serve daemon, e.g. acload submit load plant.xlsx
 
+    Args:
+        priority - priority class of the job
+        weight - share of the requests within the priority class
+        metrics - print the metrics of the job
+        command - load, delete, validate, diff, dimensions, catalog or ingest
+        args - the arguments of the command, existing files are passed with their absolute path
+    """
+    from daemon import submit as submit_job, DEFAULT_SOCKET
+
+    args = [os.path.abspath(arg) if os.path.exists(arg) else arg for arg in args]
+    result = submit_job({"command": command, "args": args, "priority": priority, "weight": weight},
+        socket_path or DEFAULT_SOCKET)
+    print(result["output"], end="")
+    if metrics and "metrics" in result:
+        print(", ".join(f"{name} {value}" for name, value in result["metrics"].items()))
+    if result["exit_code"]:
+        raise SystemExit(result["exit_code"])
+
+
+def __getattr__(name):
+    """ the stages are in loader.py, acload.load_indicators etc. import it on first use """
+    import loader
+    try:
+        return getattr(loader, name)
+    except AttributeError:
+        raise AttributeError(f"module 'acload' has no attribute '{name}'") from None
@@ -0,0 +1,171 @@
+"""Adaptive concurrency of the ACAPI requests
+
+Instead of a fixed number of workers, the AutoTuner keeps a limit of the
+requests in flight for each entity type, keyed like the rate limits
+("POST:equipment", "PUT:models", ...), and adjusts it from the responses (AIMD):
+
+    success at about the best latency seen   -> + 1 per round trip (additive increase)
+    latency above tolerance x the best       -> x 0.9, the tenant starts to queue
+    429 Too Many Requests, 5xx or an error   -> x 0.5 (multiplicative decrease)
+
+A limit is only increased while it is used up, and decreased at most once per
+round trip so that the requests that were in flight together cut it once. The
+pools of the loader are sized to the maximum and the limits decide how many of
+their threads send at the same time.
+
+"""
+
+# standard imports
+import threading
+import time
+from typing import Dict
+
+# local imports
+from profiling import collection_of
+
+
+# limits of a new key
+INITIAL_LIMIT = 4
+MAX_LIMIT = 64
+
+
+class AdaptiveLimit():
+    """ AIMD limit of the requests in flight for one key
+
+    Attributes:
+        limit: requests that may be in flight, fractional between the adjustments
+        minimum, maximum: range of the limit
+        tolerance: latency over the best one that counts as queueing
+        lowest, highest: range the limit had after its first decrease
+        requests, throttled, errors: counts of the responses
+    """
+
+    def __init__(self, initial: int = INITIAL_LIMIT, minimum: int = 1, maximum: int = MAX_LIMIT,
+            tolerance: float = 2.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.lowest = self.highest = self.limit
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._best = None
+        self._latency = None
+        self._decreased = 0.0
+        self._decreases = 0
+        self._start = time.perf_counter()
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        """ wait until a request can be sent """
+        with self._changed:
+            while self.in_flight >= int(self.limit):
+                self._changed.wait()
+            self.in_flight += 1
+
+    def release(self, elapsed: float, status_code: int = None):
+        """ adjust the limit with the outcome of a request, None for a request that raised """
+        with self._changed:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self.requests += 1
+            if status_code == 429:
+                self.throttled += 1
+                self._decrease(0.5)
+            elif status_code is None or status_code >= 500:
+                self.errors += 1
+                self._decrease(0.5)
+            else:
+                self._latency = elapsed if self._latency is None else 0.8 * self._latency + 0.2 * elapsed
+                self._best = elapsed if self._best is None else min(self._best, elapsed)
+                if self._latency > self.tolerance * self._best:
+                    self._decrease(0.9)
+                elif saturated:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if self._decreases:
+                self.lowest = min(self.lowest, self.limit)
+                self.highest = max(self.highest, self.limit)
+            self._changed.notify_all()
+
+    def _decrease(self, factor: float):
+        now = time.perf_counter()
+        # once per round trip
+        if now - self._decreased < (self._latency or 0.0):
+            return
+        self._decreased = now
+        if not self._decreases:
+            self.lowest = self.highest = self.limit
+        self._decreases += 1
+        self.limit = max(self.minimum, self.limit * factor)
+        if self._best is not None and self._latency is not None:
+            # the best latency slowly follows the current one, the tenant may have become slower
+            self._best = min(self._latency, self._best * 1.1)
+
+    @property
+    def rate(self):
+        """ requests per second since the first request """
+        seconds = time.perf_counter() - self._start
+        return self.requests / seconds if seconds else 0.0
+
+    def summary(self):
+        return (f"{int(self.limit)} in flight ({int(self.lowest)}-{int(self.highest)}), "
+            f"{self.requests} request(s), {self.rate:.1f}/s, {self.throttled} throttled, "
+            f"{self.errors} error(s)")
+
+
+class AutoTuner():
+    """ one AdaptiveLimit per method and collection
+
+    Attributes:
+        initial, maximum: the limits of a new key
+        limits: {key: AdaptiveLimit}
+    """
+
+    def __init__(self, initial: int = INITIAL_LIMIT, maximum: int = MAX_LIMIT):
+        self.initial = initial
+        self.maximum = maximum
+        self.limits: Dict[str, AdaptiveLimit] = {}
+        self._lock = threading.Lock()
+
+    def limit(self, method: str, url: str) -> AdaptiveLimit:
+        key = f"{method}:{collection_of(url)}"
+        with self._lock:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = self.limits[key] = AdaptiveLimit(self.initial, maximum=self.maximum)
+            return limit
+
+    def settings(self):
+        """ {key: the limit each key converged on} """
+        return {key: int(limit.limit) for key, limit in sorted(self.limits.items())}
+
+    def summary(self):
+        return "\n".join(["auto-tuned concurrency:"] + [f"  {key}: {limit.summary()}"
+            for key, limit in sorted(self.limits.items())])
+
+
+class AdaptiveTransport():
+    """ transport that sends the requests within the limits of an AutoTuner
+
+    Attributes:
+        inner: the transport that sends the requests
+        tuner: the AutoTuner
+    """
+
+    def __init__(self, inner, tuner: AutoTuner):
+        self.inner = inner
+        self.tuner = tuner
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        limit = self.tuner.limit(method, url)
+        limit.acquire()
+        start = time.perf_counter()
+        try:
+            res = self.inner.request(method, url, data=data, headers=headers)
+        except Exception:
+            limit.release(time.perf_counter() - start)
+            raise
+        limit.release(time.perf_counter() - start, res.status_code)
+        return res
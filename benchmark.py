@@ -0,0 +1,154 @@
+"""Benchmarks for ACLoad against the local mock server or recorded cassettes
+
+Run with:
+    python benchmark.py transport --objects 500 --workers 16 --latency 0.02
+    python benchmark.py load ac_sample.xlsx --cassette load.json --record
+    python benchmark.py load ac_sample.xlsx --cassette load.json
+    python benchmark.py startup --runs 20 --max-ms 150
+
+"""
+
+# standard imports
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# third party imports
+import click
+
+# local imports
+import ac_api
+import acload
+import mock_server
+from ac_api import Description, Equipment, CassetteTransport, SessionTransport, Http2Transport
+
+
+def use_mock_server(latency: float = 0.0):
+    """ start the mock server and point ac_api at it """
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    server = mock_server.start(latency=latency)
+    url = f"http://localhost:{server.server_port}"
+    ac_api.base_url = url
+    ac_api.token_url = url + "/oauth/token"
+    ac_api.client_id = "benchmark"
+    ac_api.client_secret = "benchmark"
+    return server
+
+
+@click.group()
+def cli():
+    """ ACLoad benchmarks """
+    pass
+
+
+@cli.command()
+@click.option("--objects", default=500, show_default=True, help="equipment to insert, read and delete")
+@click.option("--workers", default=16, show_default=True, help="concurrent requests")
+@click.option("--latency", default=0.02, show_default=True, help="seconds added to every response")
+@click.option("--description-size", default=2000, show_default=True,
+        help="length of the long description, larger bodies compress better")
+def transport(objects, workers, latency, description_size):
+    """ Compare the transports with and without compression """
+    server = use_mock_server(latency)
+    configs = [("http/1.1", SessionTransport, False), ("http/1.1 gzip", SessionTransport, True)]
+    try:
+        import httpx
+        configs += [("httpx", Http2Transport, False), ("httpx gzip", Http2Transport, True)]
+    except ImportError:
+        print("httpx is not installed, skipping Http2Transport")
+
+    print(f"{'transport':<16}{'insert s':>10}{'load s':>10}{'delete s':>10}{'req/s':>10}"
+        f"{'kB sent':>10}{'kB recv':>10}")
+    for name, transport_class, compress in configs:
+        ac_api.set_transport(transport_class(compress=compress))
+        state = server.state
+        requests, bytes_in, bytes_out = state.requests, state.bytes_in, state.bytes_out
+        equipment = [Equipment(internalId=f"BENCH{i}",
+            description=Description(f"equipment {i}", "x" * description_size))
+            for i in range(objects)]
+        timings = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            start = time.perf_counter()
+            list(executor.map(Equipment.insert, equipment))
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            Equipment.load_many([e.internalId for e in equipment], max_workers=workers)
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            list(executor.map(Equipment.delete, equipment))
+            timings.append(time.perf_counter() - start)
+        rate = (state.requests - requests) / sum(timings)
+        print(f"{name:<16}{timings[0]:>10.2f}{timings[1]:>10.2f}{timings[2]:>10.2f}{rate:>10.0f}"
+            f"{(state.bytes_in - bytes_in) / 1024:>10.0f}{(state.bytes_out - bytes_out) / 1024:>10.0f}")
+    server.shutdown()
+
+
+@cli.command()
+@click.argument("datafile", type=click.Path(exists=True))
+@click.option("--cassette", required=True, type=click.Path(), help="cassette file to record or replay")
+@click.option("--record", is_flag=True, help="record the cassette against the tenant in .env")
+@click.option("--mock", is_flag=True, help="record against the mock server instead of the tenant")
+@click.option("--keep-latency/--no-latency", default=True, show_default=True,
+        help="replay with the recorded latency")
+def load(datafile, cassette, record, mock, keep_latency):
+    """ Time acload load on a copy of the workbook
+
+    The exchanges are recorded once with --record and then replayed offline
+    so that the load time can be compared between changes.
+    """
+    if mock:
+        use_mock_server()
+    elif not ac_api.base_url:
+        # the cassette urls are relative to base_url
+        ac_api.base_url = "https://replay"
+    transport = CassetteTransport(cassette, "record" if record or mock else "replay",
+        keep_latency=keep_latency)
+    ac_api.set_transport(transport)
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, os.path.basename(datafile))
+        shutil.copy(datafile, copy)
+        start = time.perf_counter()
+        acload.cli.main(["load", copy], standalone_mode=False)
+        elapsed = time.perf_counter() - start
+    transport.save()
+    print(f"load of {datafile} took {elapsed:.2f}s ({transport.mode})")
+
+
+@cli.command()
+@click.option("--runs", default=20, show_default=True, help="interpreter starts per command")
+@click.option("--max-ms", type=float, help="exit with an error if the median is slower")
+def startup(runs, max_ms):
+    """ Time the start of acload in a new interpreter
+
+    The orchestrator starts acload for every small job, so the import time
+    of the CLI adds up. --max-ms turns this into a check for regressions.
+    """
+    commands = {
+        "python": "pass",
+        "import acload": "import acload",
+        "acload --help": "import acload; acload.cli.main(['--help'], standalone_mode=False)",
+    }
+    directory = os.path.dirname(os.path.abspath(__file__))
+    medians = {}
+    print(f"{'command':<16}{'median ms':>10}{'min ms':>10}")
+    for name, code in commands.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=directory, check=True,
+                stdout=subprocess.DEVNULL)
+            timings.append(1000 * (time.perf_counter() - start))
+        medians[name] = statistics.median(timings)
+        print(f"{name:<16}{medians[name]:>10.1f}{min(timings):>10.1f}")
+    if max_ms is not None and medians["acload --help"] > max_ms:
+        raise click.ClickException(f"acload --help took {medians['acload --help']:.1f} ms, "
+            f"more than {max_ms} ms")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,236 @@
+"""Loads a hierarchy of AC objects from Python data without a workbook
+
+The objects are given as records (dicts, or pandas DataFrames with one row
+per record) using the field names of the ac_api classes. The references hold
+internal ids and are resolved by the builder:
+
+    builder = Builder(workers=16)
+    builder.add("Indicator", [{"internalId": "voltage_out", "description": "Output Voltage",
+        "dataType": "numeric", "dimension1": "VOLTAG", "indicatorUom": "V"}])
+    builder.add("Indicator Group", [{"internalId": "TIG", "description": "Transformer",
+        "indicators": ["voltage_out"]}])
+    builder.add("Model Template", [{"internalId": "SDT", "description": "Transformers",
+        "indicatorGroups": "TIG"}])
+    builder.add("Model", models_df)          # templates: internal id of the template
+    builder.add("Equipment", equipment_df)   # modelId: internal id of the model
+    result = builder.build()
+    result.ids("Equipment")                  # {internal id: AC id}
+    result.to_dataframe()                    # type, internalId, id, error
+
+Records of indicator groups and templates with the same internal id are
+merged, so a "long" DataFrame with one member per row works as well. The
+objects of each level are created concurrently; an object that fails is
+reported with its error and everything below it is skipped.
+
+Attributes, attribute groups and attribute values are not built, load them
+from a workbook with acload load.
+
+"""
+
+# standard imports
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# local imports
+from ac_api import Description, Indicator, IndicatorGroup, IdString, Template, Model, \
+    PrimaryTemplate, Equipment, bind_client
+from catalog import Catalog, SHEET_COLLECTIONS
+from loader import ac_id
+from quarantine import Quarantine, DEPENDENCIES
+
+
+# type -> (class, field with the references to the type it depends on)
+TYPES = {
+    "Indicator": (Indicator, None),
+    "Indicator Group": (IndicatorGroup, "indicators"),
+    "Model Template": (Template, "indicatorGroups"),
+    "Model": (Model, "templates"),
+    "Equipment": (Equipment, "modelId"),
+}
+
+# types whose records with the same internal id are merged
+MERGED = {"Indicator Group", "Model Template"}
+
+# references as they are sent to AC
+REFERENCES = {
+    "Indicator Group": lambda ids: list(ids),
+    "Model Template": lambda ids: [IdString(id) for id in ids],
+    "Model": lambda ids: [PrimaryTemplate(id) for id in ids],
+    "Equipment": lambda ids: ids[0],
+}
+
+
+def _records(data):
+    """ the records of a list of dicts or a DataFrame, NaN is None """
+    if hasattr(data, "to_dict"):
+        data = data.to_dict("records")
+    for record in data:
+        yield {key: None if value != value else value for key, value in record.items()}
+
+def _references(value) -> List[str]:
+    """ the internal ids of a reference field, a single id or a list """
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        return [value]
+    return [ref for ref in value if ref is not None and ref != ""]
+
+
+class BuildResult():
+    """ The outcome of Builder.build, one row per object
+
+    Attributes:
+        rows: list of {"type", "internalId", "id", "error"}, the error is set for
+            the objects that were not created (and the models not published)
+    """
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def ok(self):
+        return not self.errors()
+
+    def ids(self, type_: str) -> Dict[str, str]:
+        """ {internal id: AC id} of the objects of the type that are in AC """
+        return {row["internalId"]: row["id"] for row in self.rows
+            if row["type"] == type_ and row["id"]}
+
+    def errors(self) -> List[dict]:
+        return [row for row in self.rows if row["error"]]
+
+    def to_dataframe(self):
+        """ the rows as a pandas DataFrame (needs pandas) """
+        import pandas
+        return pandas.DataFrame(self.rows, columns=["type", "internalId", "id", "error"])
+
+
+class Builder():
+    """ Creates indicators, indicator groups, templates, models and equipment
+
+    Attributes:
+        workers: concurrent creates
+        batch_size: objects submitted to the workers at a time
+        catalog: optional catalog for the references to objects that are in AC
+            but not in the data
+        quarantine: the objects that failed and the ones skipped because of them
+    """
+
+    def __init__(self, workers: int = 8, batch_size: int = 500, catalog: Catalog = None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.catalog = catalog
+        self.quarantine = Quarantine()
+        # type -> {internal id: (object, references)}
+        self._objects = {type_: {} for type_ in TYPES}
+
+    def add(self, type_: str, data):
+        """ Add records of a type
+
+        Args:
+            type_ - Indicator, Indicator Group, Model Template, Model or Equipment
+            data - dicts or a DataFrame with the field names of the class, the
+                reference field holds the internal id(s) of the referenced
+                objects; objects with an id are not created again
+
+        Returns:
+            the builder
+        """
+        if type_ not in TYPES:
+            raise ValueError(f"unknown type {type_}, use one of {', '.join(TYPES)}")
+        cls, reference_field = TYPES[type_]
+        names = set(cls.__dataclass_fields__)
+        objects = self._objects[type_]
+        for record in _records(data):
+            unknown = set(record) - names
+            if unknown:
+                raise ValueError(f"{type_} has no field {', '.join(sorted(unknown))}")
+            internal_id = record.get("internalId")
+            if not internal_id:
+                raise ValueError(f"{type_} record without internalId")
+            references = _references(record.pop(reference_field, None)) if reference_field else []
+            if internal_id in objects:
+                if type_ not in MERGED:
+                    raise ValueError(f"{type_} {internal_id} is given twice")
+                merged = objects[internal_id][1]
+                merged += [ref for ref in references if ref not in merged]
+                continue
+            if isinstance(record.get("description"), str) and cls is not Model:
+                record["description"] = Description(record["description"])
+            if record.get("expectedBehaviour") is not None:
+                record["expectedBehaviour"] = str(record["expectedBehaviour"])
+            record = {key: value for key, value in record.items() if value is not None}
+            objects[internal_id] = (cls(**record), list(dict.fromkeys(references)))
+        return self
+
+    def _lookup(self, type_: str, internal_id: str):
+        """ the AC id of a referenced object, "" if it is unknown """
+        if internal_id in self._objects[type_]:
+            return ac_id(self._objects[type_][internal_id][0])
+        if self.catalog is not None:
+            return self.catalog.lookup(SHEET_COLLECTIONS[type_], internal_id) or ""
+        return ""
+
+    def _resolve(self, type_: str, obj, references: List[str]):
+        """ set the AC ids of the references, False if the object must be skipped """
+        quarantine = self.quarantine
+        if quarantine.skip_dependent(type_, obj.internalId, references):
+            return False
+        parent = DEPENDENCIES[type_][0]
+        ids = []
+        for ref in references:
+            id = self._lookup(parent, ref)
+            if not id:
+                quarantine.fail(type_, obj.internalId, f"{parent} {ref} is not in AC")
+                return False
+            ids.append(id)
+        if type_ == "Equipment" and len(ids) != 1:
+            quarantine.fail(type_, obj.internalId, "needs one model")
+            return False
+        setattr(obj, TYPES[type_][1], REFERENCES[type_](ids))
+        return True
+
+    def _create(self, type_: str, obj):
+        try:
+            obj.insert()
+        except Exception as ex:
+            self.quarantine.fail(type_, obj.internalId, ex)
+            return
+        if type_ == "Model":
+            try:
+                # raises ElementCouldNotBePublished when AC answers with an error
+                obj.publish()
+            except Exception as ex:
+                self.quarantine.fail(type_, obj.internalId,
+                    f"inserted as {obj.modelId} but not published: {ex}")
+
+    def build(self) -> BuildResult:
+        """ Create the objects level by level, each level concurrently
+
+        Returns:
+            the BuildResult with the id or the error of each object
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for type_ in TYPES:
+                pending = []
+                for obj, references in self._objects[type_].values():
+                    if ac_id(obj):
+                        continue
+                    if type_ == "Indicator" or self._resolve(type_, obj, references):
+                        pending.append(obj)
+                for start in range(0, len(pending), self.batch_size):
+                    list(executor.map(bind_client(lambda obj: self._create(type_, obj)),
+                        pending[start:start + self.batch_size]))
+        rows = []
+        for type_ in TYPES:
+            for internal_id, (obj, _) in self._objects[type_].items():
+                # a model that was inserted but not published has its id and an error
+                rows.append({"type": type_, "internalId": internal_id, "id": ac_id(obj),
+                    "error": self.quarantine.reasons[type_].get(internal_id, "")})
+        return BuildResult(rows)
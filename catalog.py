@@ -0,0 +1,186 @@
+"""Local SQLite catalog of the objects in Asset Central
+
+The catalog keeps the json of the indicators, indicator groups, templates,
+models and equipment of a tenant, indexed by id and internal id, together with
+the dimensions. It is refreshed from the paged ACAPI readers; after the first
+refresh only the objects changed since the last one are read (changedOn).
+Validation and the id resolution of acload can then answer "does template X
+exist?" or "what is the id of model Y?" without calling the ACAPI.
+
+Objects deleted in AC are only dropped from the catalog by a full refresh.
+
+"""
+
+# standard imports
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+# local imports
+from ac_api import Indicator, IndicatorGroup, Template, Model, Equipment, Dimension, \
+    load_dimensions, read_pages, PAGE_SIZE, decode_objects
+
+
+# collection -> (class, id field)
+COLLECTIONS = {
+    "indicators": (Indicator, "id"),
+    "indicatorgroups": (IndicatorGroup, "id"),
+    "templates": (Template, "id"),
+    "models": (Model, "modelId"),
+    "equipment": (Equipment, "equipmentId"),
+}
+
+# sheet of the workbook -> collection
+SHEET_COLLECTIONS = {
+    "Indicator": "indicators",
+    "Indicator Group": "indicatorgroups",
+    "Model Template": "templates",
+    "Model": "models",
+    "Equipment": "equipment",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    internal_id TEXT,
+    changed_on TEXT,
+    json TEXT NOT NULL,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS objects_internal_id ON objects (collection, internal_id);
+CREATE TABLE IF NOT EXISTS dimensions (
+    dimension_id TEXT NOT NULL,
+    unit_id TEXT NOT NULL,
+    json TEXT NOT NULL,
+    PRIMARY KEY (dimension_id, unit_id)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    collection TEXT PRIMARY KEY,
+    changed_on TEXT,
+    refreshed_at REAL
+);
+"""
+
+# internal ids per query of get_many, below the SQLite variable limit
+QUERY_IDS = 500
+
+
+class Catalog():
+    """ SQLite catalog of the objects in AC
+
+    Attributes:
+        path: the database file, ":memory:" for a catalog that is not kept
+    """
+
+    def __init__(self, path: str = "acload_catalog.db"):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self, collections: Iterable[str] = None, full: bool = False,
+            page_size: int = PAGE_SIZE):
+        """ Read the objects changed since the last refresh from AC
+
+        Collections whose objects have no changedOn are always read in full.
+
+        Args:
+            collections - the collections to refresh, default all
+            full - replace the collections instead of reading the changes
+            page_size - objects per request
+
+        Returns:
+            {collection: number of objects read}
+        """
+        counts = {}
+        for collection in collections or COLLECTIONS:
+            id_field = COLLECTIONS[collection][1]
+            since = None if full else self.last_change(collection)
+            rows = []
+            last = since
+            for page in read_pages("/" + collection, changed_since=since, page_size=page_size):
+                for d in page:
+                    changed_on = d.get("changedOn") or None
+                    if changed_on and (last is None or changed_on > last):
+                        last = changed_on
+                    rows.append((collection, d[id_field], d.get("internalId"), changed_on,
+                        json.dumps(d)))
+            with self._lock, self._db:
+                if since is None:
+                    self._db.execute("DELETE FROM objects WHERE collection = ?", (collection,))
+                self._db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)", rows)
+                self._db.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)",
+                    (collection, last, time.time()))
+            counts[collection] = len(rows)
+        return counts
+
+    def refresh_dimensions(self):
+        """ Replace the dimensions with the ones in AC, returns the number of dimensions """
+        dims = load_dimensions()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM dimensions")
+            self._db.executemany("INSERT OR REPLACE INTO dimensions VALUES (?, ?, ?)",
+                [(d.dimensionId, d.unitId, d.to_json()) for d in dims])
+        return len(dims)
+
+    def last_change(self, collection: str) -> Optional[str]:
+        """ the latest changedOn seen in the collection, None if it was never refreshed """
+        with self._lock:
+            row = self._db.execute("SELECT changed_on FROM refreshes WHERE collection = ?",
+                (collection,)).fetchone()
+        return row[0] if row else None
+
+    def lookup(self, collection: str, internal_id: str) -> Optional[str]:
+        """ the id of an object, None if it is not in the catalog """
+        with self._lock:
+            row = self._db.execute("SELECT id FROM objects WHERE collection = ? AND internal_id = ?",
+                (collection, internal_id)).fetchone()
+        return row[0] if row else None
+
+    def ids(self, collection: str) -> Dict[str, str]:
+        """ {internal id: id} of all objects in the collection """
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT internal_id, id FROM objects WHERE collection = ?", (collection,)))
+
+    def get(self, collection: str, internal_id: str):
+        """ the object with the internal id, None if it is not in the catalog """
+        objects = self.get_many(collection, [internal_id])
+        return objects[0] if objects else None
+
+    def get_many(self, collection: str, internal_ids: Iterable[str]) -> List:
+        """ the objects with the internal ids, the ids not in the catalog are left out """
+        cls = COLLECTIONS[collection][0]
+        internal_ids = list(dict.fromkeys(internal_ids))
+        objects = []
+        for start in range(0, len(internal_ids), QUERY_IDS):
+            chunk = internal_ids[start:start + QUERY_IDS]
+            with self._lock:
+                rows = self._db.execute("SELECT json FROM objects WHERE collection = ? AND "
+                    f"internal_id IN ({','.join('?' * len(chunk))})", [collection, *chunk]).fetchall()
+            objects += decode_objects(cls, [json.loads(row[0]) for row in rows])
+        return objects
+
+    def dimensions(self) -> List[Dimension]:
+        with self._lock:
+            rows = self._db.execute("SELECT json FROM dimensions").fetchall()
+        return decode_objects(Dimension, [json.loads(row[0]) for row in rows])
+
+    def counts(self) -> Dict[str, int]:
+        """ {collection: number of objects} """
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT collection, COUNT(*) FROM objects GROUP BY collection"))
+        return {collection: counts.get(collection, 0) for collection in COLLECTIONS}
@@ -0,0 +1,118 @@
+import json
+import os
+
+import pytest
+
+import ac_api
+
+
+def pytest_addoption(parser):
+    parser.addoption("--cassette-mode", choices=["off", "record", "replay"], default="off",
+        help="record the ACAPI exchanges of each test or replay them offline")
+    parser.addoption("--cassette-dir", default="cassettes",
+        help="directory with one cassette per test")
+    parser.addoption("--keep-latency", action="store_true",
+        help="replay the cassettes with the recorded latency")
+    parser.addoption("--mock-server", action="store_true",
+        help="run the tests against the in-memory mock ACAPI instead of the tenant in .env")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "live: needs a live AC tenant, skipped when replaying")
+
+
+@pytest.fixture(scope="session")
+def mock_acapi(request):
+    """ the mock server when --mock-server is given """
+    if not request.config.getoption("--mock-server"):
+        yield None
+        return
+    import mock_server
+    server = mock_server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def mock_tenant(monkeypatch):
+    """ a fresh mock server that ac_api is pointed at, for the offline tests """
+    import mock_server
+    server = mock_server.start()
+    url = f"http://localhost:{server.server_port}"
+    monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+    monkeypatch.setattr("ac_api.base_url", url)
+    monkeypatch.setattr("ac_api.token_url", url + "/oauth/token")
+    monkeypatch.setattr("ac_api.client_id", "mock")
+    monkeypatch.setattr("ac_api.transport", None)
+    yield server
+    server.shutdown()
+
+
+class FakeResponse():
+    """ minimal requests.Response for the offline tests """
+    def __init__(self, status_code, content=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(content) if content is not None else ""
+        self.content = self.text.encode()
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeTransport():
+    """ transport that answers with a function of the test instead of AC
+
+    respond(method, url, data, headers) returns (status code, json content)
+    or (status code, json content, response headers); by default every
+    request is answered 200 with an empty list.
+
+    Attributes:
+        requests: the (method, url, data, headers) of the requests sent
+    """
+
+    def __init__(self):
+        self.respond = lambda method, url, data, headers: (200, [])
+        self.requests = []
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        self.requests.append((method, url, data, headers))
+        return FakeResponse(*self.respond(method, url, data, headers))
+
+
+@pytest.fixture
+def fake_transport(monkeypatch):
+    """ a FakeTransport that ac_api sends its requests to, with base url https://ac """
+    transport = FakeTransport()
+    monkeypatch.setattr("ac_api.transport", transport)
+    monkeypatch.setattr("ac_api.base_url", "https://ac")
+    return transport
+
+
+@pytest.fixture(autouse=True)
+def cassette(request, monkeypatch, mock_acapi):
+    """ run the test against a cassette when --cassette-mode is record or replay """
+    if mock_acapi is not None:
+        url = f"http://localhost:{mock_acapi.server_port}"
+        monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+        monkeypatch.setattr("ac_api.base_url", url)
+        monkeypatch.setattr("ac_api.token_url", url + "/oauth/token")
+        monkeypatch.setattr("ac_api.client_id", "mock")
+        monkeypatch.setattr("ac_api.transport", None)
+    mode = request.config.getoption("--cassette-mode")
+    if mode == "off":
+        yield None
+        return
+    if mode == "replay":
+        if request.node.get_closest_marker("live"):
+            pytest.skip("needs a live AC tenant")
+        # the cassettes have urls relative to base_url, any tenant url works
+        if not ac_api.base_url:
+            monkeypatch.setattr("ac_api.base_url", "https://replay")
+    directory = request.config.getoption("--cassette-dir")
+    os.makedirs(directory, exist_ok=True)
+    transport = ac_api.CassetteTransport(os.path.join(directory, request.node.name + ".json"),
+        mode, keep_latency=request.config.getoption("--keep-latency"))
+    monkeypatch.setattr("ac_api.transport", transport)
+    yield transport
+    transport.save()
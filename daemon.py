@@ -0,0 +1,601 @@
+"""Long running acload service that keeps the ACAPI session and caches warm
+
+Every acload run pays for the interpreter start, the imports, a token and
+new connections. The daemon does this once and then runs the jobs in the
+same process: the OAuth token, the connection pool, the response cache (the
+dimensions and load lookups are revalidated with ETags) and the catalog stay
+warm between the jobs. The jobs share one limit of concurrent requests to AC.
+
+A job is a json object with an acload command and its arguments:
+    {"command": "load", "args": ["/data/plant.xlsx", "--workers", "16"]}
+
+Jobs are sent to the unix socket with `acload submit load plant.xlsx`, or put
+as *.json files into the watched folder. Write the file under another name
+and rename it so that it is not read half written. The result is written to
+<job>.result.json and the job file is renamed to <job>.done, or to
+<job>.failed if it is not a valid job.
+
+A job can have a priority (high, normal or low) and a weight:
+    {"command": "load", "args": ["/data/pump.xlsx"], "priority": "high"}
+The queued jobs are started in the order of their priority, and the running
+jobs share the concurrent requests by priority first and then in proportion
+to their weight (see FairScheduler), so a small urgent job is not stuck behind
+the requests of a bulk load. Waiting moves a job up: a queued job one class
+per JOB_AGING seconds and the requests of a job one class per REQUEST_AGING
+seconds, so a steady stream of high priority jobs does not starve the low
+ones. A job on a workbook that another job is using stays queued and the
+job threads run the jobs after it. The result of a job has its queue wait,
+its requests and their wait and throughput.
+
+"""
+
+# standard imports
+import io
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from heapq import heapify, heappush
+
+# third party imports
+import click
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "acload.sock")
+
+# commands that can be run as jobs, the options of the acload group are set by the daemon
+COMMANDS = {"load", "delete", "validate", "diff", "dimensions", "catalog", "ingest"}
+
+# commands whose first argument is a workbook, jobs on the same workbook run one after the other
+WORKBOOK_COMMANDS = {"load", "delete", "validate", "diff"}
+
+# priority classes of the jobs, lower runs first
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# seconds of waiting that move a queued job, or the waiting requests of a job, up one priority class
+JOB_AGING = 60.0
+REQUEST_AGING = 1.0
+
+
+def _workbook(job: dict):
+    """ the absolute path of the workbook of a job, None if its command has none """
+    args = job.get("args") or []
+    if job.get("command") in WORKBOOK_COMMANDS and args:
+        return os.path.abspath(str(args[0]))
+    return None
+
+
+class _ThreadOutput(io.TextIOBase):
+    """ sys.stdout that sends the output of each job thread to its own buffer
+
+    The output of the worker threads of a job (e.g. the equipment inserts) goes
+    to the daemon's stdout.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "buffer", None) or self.stream
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return False
+
+    @contextmanager
+    def capture(self):
+        """ collect the output of the current thread """
+        buffer = io.StringIO()
+        self._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = None
+
+
+class JobStats():
+    """ the scheduling state and the metrics of a job
+
+    Attributes:
+        id: number of the job
+        command: the acload command
+        priority: priority class, see PRIORITIES
+        weight: share of the requests within the priority class
+        submitted, started, finished: perf_counter times of the job
+        requests: requests sent by the job
+        request_wait: seconds its requests waited for a free slot
+    """
+
+    def __init__(self, id: int, command: str, priority: str = "normal", weight: float = 1.0):
+        self.id = id
+        self.command = command
+        self.priority = priority
+        self.weight = weight
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.requests = 0
+        self.request_wait = 0.0
+        # virtual time of the next request, the number of waiting requests and since when the
+        # job waits for a slot, see FairScheduler
+        self.vtime = 0.0
+        self.waiting = 0
+        self.waiting_since = None
+
+    def metrics(self):
+        started = self.started or self.submitted
+        seconds = (self.finished or time.perf_counter()) - started
+        return {"priority": self.priority, "weight": self.weight,
+            "queue_wait": round(started - self.submitted, 3), "requests": self.requests,
+            "request_wait": round(self.request_wait, 3),
+            "requests_per_second": round(self.requests / seconds, 1) if seconds else 0.0}
+
+
+class FairScheduler():
+    """ shares max_requests concurrent requests between the jobs
+
+    A free slot goes to a waiting request of the job in the highest priority
+    class, and within the class to the job with the lowest virtual time: each
+    request moves the time of its job on by 1 / weight, so the jobs of a class
+    get slots in proportion to their weights however many requests they have
+    queued. A job that starts or was idle starts at the current virtual time
+    and gets no credit for the time it did not send.
+
+    A job that waits for a slot moves up one class every aging seconds until it
+    gets one, so the lower classes still get a share while the higher ones use
+    all the slots.
+
+    Attributes:
+        max_requests: concurrent requests of all jobs together
+        aging: seconds of waiting that move a job up one priority class
+        in_flight: requests being sent
+    """
+
+    def __init__(self, max_requests: int = 16, aging: float = REQUEST_AGING):
+        self.max_requests = max_requests
+        self.aging = aging
+        self.in_flight = 0
+        self._clock = 0.0
+        self._waiting = set()
+        self._changed = threading.Condition()
+
+    def _next(self):
+        now = time.perf_counter()
+        def key(job):
+            aged = int((now - job.waiting_since) / self.aging)
+            return (max(0, PRIORITIES[job.priority] - aged), job.vtime, job.id)
+        return min(self._waiting, key=key)
+
+    def acquire(self, job: JobStats):
+        """ wait for a slot for a request of the job """
+        start = time.perf_counter()
+        with self._changed:
+            if not job.waiting:
+                job.vtime = max(job.vtime, self._clock)
+                job.waiting_since = start
+            job.waiting += 1
+            self._waiting.add(job)
+            while self.in_flight >= self.max_requests or self._next() is not job:
+                # wake up to age the waiting jobs
+                self._changed.wait(self.aging)
+            job.waiting -= 1
+            if not job.waiting:
+                self._waiting.discard(job)
+            # the other requests of the job wait from now on
+            job.waiting_since = time.perf_counter()
+            self.in_flight += 1
+            self._clock = job.vtime
+            job.vtime += 1.0 / job.weight
+            job.requests += 1
+            job.request_wait += time.perf_counter() - start
+            # the next job in line may get a slot that is still free
+            self._changed.notify_all()
+
+    def release(self, job: JobStats):
+        with self._changed:
+            self.in_flight -= 1
+            self._changed.notify_all()
+
+
+class LimitedTransport():
+    """ transport that sends at most max_requests requests at the same time
+
+    The slots are shared between the jobs by a FairScheduler. A request belongs
+    to the job of the current ac_api client; the requests outside of the jobs
+    (warm up, catalog refresh) are scheduled as default_job.
+
+    Attributes:
+        inner: the transport that sends the requests
+        max_requests: concurrent requests of all jobs together
+        scheduler: the FairScheduler
+        default_job: the JobStats of the requests outside of the jobs
+    """
+
+    def __init__(self, inner, max_requests: int = 16):
+        self.inner = inner
+        self.max_requests = max_requests
+        self.scheduler = FairScheduler(max_requests)
+        self.default_job = JobStats(0, "daemon")
+
+    def request(self, method: str, url: str, data=None, headers=None):
+        import ac_api
+        job = getattr(ac_api.current_client(), "job", None) or self.default_job
+        self.scheduler.acquire(job)
+        try:
+            return self.inner.request(method, url, data=data, headers=headers)
+        finally:
+            self.scheduler.release(job)
+
+
+class Daemon():
+    """ Runs acload jobs in one warm process
+
+    Attributes:
+        max_jobs: jobs that run at the same time
+        max_requests: concurrent requests to AC of all jobs together
+        catalog: optional catalog file, passed to the load and validate jobs
+        refresh_interval: seconds between catalog refreshes, 0 to never refresh
+        job_aging: seconds of waiting that move a queued job up one priority class
+        jobs: number of jobs that were run
+        scheduler: the FairScheduler of the requests to AC
+    """
+
+    def __init__(self, max_jobs: int = 4, max_requests: int = 16, catalog: str = None,
+            refresh_interval: float = 0.0, job_aging: float = JOB_AGING):
+        # the imports are paid once, here
+        import ac_api
+        import acload
+        import loader
+        self.max_jobs = max_jobs
+        self.max_requests = max_requests
+        self.catalog = catalog
+        self.refresh_interval = refresh_interval
+        self.job_aging = job_aging
+        self.jobs = 0
+        # (rank, number, workbook, run, future) of the jobs waiting for a job thread, see _enqueue
+        self._queue = []
+        self._queued = threading.Condition()
+        # the workbooks of the running jobs
+        self._busy_workbooks = set()
+        self._submitted = 0
+        self._jobs_created = 0
+        self._closing = False
+        self._workers = [threading.Thread(target=self._work, name=f"job-{n}", daemon=True)
+            for n in range(max_jobs)]
+        for worker in self._workers:
+            worker.start()
+        self._workbook_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._servers = []
+        self._threads = []
+        self._transport = ac_api.transport
+        ac_api.set_transport(LimitedTransport(ac_api.transport or ac_api.SessionTransport(),
+            max_requests))
+        self.scheduler = ac_api.transport.scheduler
+        self._cache = ac_api.response_cache
+        if self._cache is None:
+            ac_api.enable_response_cache()
+        self._stdout = sys.stdout
+        self.output = _ThreadOutput(sys.stdout)
+        sys.stdout = self.output
+
+    def warm(self):
+        """ fetch the token, open the connections and cache the dimensions """
+        import ac_api
+        try:
+            dims = ac_api.load_dimensions()
+        except Exception as ex:
+            print(f"could not warm up: {ex}")
+            return
+        print(f"warm: {len(dims)} dimensions cached")
+
+    def _new_job(self, job: dict):
+        """ the JobStats of a job, None if its priority or weight is not valid """
+        with self._queued:
+            self._jobs_created += 1
+            number = self._jobs_created
+        priority = job.get("priority", "normal")
+        try:
+            weight = float(job.get("weight", 1.0))
+        except (TypeError, ValueError):
+            weight = 0.0
+        if priority not in PRIORITIES or weight <= 0:
+            return None
+        return JobStats(number, job.get("command"), priority, weight)
+
+    def _client(self, stats: JobStats):
+        """ a client with the settings of the daemon whose requests are scheduled as the job's """
+        import ac_api
+        default = ac_api.current_client()
+        default.configure()
+        client = ac_api.ACClient(default.base_url, default.token_url, default.client_id,
+            default.client_secret, default.transport, default.rate_limiter, default.response_cache)
+        client.job = stats
+        return client
+
+    def run(self, job: dict, stats: JobStats = None):
+        """ Run a job in the current thread
+
+        Args:
+            job - {"command": acload command, "args": [arguments], "priority": high, normal
+                or low, "weight": share of the requests}
+            stats - the JobStats of a queued job
+
+        Returns:
+            dict with the command, args, exit_code, output, seconds and metrics of the job
+        """
+        import ac_api
+        import acload
+        command = job.get("command")
+        args = [str(arg) for arg in job.get("args", [])]
+        if command not in COMMANDS:
+            return {"command": command, "args": args, "exit_code": 2, "seconds": 0.0,
+                "output": f"unknown command {command}, use one of {', '.join(sorted(COMMANDS))}\n"}
+        stats = stats or self._new_job(job)
+        if stats is None:
+            return {"command": command, "args": args, "exit_code": 2, "seconds": 0.0,
+                "output": f"invalid priority or weight, the priority is one of "
+                    f"{', '.join(PRIORITIES)} and the weight a positive number\n"}
+        if self.catalog and command in ("load", "validate") and "--catalog" not in args:
+            args += ["--catalog", self.catalog]
+        # the queue does not start two jobs on a workbook, the lock is for the direct calls
+        lock = nullcontext()
+        workbook = _workbook(job)
+        if workbook:
+            with self._lock:
+                lock = self._workbook_locks[workbook]
+        with lock, self.output.capture() as buffer, ac_api.use_client(self._client(stats)):
+            # waiting for the workbook counts as queue wait
+            stats.started = time.perf_counter()
+            try:
+                acload.cli.main([command, *args], prog_name="acload", standalone_mode=False)
+                exit_code = 0
+            except click.ClickException as ex:
+                buffer.write(f"Error: {ex.format_message()}\n")
+                exit_code = ex.exit_code
+            except SystemExit as ex:
+                exit_code = ex.code if isinstance(ex.code, int) else 1
+            except Exception:
+                traceback.print_exc(file=buffer)
+                exit_code = 1
+        stats.finished = time.perf_counter()
+        with self._lock:
+            self.jobs += 1
+        metrics = stats.metrics()
+        print(f"job {stats.id} {command} ({stats.priority}): exit code {exit_code} in "
+            f"{stats.finished - stats.started:.1f}s, queued {metrics['queue_wait']}s, "
+            f"{stats.requests} request(s) at {metrics['requests_per_second']}/s, "
+            f"waited {metrics['request_wait']}s for requests")
+        return {"command": command, "args": args, "exit_code": exit_code,
+            "output": buffer.getvalue(), "seconds": round(stats.finished - stats.started, 3),
+            "metrics": metrics}
+
+    def _enqueue(self, priority: str, run, workbook: str = None):
+        """ queue run() for a job thread
+
+        The queue is ordered by rank, the time the job was queued plus
+        job_aging seconds per priority class: a job that waited job_aging
+        seconds is ranked with the jobs of the next higher class queued now.
+        """
+        future = Future()
+        with self._queued:
+            if self._closing:
+                raise RuntimeError("the daemon is closed")
+            self._submitted += 1
+            rank = time.perf_counter() + \
+                PRIORITIES.get(priority, PRIORITIES["normal"]) * self.job_aging
+            heappush(self._queue, (rank, self._submitted, workbook, run, future))
+            self._queued.notify()
+        return future
+
+    def _next_job(self):
+        """ take the first queued job whose workbook is not in use, None if there is none """
+        for entry in sorted(self._queue):
+            if entry[2] not in self._busy_workbooks:
+                self._queue.remove(entry)
+                heapify(self._queue)
+                return entry
+        return None
+
+    def _work(self):
+        while True:
+            with self._queued:
+                entry = self._next_job()
+                while entry is None and (self._queue or not self._closing):
+                    self._queued.wait()
+                    entry = self._next_job()
+                if entry is None:
+                    return
+                _, _, workbook, run, future = entry
+                if workbook:
+                    self._busy_workbooks.add(workbook)
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(run())
+                except BaseException as ex:
+                    future.set_exception(ex)
+            finally:
+                if workbook:
+                    with self._queued:
+                        self._busy_workbooks.discard(workbook)
+                        # the jobs queued for the workbook can run now
+                        self._queued.notify_all()
+
+    def submit(self, job: dict):
+        """ queue a job, returns the future of its result """
+        stats = self._new_job(job)
+        return self._enqueue(job.get("priority", "normal"), lambda: self.run(job, stats),
+            _workbook(job))
+
+    def serve_socket(self, path: str = DEFAULT_SOCKET):
+        """ accept jobs on a unix socket, one json line per connection """
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    job = json.loads(self.rfile.readline())
+                except ValueError as ex:
+                    result = {"exit_code": 2, "output": f"invalid job: {ex}\n"}
+                else:
+                    result = daemon.submit(job).result()
+                self.wfile.write(json.dumps(result).encode() + b"\n")
+
+        if os.path.exists(path):
+            os.remove(path)
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        self._servers.append(server)
+        self._start(server.serve_forever, "socket")
+        return server
+
+    def _write_result(self, path: str, result: dict, suffix: str = ".done"):
+        """ write the result of the job file and rename it to <job>.done (or suffix) """
+        base = path[:path.rindex(".")]
+        with open(base + ".result.json.tmp", "w") as f:
+            json.dump(result, f, indent=1)
+        os.replace(base + ".result.json.tmp", base + ".result.json")
+        os.replace(path, base + suffix)
+
+    def _fail_file(self, path: str, ex: Exception):
+        """ log a job file that could not be handled and move it aside to <job>.failed """
+        print(f"job file {path} failed: {ex!r}")
+        try:
+            os.replace(path, path[:path.rindex(".")] + ".failed")
+        except OSError:
+            pass
+
+    def _run_file(self, path: str, job: dict, stats: JobStats):
+        running = path[:path.rindex(".")] + ".running"
+        try:
+            os.replace(path, running)
+            self._write_result(running, self.run(job, stats))
+        except Exception as ex:
+            self._fail_file(running, ex)
+
+    def _queue_file(self, path: str):
+        """ queue the job of a file, it is renamed to <job>.queued until it runs """
+        queued = path[:-len(".json")] + ".queued"
+        try:
+            os.replace(path, queued)
+        except FileNotFoundError:
+            # picked up by another daemon watching the folder
+            return
+        try:
+            with open(queued) as f:
+                job = json.load(f)
+            if not isinstance(job, dict):
+                raise ValueError("a job is a json object")
+        except ValueError as ex:
+            print(f"job file {path} is not a valid job: {ex}")
+            self._write_result(queued, {"exit_code": 2, "output": f"invalid job: {ex}\n"}, ".failed")
+            return
+        stats = self._new_job(job)
+        self._enqueue(job.get("priority", "normal"), lambda: self._run_file(queued, job, stats),
+            _workbook(job))
+
+    def watch(self, directory: str, interval: float = 1.0):
+        """ run the *.json jobs that are put into the directory
+
+        A file that can not be read or queued is logged and moved aside to
+        <job>.failed, the folder is polled on.
+        """
+        def poll():
+            while not self._stop.wait(interval):
+                try:
+                    names = sorted(os.listdir(directory))
+                except OSError as ex:
+                    print(f"could not read the job folder {directory}: {ex}")
+                    continue
+                for name in names:
+                    if name.endswith(".json") and not name.endswith(".result.json"):
+                        path = os.path.join(directory, name)
+                        try:
+                            self._queue_file(path)
+                        except Exception as ex:
+                            queued = path[:-len(".json")] + ".queued"
+                            self._fail_file(queued if os.path.exists(queued) else path, ex)
+
+        self._start(poll, "watch")
+
+    def refresh_catalog(self):
+        """ refresh the catalog every refresh_interval seconds """
+        from catalog import Catalog
+
+        def refresh():
+            while not self._stop.wait(self.refresh_interval):
+                try:
+                    with Catalog(self.catalog) as cat:
+                        counts = cat.refresh()
+                    print(f"catalog refreshed: {sum(counts.values())} object(s) read")
+                except Exception as ex:
+                    print(f"catalog refresh failed: {ex}")
+
+        if self.catalog and self.refresh_interval:
+            self._start(refresh, "refresh")
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def wait(self):
+        """ block until close() is called or the process is interrupted """
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def close(self):
+        """ stop accepting jobs, finish the running ones and restore the ac_api settings """
+        import ac_api
+        self._stop.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(server.server_address):
+                os.remove(server.server_address)
+        self._servers = []
+        with self._queued:
+            self._closing = True
+            self._queued.notify_all()
+        for worker in self._workers:
+            worker.join()
+        sys.stdout = self._stdout
+        ac_api.set_transport(self._transport)
+        if ac_api.response_cache is not None:
+            print(ac_api.response_cache.summary())
+        if self._cache is None:
+            ac_api.disable_response_cache()
+
+
+def submit(job: dict, path: str = DEFAULT_SOCKET):
+    """ send a job to the daemon and wait for the result """
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(job).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
@@ -0,0 +1,221 @@
+"""Differences between a workbook and the objects in AC
+
+For each sheet the rows of the workbook are read into an index by internal id,
+one entry per object with the compared fields. The collection is then read
+from AC page by page and each object is looked up in the index, so the
+differences are found in a single pass:
+
+    in the index with the same fields   -> in sync
+    in the index with other fields      -> different
+    not in the index                    -> orphaned (in AC, not in the workbook)
+    left in the index at the end        -> missing (in the workbook, not in AC)
+
+Only the compared fields are read from AC ($select) and one sheet is indexed at
+a time, so the memory is bounded by the largest sheet, not by the tenant. The
+references (the indicators of a group, the template of a model, ...) are
+compared by internal id through the id -> internal id maps of the collections
+read before; a reference to a sheet that is not in the workbook is not compared.
+
+"""
+
+# standard imports
+import json
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+# local imports
+from ac_api import read_pages, PAGE_SIZE
+from loader import group_rows
+from mapping import *
+from validation import normalize_code
+
+
+# sheet -> (collection, id field, {field: column}), the sheets that are referenced come first
+SHEETS = {
+    "Attribute": ("attributes", "id", {"description": ATT_DESCRIPTION,
+        "dataType": ATT_DATA_TYPE, "dimension1": ATT_DIMENSION, "attributeUom": ATT_UOM}),
+    "Attribute Group": ("attributegroups", "id", {"description": AG_DESCRIPTION}),
+    "Indicator": ("indicators", "id", {"description": IND_DESCRIPTION,
+        "dataType": IND_DATA_TYPE, "dimension1": IND_DIMENSION, "indicatorUom": IND_UOM,
+        "expectedBehaviour": IND_EXPECTED_BEHAVIOR, "indicatorColorCode": IND_COLOR}),
+    "Indicator Group": ("indicatorgroups", "id", {"description": IG_DESCRIPTION}),
+    "Model Template": ("templates", "id", {"description": TEM_DESCRIPTION}),
+    "Model": ("models", "modelId", {"description": MOD_DESCRIPTION,
+        "equipmentTracking": MOD_TRACKING, "organizationID": MOD_ORG}),
+    "Equipment": ("equipment", "equipmentId", {"description": EQU_DESCRIPTION,
+        "operatorID": EQU_OPERATOR, "lifeCycle": EQU_LIFECYCLE}),
+}
+
+# sheet -> [(field, column, referenced sheet)]
+REFERENCES = {
+    "Attribute Group": [("attributes", AG_ATTRIBUTE, "Attribute")],
+    "Indicator Group": [("indicators", IG_INDICATOR, "Indicator")],
+    "Model Template": [("indicatorGroups", TEM_INDICATOR_GROUP, "Indicator Group"),
+        ("attributeGroups", TEM_ATTRIBUTE_GROUP, "Attribute Group")],
+    "Model": [("templates", MOD_TEMPLATE, "Model Template")],
+    "Equipment": [("modelId", EQU_MODEL, "Model")],
+}
+
+# sheets with one row per member of an object
+GROUPED = {"Attribute Group", "Indicator Group", "Model Template"}
+
+KINDS = ("in sync", "missing", "different", "orphaned")
+
+
+class Difference(NamedTuple):
+    """ an object that is missing, different or orphaned
+
+    fields is {field: (workbook value, AC value)} of the fields that differ,
+    the workbook values of a missing object and empty for an orphaned one.
+    References are tuples of internal ids.
+    """
+    kind: str
+    sheet: str
+    internal_id: str
+    id: str
+    fields: Dict[str, tuple]
+
+    def describe(self):
+        if self.kind == "different":
+            changes = ", ".join(f"{field} {_show(ac)} in AC, {_show(workbook)} in the workbook"
+                for field, (workbook, ac) in self.fields.items())
+            return f"different {self.internal_id}: {changes}"
+        if self.kind == "orphaned":
+            return f"orphaned {self.internal_id} (id {self.id})"
+        return f"missing {self.internal_id}"
+
+    def change(self):
+        """ the change that makes AC match the workbook, as json """
+        change = {"action": {"missing": "insert", "different": "update", "orphaned": "delete"}[self.kind],
+            "sheet": self.sheet, "internalId": self.internal_id}
+        if self.id:
+            change["id"] = self.id
+        if self.kind != "orphaned":
+            change["values"] = {field: list(workbook) if isinstance(workbook, tuple) else workbook
+                for field, (workbook, _) in self.fields.items()}
+        return change
+
+
+def _show(value):
+    return "[" + ", ".join(value) + "]" if isinstance(value, tuple) else repr(value)
+
+
+def _fields(sheet: str, sheetnames) -> Tuple[List[str], list]:
+    """ the compared fields and the references of a sheet """
+    references = [ref for ref in REFERENCES.get(sheet, []) if ref[2] in sheetnames]
+    return list(SHEETS[sheet][2]) + [field for field, _, _ in references], references
+
+
+def read_sheet(wb, sheet: str) -> Dict[str, Tuple[str, tuple]]:
+    """ Indexes the objects of a sheet
+
+    Returns:
+        {internal id: (id, values of the compared fields)}, the first row of an
+        internal id that is repeated wins
+    """
+    columns = SHEETS[sheet][2]
+    _, references = _fields(sheet, wb.sheetnames)
+    ws = wb[sheet]
+    index = {}
+    if sheet in GROUPED:
+        # the description comes from the first grouping, the members of each reference are compared
+        # when the referenced sheet is in the workbook
+        groups = [(group_rows(ws, ID, INTERNAL_ID, columns["description"], ref[1]), ref in references)
+            for ref in REFERENCES[sheet]]
+        for internal_id, (id, description, _) in groups[0][0].items():
+            members = tuple(tuple(sorted(normalize_code(m) for m in group[internal_id][2]))
+                for group, compared in groups if compared)
+            index[normalize_code(internal_id)] = (normalize_code(id),
+                (normalize_code(description),) + members)
+        return index
+    width = max(list(columns.values()) + [column for _, column, _ in references]) + 1
+    for row in ws.iter_rows(min_row=2, max_col=width, values_only=True):
+        row = row + (None,) * (width - len(row))
+        internal_id = normalize_code(row[INTERNAL_ID])
+        if not internal_id or internal_id in index:
+            continue
+        values = tuple(normalize_code(row[column]) for column in columns.values())
+        values += tuple(((normalize_code(row[column]),) if normalize_code(row[column]) else ())
+            for _, column, _ in references)
+        index[internal_id] = (normalize_code(row[ID]), values)
+    return index
+
+
+def _remote_values(obj: dict, sheet: str, references: list, internal_ids: Dict[str, dict]) -> tuple:
+    """ the compared fields of an object read from AC, the references as internal ids """
+    values = []
+    for field in SHEETS[sheet][2]:
+        value = obj.get(field)
+        # description is {"short": ...} except for the models
+        if isinstance(value, dict):
+            value = value.get("short")
+        values.append(normalize_code(value))
+    for field, _, parent in references:
+        refs = obj.get(field) or []
+        if not isinstance(refs, list):
+            refs = [refs]
+        ids = [ref.get("id") if isinstance(ref, dict) else ref for ref in refs]
+        known = internal_ids.get(parent, {})
+        values.append(tuple(sorted(known.get(id, id) for id in ids if id)))
+    return tuple(values)
+
+
+def diff_workbook(wb, page_size: int = PAGE_SIZE, counts: Dict[str, Counter] = None) \
+        -> Iterator[Difference]:
+    """ Compares the sheets of a workbook with the objects in AC
+
+    Args:
+        wb - the workbook
+        page_size - objects per request
+        counts - optional dict that is filled with a Counter of the KINDS per sheet
+
+    Yields:
+        the Differences, sheet by sheet in the order of SHEETS
+    """
+    if counts is None:
+        counts = {}
+    parents = {parent for refs in REFERENCES.values() for _, _, parent in refs}
+    # sheet -> {AC id: internal id} of the referenced sheets read so far
+    internal_ids = {}
+    for sheet, (collection, id_field, _) in SHEETS.items():
+        if sheet not in wb.sheetnames:
+            continue
+        fields, references = _fields(sheet, wb.sheetnames)
+        count = counts[sheet] = Counter({kind: 0 for kind in KINDS})
+        index = read_sheet(wb, sheet)
+        ids = internal_ids[sheet] = {} if sheet in parents else None
+        for page in read_pages("/" + collection, page_size=page_size, fields=[id_field] + fields):
+            for obj in page:
+                internal_id = normalize_code(obj.get("internalId"))
+                id = obj.get(id_field) or ""
+                if ids is not None:
+                    ids[id] = internal_id
+                entry = index.pop(internal_id, None)
+                if entry is None:
+                    count["orphaned"] += 1
+                    yield Difference("orphaned", sheet, internal_id, id, {})
+                    continue
+                row_id, values = entry
+                remote = _remote_values(obj, sheet, references, internal_ids)
+                changed = {field: (workbook, ac) for field, workbook, ac in zip(fields, values, remote)
+                    if workbook != ac}
+                if row_id != id:
+                    changed["id"] = (row_id, id)
+                if changed:
+                    count["different"] += 1
+                    yield Difference("different", sheet, internal_id, id, changed)
+                else:
+                    count["in sync"] += 1
+        # what is left was not found in AC
+        for internal_id, (row_id, values) in index.items():
+            count["missing"] += 1
+            yield Difference("missing", sheet, internal_id, row_id,
+                {field: (value, None) for field, value in zip(fields, values)})
+
+
+def write_changes(differences: Iterator[Difference], path: str) -> Iterator[Difference]:
+    """ Writes the change of each difference to a json lines file as they pass through """
+    with open(path, "w") as f:
+        for difference in differences:
+            f.write(json.dumps(difference.change()) + "\n")
+            yield difference
@@ -0,0 +1,258 @@
+"""Streams indicator readings from CSV or Parquet files into AC
+
+The file has the columns equipment, indicator, timestamp and value, with the
+internal ids of the equipment and the indicators. It is read in chunks so
+that files of any size stream through in constant memory:
+
+    reader -> resolve the ids -> micro-batches -> bounded queue -> posting workers
+
+The ids are resolved through indexes that are filled from the catalog (if
+given) and from AC for the internal ids that are not known yet, so each id is
+looked up once per run. The queue between the reader and the workers is
+bounded: when AC is slower than the file, the reader waits instead of
+buffering the file in memory. A batch that fails is retried with a backoff;
+the readings that cannot be resolved or posted are written to the rejects file.
+
+Parquet files need pyarrow (pip install .[parquet]).
+
+"""
+
+# standard imports
+import csv
+import math
+import queue
+import threading
+import time
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List
+
+# local imports
+from ac_api import Equipment, Indicator, bind_client, post_readings
+from profiling import stage
+
+
+COLUMNS = ("equipment", "indicator", "timestamp", "value")
+
+# rows read from the file at a time
+CHUNK_SIZE = 50000
+
+# readings per request
+BATCH_SIZE = 1000
+
+# attempts of a batch before its readings are rejected
+MAX_RETRIES = 3
+
+ACCEPTED = (200, 201, 202, 204)
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE,
+        malformed: Callable[[List[tuple]], None] = None) -> Iterator[List[tuple]]:
+    """ Reads the readings of a CSV or Parquet file in chunks
+
+    Args:
+        malformed - optional callback with the CSV rows that are shorter than the header
+
+    Yields:
+        lists of (equipment, indicator, timestamp, value) tuples
+    """
+    if path.endswith(".parquet"):
+        yield from _parquet_chunks(path, chunk_size)
+        return
+    with open(path, newline="") as f:
+        rows = csv.reader(f)
+        header = [name.strip().lower() for name in next(rows, [])]
+        missing = [name for name in COLUMNS if name not in header]
+        if missing:
+            raise ValueError(f"{path} has no column {', '.join(missing)}")
+        columns = [header.index(name) for name in COLUMNS]
+        width = max(columns) + 1
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                return
+            # blank rows are skipped, a block of them does not end the file
+            chunk = [tuple(row[column] for column in columns)
+                for row in batch if len(row) >= width]
+            short = [tuple(row) for row in batch if row and len(row) < width]
+            if short and malformed:
+                malformed(short)
+            if chunk:
+                yield chunk
+
+def _parquet_chunks(path: str, chunk_size: int):
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=list(COLUMNS)):
+        yield list(zip(*(batch.column(name).to_pylist() for name in COLUMNS)))
+
+def _value(value):
+    """ numbers are sent as numbers, CSV gives strings """
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        # nan and inf are not valid json
+        return number if math.isfinite(number) else value
+    return value
+
+def _timestamp(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+class IdIndex():
+    """ internal id -> AC id of the equipment or indicators, filled on demand
+
+    Attributes:
+        cls: Equipment or Indicator
+        id_field: the id field of the class
+        lookups: number of internal ids looked up in AC
+    """
+
+    def __init__(self, cls, id_field: str, known: Dict[str, str] = None):
+        self.cls = cls
+        self.id_field = id_field
+        self.lookups = 0
+        self._ids = dict(known or {})
+
+    def resolve(self, internal_ids: Iterable[str]) -> Dict[str, str]:
+        """ the ids of the internal ids, "" for the ones that are not in AC """
+        missing = set(internal_ids) - self._ids.keys()
+        if missing:
+            self.lookups += len(missing)
+            loaded = self.cls.load_many(missing, fields=[self.id_field, "internalId"])
+            for internal_id in missing:
+                obj = loaded.get(internal_id)
+                # unknown ids are kept too so they are not looked up again
+                self._ids[internal_id] = getattr(obj, self.id_field) if obj else ""
+        return self._ids
+
+
+class IngestStats():
+    """ Counters of an ingest run """
+
+    def __init__(self):
+        self.read = 0
+        self.posted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+        self.requests = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    @property
+    def rate(self):
+        """ readings posted per second """
+        return self.posted / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        return (f"{self.read} reading(s) read, {self.posted} posted, {self.skipped} skipped, "
+            f"{self.failed} failed in {self.seconds:.1f}s ({self.rate:.0f}/s, "
+            f"{self.requests} request(s), {self.retries} retried)")
+
+
+def ingest(path: str, batch_size: int = BATCH_SIZE, workers: int = 8,
+        chunk_size: int = CHUNK_SIZE, max_retries: int = MAX_RETRIES, catalog=None,
+        rejects: str = None) -> IngestStats:
+    """ Posts the readings of a file to AC
+
+    Args:
+        path - CSV or Parquet file with the readings
+        batch_size - readings per request
+        workers - number of concurrent requests
+        chunk_size - rows read from the file at a time
+        max_retries - attempts of a failed batch
+        catalog - optional Catalog with the ids of the equipment and indicators
+        rejects - optional CSV file for the readings that were not posted
+
+    Returns:
+        the IngestStats of the run
+    """
+    stats = IngestStats()
+    start = time.perf_counter()
+    equipment = IdIndex(Equipment, "equipmentId", catalog.ids("equipment") if catalog else None)
+    indicators = IdIndex(Indicator, "id", catalog.ids("indicators") if catalog else None)
+    # twice the workers, so each worker has the next batch ready
+    batches = queue.Queue(maxsize=workers * 2)
+    rejects_lock = threading.Lock()
+    rejects_file = open(rejects, "w", newline="") if rejects else None
+    rejects_writer = csv.writer(rejects_file) if rejects_file else None
+    if rejects_writer:
+        rejects_writer.writerow(COLUMNS + ("reason",))
+
+    def reject(rows, reason):
+        if rejects_writer:
+            with rejects_lock:
+                rejects_writer.writerows(row + (reason,) for row in rows)
+
+    def post(batch):
+        readings = [reading for _, reading in batch]
+        reason = ""
+        for attempt in range(max_retries):
+            if attempt:
+                stats.add(retries=1)
+                time.sleep(min(10.0, 0.5 * 2 ** (attempt - 1)))
+            try:
+                status = post_readings(readings)
+            except Exception as ex:
+                reason = str(ex)
+            else:
+                stats.add(requests=1)
+                if status in ACCEPTED:
+                    stats.add(posted=len(batch))
+                    return
+                reason = f"status {status}"
+        stats.add(failed=len(batch))
+        print(f"batch of {len(batch)} reading(s) failed...error: {reason}")
+        reject([row for row, _ in batch], reason)
+
+    def malformed(rows):
+        stats.add(read=len(rows), skipped=len(rows))
+        reject(rows, "malformed row")
+
+    def worker():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            post(batch)
+
+    threads = [threading.Thread(target=bind_client(worker), daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in read_chunks(path, chunk_size, malformed):
+            with stage("resolve readings"):
+                equipment_ids = equipment.resolve({row[0] for row in chunk})
+                indicator_ids = indicators.resolve({row[1] for row in chunk})
+                readings = []
+                unresolved = []
+                for row in chunk:
+                    equipment_id = equipment_ids.get(row[0])
+                    indicator_id = indicator_ids.get(row[1])
+                    if not equipment_id or not indicator_id:
+                        unresolved.append(row)
+                        continue
+                    readings.append((row, {"equipmentId": equipment_id,
+                        "indicatorId": indicator_id, "timestamp": _timestamp(row[2]),
+                        "value": _value(row[3])}))
+            for index in range(0, len(readings), batch_size):
+                # waits while the workers are behind
+                batches.put(readings[index:index + batch_size])
+            stats.add(read=len(chunk), skipped=len(unresolved))
+            reject(unresolved, "unknown equipment or indicator")
+            print(f"{stats.read} reading(s) read, {stats.posted} posted")
+    finally:
+        for _ in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+        if rejects_file:
+            rejects_file.close()
+        stats.seconds = time.perf_counter() - start
+    return stats
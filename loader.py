@@ -0,0 +1,753 @@
+"""Stages of the acload commands: reading the sheets, resolving the references,
+inserting the objects into AC and writing the ids back into the xlsx file
+
+"""
+
+# standard imports
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, List
+
+# third party imports
+from openpyxl import load_workbook
+
+# local imports
+from ac_api import Attribute, AttributeGroup, AttributeValue, Description, Indicator, \
+    IndicatorGroup, IdString, Template, Model, PrimaryTemplate, Equipment, VALUE_BATCH_SIZE, \
+    bind_client
+from catalog import Catalog
+from mapping import *
+from profiling import stage
+from quarantine import Quarantine
+from xlsx_patch import IdWriter
+
+
+def delete_rows(ids: IdWriter, wb, sheet: str, create, deleted_status: int):
+    """ Deletes the objects of the rows with an id and clears the ids in the file
+
+    Args:
+        ids - writer for the cleared ids
+        wb - the workbook
+        sheet - name of the sheet
+        create - creates the object to delete from its id
+        deleted_status - status code of a successful delete
+    """
+    cleared = {}
+    # id -> deleted, the rows of an indicator group or template share the id
+    deleted = {}
+    for row_number, row in enumerate(wb[sheet].iter_rows(min_row=2, values_only=True), start=2):
+        if not row[ID]:
+            continue
+        if row[ID] not in deleted:
+            status = create(row[ID]).delete()
+            deleted[row[ID]] = status == deleted_status
+            if deleted[row[ID]]:
+                print(f"Deleted {row[INTERNAL_ID]}")
+            else:
+                print(f"Could not delete {row[ID]}")
+        if deleted[row[ID]]:
+            cleared[row_number] = ""
+    ids.add(sheet, cleared)
+    ids.flush()
+
+
+def group_rows(sheet, id_column: int, internal_id_column: int, description_column: int,
+        member_column: int):
+    """ Groups the rows of a one-row-per-member sheet (indicator groups and templates)
+
+    The rows of an object do not have to be next to each other, they are
+    collected by internal id in one pass. A member listed more than once is
+    kept once and empty members are left out; the description is taken from
+    the first row and the id from the first row that has one.
+
+    Returns:
+        {internal id: (id, description, [members])} in the order of the first rows
+    """
+    groups = {}
+    width = max(id_column, internal_id_column, description_column, member_column) + 1
+    for row in sheet.iter_rows(min_row=2, max_col=width, values_only=True):
+        internal_id = row[internal_id_column]
+        if internal_id is None:
+            continue
+        group = groups.get(internal_id)
+        if group is None:
+            # the members are dict keys to keep their order and drop the repeats
+            group = groups[internal_id] = [row[id_column] or "", row[description_column], {}]
+        elif not group[0] and row[id_column]:
+            group[0] = row[id_column]
+        if row[member_column] is not None and row[member_column] != "":
+            group[2][row[member_column]] = None
+    return {internal_id: (id, desc, list(members))
+        for internal_id, (id, desc, members) in groups.items()}
+
+
+def load_attributes(attribute_sheet, quarantine: Quarantine = None):
+    """ Loads all of the attributes into AC
+
+    Args:
+        attribute_sheet - worksheet containing the required datafields
+        quarantine - collects the attributes that could not be loaded
+
+    Returns:
+        List of attributes that were loaded
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+
+    attributes = []
+    for row in attribute_sheet.iter_rows(min_row=2, max_col=ATT_UOM + 1, values_only=True):
+        attributes.append(Attribute(internalId=row[ATT_INTERNAL_ID],
+            description=Description(row[ATT_DESCRIPTION]),
+            dataType=row[ATT_DATA_TYPE],
+            dimension1=row[ATT_DIMENSION] or "",
+            attributeUom=row[ATT_UOM] or "",
+            id=row[ATT_ID] or ""))
+
+    # insert into AC
+    for attribute in attributes:
+        if attribute.id:
+            print(f"attribute {attribute.internalId} already loaded...id = {attribute.id}")
+            continue
+        print(f"inserting attribute {attribute.internalId}...")
+        try:
+            attribute.insert()
+        except Exception as ex:
+            print(f"failed...error: {ex}")
+            quarantine.fail("Attribute", attribute.internalId, ex)
+        else:
+            print(f"success...id = {attribute.id}")
+
+    return attributes
+
+def load_attribute_groups(attributes: List[Attribute], ag_sheet, quarantine: Quarantine = None):
+    """ Loads all of the attribute groups into AC
+
+    Args:
+        attributes - list of attributes that were loaded
+        ag_sheet - worksheet with one row per attribute of a group
+        quarantine - collects the attribute groups that could not be loaded
+
+    Returns:
+        List of attribute groups that were loaded
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+
+    attribute_groups = [AttributeGroup(id=ag_id, internalId=internal_id,
+            description=Description(desc), attributes=members)
+        for internal_id, (ag_id, desc, members) in
+            group_rows(ag_sheet, AG_ID, AG_INTERNAL_ID, AG_DESCRIPTION, AG_ATTRIBUTE).items()]
+
+    with stage("resolve attribute groups"):
+        ids = {attribute.internalId: attribute.id for attribute in attributes}
+        for attribute_group in attribute_groups:
+            # skip the groups with attributes that could not be loaded
+            if quarantine.skip_dependent("Attribute Group", attribute_group.internalId,
+                    attribute_group.attributes):
+                continue
+            attribute_group.attributes = [ids.get(temp_id, temp_id)
+                for temp_id in attribute_group.attributes]
+
+    # insert into AC
+    for attribute_group in attribute_groups:
+        if quarantine.is_quarantined("Attribute Group", attribute_group.internalId):
+            print(f"skipping attribute group {attribute_group.internalId}...")
+            continue
+        if attribute_group.id:
+            print(f"attribute group {attribute_group.internalId} already loaded...id = {attribute_group.id}")
+            continue
+        print(f"inserting attribute group {attribute_group.internalId}...")
+        try:
+            attribute_group.insert()
+        except Exception as ex:
+            print(f"failed...error: {ex}")
+            quarantine.fail("Attribute Group", attribute_group.internalId, ex)
+        else:
+            print(f"success...id = {attribute_group.id}")
+
+    return attribute_groups
+
+def load_indicators(indicator_sheet, quarantine: Quarantine = None):
+    """ Loads all of the indicators into AC
+
+    Args:
+        indicator_sheet - worksheet containing the required datafields
+        quarantine - collects the indicators that could not be loaded
+
+    Returns:
+        List of indicators that were loaded
+
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+    indicators = []
+
+    # open the indicator sheet and load the objects
+    for row in indicator_sheet.iter_rows(min_row=2, values_only=True):
+        indicator = Indicator(internalId=row[IND_INTERNAL_ID],
+                                description=Description(row[IND_DESCRIPTION]),
+                                dataType=row[IND_DATA_TYPE],
+                                dimension1=row[IND_DIMENSION],
+                                indicatorUom=row[IND_UOM],
+                                expectedBehaviour=str(row[IND_EXPECTED_BEHAVIOR]),
+                                indicatorColorCode=row[IND_COLOR],
+                                id=row[IND_ID] or "")
+
+        indicators.append(indicator)
+
+    # insert into AC
+    for indicator in indicators:
+        # rows with an id were loaded before
+        if indicator.id:
+            print(f"indicator {indicator.internalId} already loaded...id = {indicator.id}")
+            continue
+        print(f"inserting indicator {indicator.internalId}...")
+        try:
+            indicator.insert()
+        except Exception as ex:
+            print(f"failed...error:{ex}")
+            quarantine.fail("Indicator", indicator.internalId, ex)
+        else:
+            print(f"sucess...id = {indicator.id}")
+
+    return indicators
+
+def load_indicator_groups(indicators: List[Indicator], ig_sheet, quarantine: Quarantine = None):
+    """ Loads all of the indicator groups into AC
+
+    Args:
+        indicators - list of indicators that were loaded
+        ig_sheet - worksheet containing the required datafields
+        quarantine - collects the indicator groups that could not be loaded
+
+
+    Returns:
+        List of indicator groups that were loaded
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+
+    indicator_groups = [IndicatorGroup(id=ig_id, internalId=internal_id,
+            description=Description(desc), indicators=members)
+        for internal_id, (ig_id, desc, members) in
+            group_rows(ig_sheet, IG_ID, IG_INTERNAL_ID, IG_DESCRIPTION, IG_INDICATOR).items()]
+
+    # get the ids for each indicator in each indicator group
+    with stage("resolve indicator groups"):
+        ids = {ind.internalId: ind.id for ind in indicators}
+        for indicator_group in indicator_groups:
+            # skip the groups with indicators that could not be loaded
+            if quarantine.skip_dependent("Indicator Group", indicator_group.internalId,
+                    indicator_group.indicators):
+                continue
+            indicator_group.indicators = [ids.get(temp_id, temp_id)
+                for temp_id in indicator_group.indicators]
+
+    # insert into AC
+    for indicator_group in indicator_groups:
+        if quarantine.is_quarantined("Indicator Group", indicator_group.internalId):
+            print(f"skipping indicator group {indicator_group.internalId}...")
+            continue
+        if indicator_group.id:
+            print(f"indicator group {indicator_group.internalId} already loaded...id = {indicator_group.id}")
+            continue
+        print(f"inserting indicator group {indicator_group.internalId}...")
+        try:
+            indicator_group.insert()
+        except Exception as ex:
+            print(f"failed...error: {ex}")
+            quarantine.fail("Indicator Group", indicator_group.internalId, ex)
+        else:
+            print(f"success...id = {indicator_group.id}")
+
+    return indicator_groups
+
+def load_templates(indicator_groups, template_sheet, quarantine: Quarantine = None,
+        attribute_groups: List[AttributeGroup] = None):
+    """ Loads all of the templates into AC
+
+    Supports model templates only.
+
+    Args:
+        indicator_groups - list of indicator groups that were loaded
+        template_sheet - worksheet that contains required datafields
+        quarantine - collects the templates that could not be loaded
+        attribute_groups - list of attribute groups that were loaded, the
+            optional column E of the sheet references them
+
+    Returns:
+        list of the templates that were loaded
+
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+
+    templates = [Template(id=template_id, internalId=internal_id,
+            description=Description(desc), indicatorGroups=members)
+        for internal_id, (template_id, desc, members) in
+            group_rows(template_sheet, TEM_ID, TEM_INTERNAL_ID, TEM_DESCRIPTION,
+                TEM_INDICATOR_GROUP).items()]
+    template_attribute_groups = {internal_id: members for internal_id, (_, _, members) in
+        group_rows(template_sheet, TEM_ID, TEM_INTERNAL_ID, TEM_DESCRIPTION,
+            TEM_ATTRIBUTE_GROUP).items()}
+
+    # get the ids for each indicator group and attribute group in each template
+    with stage("resolve templates"):
+        ids = {ig.internalId: ig.id for ig in indicator_groups}
+        ag_ids = {ag.internalId: ag.id for ag in attribute_groups or []}
+        for template in templates:
+            members = template_attribute_groups.get(template.internalId, [])
+            # skip the templates with indicator or attribute groups that could not be loaded
+            if quarantine.skip_dependent("Model Template", template.internalId,
+                    template.indicatorGroups) or \
+                    quarantine.skip_dependent("Model Template", template.internalId, members,
+                        "Attribute Group"):
+                continue
+            unresolved = [temp_id for temp_id in members if not ag_ids.get(temp_id)]
+            if unresolved and not template.id:
+                quarantine.fail("Model Template", template.internalId,
+                    f"attribute group {unresolved[0]} was not loaded")
+                continue
+            template.indicatorGroups = [IdString(ids[temp_id]) if temp_id in ids else temp_id
+                for temp_id in template.indicatorGroups]
+            template.attributeGroups = [IdString(ag_ids[temp_id]) for temp_id in members]
+
+    # insert into AC
+    for template in templates:
+        if quarantine.is_quarantined("Model Template", template.internalId):
+            print(f"skipping template {template.internalId}...")
+            continue
+        if template.id:
+            print(f"template {template.internalId} already loaded...id = {template.id}")
+            continue
+        print(f"inserting template {template.internalId}...")
+        try:
+            template.insert()
+        except Exception as ex:
+            print(f"failed...error: {ex}")
+            quarantine.fail("Model Template", template.internalId, ex)
+        else:
+            print(f"success...id = {template.id}")
+
+    return templates
+
+def read_models(model_sheet):
+    """ Creates the models from the worksheet
+
+    The templates field holds the internal id of the template until it is
+    resolved with resolve_model_templates.
+
+    Args:
+        model_sheet - worksheet that contains required datafields
+
+    Returns:
+        list of models
+    """
+    models = []
+    for row in model_sheet.iter_rows(min_row=2, values_only=True):
+       # create model and add to list
+       models.append(Model(internalId=row[MOD_INTERNAL_ID],
+            description=row[MOD_DESCRIPTION],
+            templates=row[MOD_TEMPLATE],
+            equipmentTracking=row[MOD_TRACKING],
+            organizationID=row[MOD_ORG],
+            modelId=row[MOD_ID] or ""))
+    return models
+
+def resolve_model_templates(models, templates, quarantine: Quarantine):
+    """ Replaces the template internal ids in the models with the AC ids """
+    with stage("resolve models"):
+        for model in models:
+            # skip the models with a template that could not be loaded
+            if quarantine.skip_dependent("Model", model.internalId, [model.templates]):
+                continue
+            for template in templates:
+                # get the real id from the indicator group list and replace the temp_id
+                if model.templates == template.internalId:
+                    model.templates = [PrimaryTemplate(template.id)]
+                    break
+
+def insert_model(model: Model, quarantine: Quarantine):
+    """ Inserts a single model, returns True if it was inserted """
+    print(f"inserting model {model.internalId}...")
+    try:
+        model.insert()
+    except Exception as ex:
+        print(f"failed...error: {ex}")
+        quarantine.fail("Model", model.internalId, ex)
+        return False
+    print(f"success...id = {model.modelId}")
+    return True
+
+def publish_model(model: Model, quarantine: Quarantine):
+    """ Publishes a single inserted model, returns True if it was published """
+    print(f"publishing model {model.internalId}...")
+    try:
+        model.publish()
+    except Exception as ex:
+        print(f"failed...error: {ex}")
+        quarantine.fail("Model", model.internalId,
+            f"inserted as {model.modelId} but not published, publish it before retrying: {ex}")
+        return False
+    print(f"published {model.internalId}")
+    return True
+
+
+def _equipment(row):
+    return Equipment(internalId=row[EQU_INTERNAL_ID],
+        description=Description(row[EQU_DESCRIPTION]),
+        modelId=row[EQU_MODEL],
+        operatorID=row[EQU_OPERATOR],
+        lifeCycle=row[EQU_LIFECYCLE],
+        equipmentId=row[EQU_ID] or "")
+
+def read_equipment_ids(equipment_sheet) -> Dict[str, str]:
+    """ {internal id: equipment id} of the rows of the worksheet that have an id
+
+    The rows are streamed, no equipment is created.
+    """
+    return {row[EQU_INTERNAL_ID]: row[EQU_ID] for row in equipment_sheet.iter_rows(min_row=2,
+        max_col=max(EQU_ID, EQU_INTERNAL_ID) + 1, values_only=True) if row[EQU_ID]}
+
+def model_index(models):
+    """ {internal id: model}, the first model of an internal id wins """
+    return {model.internalId: model for model in reversed(models)}
+
+def resolve_equipment_model(equipment: Equipment, index, quarantine: Quarantine):
+    """ Replaces the model internal id of one equipment with the AC id from a model_index """
+    # skip the equipment of models that could not be loaded
+    if quarantine.skip_dependent("Equipment", equipment.internalId, [equipment.modelId]):
+        return
+    model = index.get(equipment.modelId)
+    if model is not None:
+        equipment.modelId = model.modelId
+
+def insert_equipment(equipment: Equipment, quarantine: Quarantine):
+    """ Inserts a single equipment unless it is quarantined or already loaded """
+    if quarantine.is_quarantined("Equipment", equipment.internalId):
+        print(f"skipping {equipment.internalId}...")
+        return
+    if equipment.equipmentId:
+        print(f"{equipment.internalId} already loaded...id = {equipment.equipmentId}")
+        return
+    print(f"inserting {equipment.internalId}...")
+    try:
+        equipment.insert()
+    except Exception as ex:
+        print(f"failed...error: {ex}")
+        quarantine.fail("Equipment", equipment.internalId, ex)
+    else:
+        print(f"success...id = {equipment.equipmentId}")
+
+# marks the end of the rows in the queues of stream_equipment
+_DONE = None
+
+def stream_equipment(equipment_sheet, resolve, quarantine: Quarantine, ids: IdWriter = None,
+        workers: int = 8):
+    """ Inserts the equipment of a sheet as a pipeline with bounded queues
+
+        read row -> resolve the model -> insert (workers threads) -> write the id
+
+    The rows are read one at a time and each queue holds at most 2 x workers
+    equipment, so reading waits for the inserts and the memory does not grow
+    with the sheet. The ids of the inserted equipment are added to ids by a
+    single thread as they come in; the IdWriter patches them into the file
+    when it is flushed and at its checkpoints, in the background.
+
+    Args:
+        equipment_sheet - worksheet that contains the equipment
+        resolve - called with each equipment to resolve its model, it may wait
+            until the model is loaded
+        quarantine - collects the equipment that could not be loaded
+        ids - writer for the ids, None to keep the equipment instead
+        workers - number of concurrent inserts
+
+    Returns:
+        the equipment in the order of the sheet, an empty list when the ids
+        are written to ids
+    """
+    rows = queue.Queue(maxsize=2 * workers)
+    inserted = queue.Queue(maxsize=2 * workers)
+    kept = []
+    errors = []
+
+    def insert():
+        try:
+            while True:
+                item = rows.get()
+                if item is _DONE:
+                    return
+                if not errors:
+                    insert_equipment(item[1], quarantine)
+                inserted.put(item)
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            inserted.put(_DONE)
+
+    def sink():
+        running = workers
+        while running:
+            item = inserted.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            row_number, equipment, loaded = item
+            if errors:
+                # keep draining so that the inserts do not block
+                continue
+            try:
+                if ids is None:
+                    kept.append((row_number, equipment))
+                elif equipment.equipmentId and not loaded:
+                    ids.add(equipment_sheet.title, {row_number: equipment.equipmentId})
+            except BaseException as ex:
+                errors.append(ex)
+
+    threads = [threading.Thread(target=bind_client(insert), daemon=True) for _ in range(workers)]
+    threads.append(threading.Thread(target=bind_client(sink), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        for row_number, row in enumerate(equipment_sheet.iter_rows(min_row=2, values_only=True), start=2):
+            if errors:
+                break
+            equipment = _equipment(row)
+            loaded = bool(equipment.equipmentId)
+            resolve(equipment)
+            rows.put((row_number, equipment, loaded))
+    except BaseException as ex:
+        errors.append(ex)
+    finally:
+        for _ in range(workers):
+            rows.put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    kept.sort(key=lambda item: item[0])
+    return [equipment for _, equipment in kept]
+
+
+def load_attribute_values(equipment_ids: Dict[str, str], attribute_groups: List[AttributeGroup],
+        attributes: List[Attribute], value_sheet, quarantine: Quarantine = None,
+        batch_size: int = VALUE_BATCH_SIZE, workers: int = 8):
+    """ Writes the attribute values of the equipment with bulk requests
+
+    The values of all equipment are sent together, batch_size values per
+    request, instead of one request per equipment and attribute. The values of
+    equipment that was not loaded are skipped.
+
+    Args:
+        equipment_ids - {internal id: equipment id} of the equipment that was loaded,
+            see read_equipment_ids
+        attribute_groups - the attribute groups that were loaded
+        attributes - the attributes that were loaded
+        value_sheet - worksheet with one row per equipment, attribute group and attribute
+        quarantine - the objects that could not be loaded
+        batch_size - values per request
+        workers - number of concurrent requests
+
+    Returns:
+        number of values written and the number that could not be written
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+    group_ids = {ag.internalId: ag.id for ag in attribute_groups}
+    attribute_ids = {attribute.internalId: attribute.id for attribute in attributes}
+
+    values = []
+    skipped = 0
+    with stage("resolve attribute values"):
+        for row in value_sheet.iter_rows(min_row=2, max_col=VAL_VALUE + 1, values_only=True):
+            if not row[VAL_EQUIPMENT]:
+                continue
+            value = AttributeValue(equipmentId=equipment_ids.get(row[VAL_EQUIPMENT], ""),
+                attributeGroupId=group_ids.get(row[VAL_ATTRIBUTE_GROUP], ""),
+                attributeId=attribute_ids.get(row[VAL_ATTRIBUTE], ""),
+                value="" if row[VAL_VALUE] is None else str(row[VAL_VALUE]))
+            if quarantine.is_quarantined("Equipment", row[VAL_EQUIPMENT]) or \
+                    not (value.equipmentId and value.attributeGroupId and value.attributeId):
+                skipped += 1
+                continue
+            values.append(value)
+    if skipped:
+        print(f"skipping {skipped} value(s) of equipment, attribute groups or attributes that were not loaded")
+
+    print(f"writing {len(values)} attribute value(s)...")
+    written = 0
+    failed = skipped
+    for batch, result in AttributeValue.write_many(values, batch_size, workers):
+        if result in (200, 204):
+            written += len(batch)
+        else:
+            failed += len(batch)
+            print(f"failed to write {len(batch)} value(s)...error: {result}")
+    print(f"wrote {written} attribute value(s)")
+    return written, failed
+
+
+def load_models_and_equipment(templates, model_sheet, equipment_sheet,
+        quarantine: Quarantine = None, workers: int = 8, known_models: List[Model] = None,
+        ids: IdWriter = None):
+    """ Loads the models and their equipment as one pipeline
+
+    The models are inserted one after the other. Each publish is queued on a
+    thread pool so it runs while the next models are inserted. At the same
+    time the equipment is streamed from the sheet (stream_equipment): a row
+    whose model is in the sheet waits until the model is published, then it
+    is inserted and its id written.
+
+    Args:
+        templates - list of templates that were loaded
+        model_sheet - worksheet that contains the models
+        equipment_sheet - worksheet that contains the equipment
+        quarantine - collects the objects that could not be loaded
+        workers - number of concurrent publish and of concurrent equipment requests
+        known_models - models in AC that are not in the sheet but used by the equipment
+        ids - writer for the ids of the equipment, None to return the equipment
+
+    Returns:
+        list of the models and list of the equipment that were loaded, the
+        equipment is not kept with ids
+    """
+    if quarantine is None:
+        quarantine = Quarantine()
+
+    models = read_models(model_sheet)
+    resolve_model_templates(models, templates, quarantine)
+    index = model_index(known_models or [])
+    index.update(model_index(models))
+    # set when the model is published or could not be loaded
+    done = {model.internalId: threading.Event() for model in models}
+
+    def resolve(equipment):
+        event = done.get(equipment.modelId)
+        if event is not None:
+            event.wait()
+        resolve_equipment_model(equipment, index, quarantine)
+
+    def publish(model):
+        try:
+            publish_model(model, quarantine)
+        finally:
+            done[model.internalId].set()
+
+    with ThreadPoolExecutor(max_workers=1) as reader, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        streamed = reader.submit(bind_client(stream_equipment), equipment_sheet, resolve,
+            quarantine, ids, workers)
+        try:
+            publishes = []
+            for model in models:
+                if quarantine.is_quarantined("Model", model.internalId):
+                    print(f"skipping model {model.internalId}...")
+                elif model.modelId:
+                    print(f"model {model.internalId} already loaded...id = {model.modelId}")
+                elif insert_model(model, quarantine):
+                    publishes.append(executor.submit(bind_client(publish), model))
+                    continue
+                done[model.internalId].set()
+            for future in publishes:
+                future.result()
+        finally:
+            # the equipment must not wait for a model that is never published
+            for event in done.values():
+                event.set()
+        equipment_list = streamed.result()
+
+    return models, equipment_list
+
+
+def open_workbook(datafile: str):
+    """ Opens the workbook read only
+
+    The file is read into memory first so that it is not held open while the
+    ids are patched into it.
+    """
+    with open(datafile, "rb") as f:
+        return load_workbook(filename=BytesIO(f.read()), read_only=True)
+
+@contextmanager
+def stream_workbook(datafile: str):
+    """ Opens the workbook read only and streams the sheets from the file
+
+    Unlike open_workbook the file is not read into memory, it is held open
+    until the with block ends and must not be patched in it.
+    """
+    wb = load_workbook(filename=datafile, read_only=True)
+    try:
+        yield wb
+    finally:
+        wb.close()
+
+def with_catalog(objects: List, catalog: Catalog, collection: str, worksheet, column: int):
+    """ Adds the objects of the catalog that the worksheet references and that are not loaded
+
+    Args:
+        objects - the loaded objects
+        catalog - the catalog, None to use the objects as they are
+        collection - collection of the referenced objects
+        worksheet - the worksheet with the references
+        column - the column of the references
+
+    Returns:
+        the objects and the referenced objects found in the catalog
+    """
+    if catalog is None:
+        return objects
+    loaded = {obj.internalId for obj in objects}
+    references = {row[column] for row in worksheet.iter_rows(min_row=2, values_only=True)}
+    return objects + catalog.get_many(collection, references - loaded - {None})
+
+def with_catalog_ids(ids: Dict[str, str], catalog: Catalog, collection: str, worksheet,
+        column: int) -> Dict[str, str]:
+    """ Adds the ids of the catalog objects that the worksheet references and that are not loaded
+
+    Like with_catalog, for {internal id: id} instead of the objects.
+    """
+    if catalog is None:
+        return ids
+    references = {row[column] for row in worksheet.iter_rows(min_row=2, values_only=True)}
+    found = {}
+    for internal_id in references - ids.keys() - {None}:
+        found_id = catalog.lookup(collection, internal_id)
+        if found_id:
+            found[internal_id] = found_id
+    return {**ids, **found}
+
+def ac_id(obj):
+    """ the AC id of an object, models and equipment have their own id fields """
+    if isinstance(obj, Model):
+        return obj.modelId
+    if isinstance(obj, Equipment):
+        return obj.equipmentId
+    return obj.id
+
+def id_updates(asset_central_objects: List, worksheet):
+    """ Finds the rows whose id differs from the id of the loaded object
+
+    Args:
+        asset_central_objects - a list of objects with ids
+        worksheet - the worksheet the objects were read from
+
+    Returns:
+        {row number: id} for the rows to update
+    """
+    if asset_central_objects is None:
+        return {}
+    ids = {obj.internalId: ac_id(obj) for obj in asset_central_objects}
+    updates = {}
+    for row_number, row in enumerate(worksheet.iter_rows(min_row=2, values_only=True), start=2):
+        value = ids.get(row[INTERNAL_ID])
+        if value is not None and value != (row[ID] or ""):
+            updates[row_number] = value
+    return updates
+
+def write_ids(ids: IdWriter, asset_central_objects: List, worksheet):
+    """ Patches the ids of the loaded objects into the file """
+    ids.add(worksheet.title, id_updates(asset_central_objects, worksheet))
+    ids.flush()
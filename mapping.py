@@ -23,6 +23,7 @@ TEM_ID = 0
 TEM_INTERNAL_ID = 1
 TEM_DESCRIPTION = 2
 TEM_INDICATOR_GROUP = 3
+TEM_ATTRIBUTE_GROUP = 4
 
 # model fields
 MOD_ID = 0
@@ -39,3 +40,23 @@ EQU_DESCRIPTION = 2
 EQU_MODEL = 3
 EQU_OPERATOR = 4
 EQU_LIFECYCLE = 5
+
+# attribute fields
+ATT_ID = 0
+ATT_INTERNAL_ID = 1
+ATT_DESCRIPTION = 2
+ATT_DATA_TYPE = 3
+ATT_DIMENSION = 4
+ATT_UOM = 5
+
+# attribute group fields
+AG_ID = 0
+AG_INTERNAL_ID = 1
+AG_DESCRIPTION = 2
+AG_ATTRIBUTE = 3
+
+# attribute value fields, the values have no id
+VAL_EQUIPMENT = 0
+VAL_ATTRIBUTE_GROUP = 1
+VAL_ATTRIBUTE = 2
+VAL_VALUE = 3
@@ -0,0 +1,287 @@
+"""In-memory mock of the ACAPI for offline tests and benchmarks
+
+Implements the parts of the ACAPI that ac_api uses: the token endpoint,
+dimensions, create/read/update/delete of attributes, attribute groups,
+indicators, indicator groups, templates, models and equipment, the bulk
+write of equipment attribute values and the posting of indicator readings. Reads support internalId $filter with or,
+changedOn ge $filter, $top/$skip paging, $select and ETags. Request and response bodies may be gzip compressed.
+Tests can make requests fail with state.faults.
+
+Run it with:
+    python mock_server.py --port 8765 --latency 0.05
+and point the .env at it:
+    BASE_URL = 'http://localhost:8765'
+    TOKEN_URL = 'http://localhost:8765/oauth/token'
+    OAUTHLIB_INSECURE_TRANSPORT = '1'
+
+"""
+
+# standard imports
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# third party imports
+import click
+
+
+# collection -> (id field, status code of a delete)
+COLLECTIONS = {
+    "attributes": ("id", 200),
+    "attributegroups": ("id", 200),
+    "indicators": ("id", 200),
+    "indicatorgroups": ("id", 200),
+    "templates": ("id", 200),
+    "models": ("modelId", 204),
+    "equipment": ("equipmentId", 204),
+}
+
+DIMENSIONS = [
+    {"dimensionId": "VOLTAG", "unitId": "V", "dimensionDescription": "Voltage",
+        "unitShortDescription": "V"},
+    {"dimensionId": "TEMP", "unitId": "GC", "dimensionDescription": "Temperature",
+        "unitShortDescription": "C"},
+]
+
+# /models, /models(ID), /models(ID)/publish, /indicators/ID
+PATH = re.compile(r"^/(\w+)(?:\((\w+)\)|/(\w+))?(/publish)?$")
+
+
+class MockState():
+    """ the objects in the mock tenant and traffic counters """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects = {name: {} for name in COLLECTIONS}
+        # equipmentId -> {(attributeGroupId, attributeId): value}
+        self.values = {}
+        # the posted indicator readings
+        self.readings = []
+        # {regex of "METHOD path": status code} answered instead of handling the request
+        self.faults = {}
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def find(self, collection, filter_expression):
+        """ objects matching an internalId eq ... or ... or a changedOn ge ... filter """
+        internal_ids = {v.replace("''", "'") for v in re.findall(r"internalId eq '((?:[^']|'')*)'",
+            filter_expression)}
+        with self.lock:
+            objects = list(self.objects[collection].values())
+        if not filter_expression:
+            return objects
+        changed = re.search(r"changedOn ge '([^']*)'", filter_expression)
+        if changed:
+            return [o for o in objects if o.get("changedOn", "") >= changed.group(1)]
+        return [o for o in objects if o.get("internalId") in internal_ids]
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.state.lock:
+            self.state.requests += 1
+            self.state.bytes_in += len(data)
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        return json.loads(data) if data else None
+
+    def _fault(self):
+        """ answer with the status of a matching fault, returns True if it did """
+        for pattern, status in list(self.state.faults.items()):
+            if re.search(pattern, f"{self.command} {self.path}"):
+                self._send(status, {"error": "injected fault"})
+                return True
+        return False
+
+    def _send(self, status, payload=None, etag=None):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        data = b"" if payload is None else json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        if etag:
+            headers["ETag"] = etag
+        if len(data) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(data))
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        with self.state.lock:
+            self.state.bytes_out += len(data)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        match = PATH.match(unquote(url.path))
+        if not match:
+            return None, None, None, {}
+        collection, key1, key2, publish = match.groups()
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        return collection, key1 or key2, publish, query
+
+    def do_GET(self):
+        self._body()
+        if self._fault():
+            return
+        collection, key, _, query = self._route()
+        if self.path.startswith("/uom/dimensions"):
+            return self._send(200, DIMENSIONS)
+        if collection not in COLLECTIONS:
+            return self._send(404, {"error": "not found"})
+        objects = self.state.find(collection, query.get("$filter", ""))
+        if "$top" in query or "$skip" in query:
+            skip = int(query.get("$skip", 0))
+            objects = objects[skip:skip + int(query.get("$top", len(objects)))]
+        if "$select" in query:
+            fields = query["$select"].split(",")
+            objects = [{k: v for k, v in o.items() if k in fields} for o in objects]
+        data = json.dumps(objects, sort_keys=True).encode()
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, etag=etag)
+        self._send(200, objects, etag)
+
+    def do_POST(self):
+        if self.path.startswith("/oauth/token"):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            return self._send(200, {"access_token": "mock", "token_type": "Bearer",
+                "expires_in": 3600})
+        body = self._body()
+        if self._fault():
+            return
+        if self.path.startswith("/timeseries/readings"):
+            return self._post_readings(body or [])
+        collection, _, _, _ = self._route()
+        if collection not in COLLECTIONS:
+            return self._send(404, {"error": "not found"})
+        id_field = COLLECTIONS[collection][0]
+        if any(o.get("internalId") == body.get("internalId")
+                for o in self.state.find(collection, f"internalId eq '{body.get('internalId')}'")):
+            return self._send(400, {"error": "internalId already exists"})
+        body[id_field] = uuid.uuid4().hex.upper()
+        body["createdOn"] = body["changedOn"] = _now()
+        if collection in ("models", "equipment"):
+            body["class"] = collection
+        with self.state.lock:
+            self.state.objects[collection][body[id_field]] = body
+        # templates are returned as a list
+        if collection == "templates":
+            return self._send(200, [{"id": body["id"]}])
+        self._send(200, {id_field: body[id_field]})
+
+    def _post_readings(self, readings):
+        """ readings of known equipment and indicators, all or nothing """
+        with self.state.lock:
+            unknown = {r.get("equipmentId") for r in readings} - set(self.state.objects["equipment"])
+            unknown |= {r.get("indicatorId") for r in readings} - set(self.state.objects["indicators"])
+            if not unknown:
+                self.state.readings.extend(readings)
+        if unknown:
+            return self._send(400, {"error": f"unknown ids {', '.join(sorted(map(str, unknown)))}"})
+        self._send(202)
+
+    def _write_values(self, values):
+        """ the bulk write of attribute values, all or nothing """
+        with self.state.lock:
+            equipment = self.state.objects["equipment"]
+            unknown = {v.get("equipmentId") for v in values} - set(equipment)
+            if not unknown:
+                for v in values:
+                    self.state.values.setdefault(v["equipmentId"], {})[
+                        (v.get("attributeGroupId"), v.get("attributeId"))] = v.get("value")
+        if unknown:
+            return self._send(400, {"error": f"unknown equipment {', '.join(sorted(map(str, unknown)))}"})
+        self._send(200)
+
+    def _update(self):
+        body = self._body()
+        if self._fault():
+            return
+        collection, key, publish, _ = self._route()
+        if collection == "equipment" and key == "values":
+            return self._write_values(body or [])
+        with self.state.lock:
+            obj = self.state.objects.get(collection, {}).get(key)
+            if obj is not None and publish:
+                obj["status"] = "published"
+            elif obj is not None and body:
+                obj.update(body)
+            if obj is not None:
+                obj["changedOn"] = _now()
+        if obj is None:
+            return self._send(404, {"error": "not found"})
+        self._send(200 if COLLECTIONS[collection][1] == 200 or publish else 204)
+
+    do_PUT = _update
+    do_PATCH = _update
+
+    def do_DELETE(self):
+        self._body()
+        if self._fault():
+            return
+        collection, key, _, _ = self._route()
+        with self.state.lock:
+            obj = self.state.objects.get(collection, {}).pop(key, None)
+        if obj is None:
+            return self._send(404, {"error": "not found"})
+        self._send(COLLECTIONS[collection][1])
+
+
+def start(port: int = 0, latency: float = 0.0):
+    """ Start the mock server in a background thread
+
+    Args:
+        port - port to listen on, 0 picks a free port
+        latency - seconds added to every response
+
+    Returns:
+        the server, its url is f"http://localhost:{server.server_port}" and
+        server.state has the objects and traffic counters
+    """
+    state = MockState(latency)
+    handler = type("Handler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option("--port", default=8765, show_default=True)
+@click.option("--latency", default=0.0, show_default=True, help="seconds added to every response")
+def main(port, latency):
+    """ Run the mock ACAPI server """
+    server = start(port, latency)
+    print(f"mock ACAPI listening on http://localhost:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Hooks and profiling for the ACAPI requests and the loader stages
+
+ac_api calls the before_request/after_request hooks around every request and
+acload marks its stages with stage(). The Profiler uses the hooks to report
+the wall and CPU time per stage and the time spent waiting for the ACAPI,
+together with a cProfile dump and folded stacks for flame graphs.
+
+"""
+
+# standard imports
+import cProfile
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+
+# event -> hook signature
+#   before_request(method, url)
+#   after_request(method, url, status_code, elapsed)
+#   stage_start(name)
+#   stage_end(name)
+HOOK_EVENTS = ("before_request", "after_request", "stage_start", "stage_end")
+
+_hooks = {event: [] for event in HOOK_EVENTS}
+
+
+def add_hook(event: str, hook):
+    """ call hook on the event, see HOOK_EVENTS for the arguments """
+    if event not in _hooks:
+        raise ValueError(f"unknown hook event {event}")
+    _hooks[event].append(hook)
+
+
+def remove_hook(event: str, hook):
+    _hooks[event].remove(hook)
+
+
+def emit(event: str, *args):
+    """ call the hooks of the event """
+    for hook in _hooks[event]:
+        hook(*args)
+
+
+@contextmanager
+def stage(name: str):
+    """ mark a stage of the load, e.g. with stage("indicators"): ... """
+    emit("stage_start", name)
+    try:
+        yield
+    finally:
+        emit("stage_end", name)
+
+
+def collection_of(url: str):
+    """ the collection of a request url, e.g. models for .../models(ID)/publish """
+    segments = [seg for seg in urlsplit(url).path.split("/") if seg and seg != "publish"]
+    if not segments:
+        return ""
+    if "(" in segments[-1]:
+        return segments[-1].split("(")[0]
+    # .../indicators/ID
+    if len(segments) > 1 and re.fullmatch(r"[0-9A-F]{32}", segments[-1]):
+        return segments[-2]
+    return segments[-1]
+
+
+class Profiler():
+    """ Profile a run of acload
+
+    Writes <prefix>.prof (cProfile of the main thread, open with pstats or
+    snakeviz) and <prefix>.folded (stacks of all threads sampled every
+    interval seconds, for flamegraph.pl or speedscope).
+
+    Attributes:
+        prefix: path prefix of the output files
+        interval: seconds between stack samples
+    """
+
+    def __init__(self, prefix: str = "acload_profile", interval: float = 0.005):
+        self.prefix = prefix
+        self.interval = interval
+        # stage -> [wall seconds, cpu seconds, count]
+        self.stages = defaultdict(lambda: [0.0, 0.0, 0])
+        # (method, collection) -> [seconds, count]
+        self.requests = defaultdict(lambda: [0.0, 0])
+        self.samples = Counter()
+        self._started = {}
+        self._lock = threading.Lock()
+        self._profile = cProfile.Profile()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._start = None
+
+    def _stage_start(self, name):
+        self._started[(threading.get_ident(), name)] = (time.perf_counter(), time.process_time())
+
+    def _stage_end(self, name):
+        wall, cpu = self._started.pop((threading.get_ident(), name))
+        with self._lock:
+            totals = self.stages[name]
+            totals[0] += time.perf_counter() - wall
+            totals[1] += time.process_time() - cpu
+            totals[2] += 1
+
+    def _after_request(self, method, url, status_code, elapsed):
+        collection = collection_of(url)
+        with self._lock:
+            totals = self.requests[(method, collection)]
+            totals[0] += elapsed
+            totals[1] += 1
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.split('/')[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident) or str(ident))
+                self.samples[";".join(reversed(stack))] += 1
+            names = {t.ident: t.name for t in threading.enumerate()}
+
+    def start(self):
+        add_hook("stage_start", self._stage_start)
+        add_hook("stage_end", self._stage_end)
+        add_hook("after_request", self._after_request)
+        self._start = (time.perf_counter(), time.process_time())
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        self._profile.enable()
+
+    def stop(self):
+        """ stop profiling, write the files and return the report """
+        self._profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        remove_hook("stage_start", self._stage_start)
+        remove_hook("stage_end", self._stage_end)
+        remove_hook("after_request", self._after_request)
+        self._profile.dump_stats(self.prefix + ".prof")
+        with open(self.prefix + ".folded", "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        return self.report()
+
+    def report(self):
+        """ the wall/CPU time per stage and the request times as text """
+        wall = time.perf_counter() - self._start[0]
+        cpu = time.process_time() - self._start[1]
+        lines = [f"{'stage':<30}{'count':>8}{'wall s':>10}{'cpu s':>10}"]
+        for name, (stage_wall, stage_cpu, count) in self.stages.items():
+            lines.append(f"{name:<30}{count:>8}{stage_wall:>10.3f}{stage_cpu:>10.3f}")
+        lines.append(f"{'total':<30}{'':>8}{wall:>10.3f}{cpu:>10.3f}")
+        lines.append("")
+        lines.append(f"{'request':<30}{'count':>8}{'wait s':>10}{'avg ms':>10}")
+        for (method, collection), (seconds, count) in sorted(self.requests.items()):
+            lines.append(f"{method + ' ' + collection:<30}{count:>8}{seconds:>10.3f}"
+                f"{1000 * seconds / count:>10.1f}")
+        lines.append("")
+        lines.append(f"profile written to {self.prefix}.prof and {self.prefix}.folded")
+        return "\n".join(lines)
@@ -0,0 +1,110 @@
+"""Quarantine for objects that could not be loaded into Asset Central
+
+When an object fails, everything that depends on it is skipped without calling
+the ACAPI. The failed and skipped rows are written to a workbook with the same
+layout as the input so that they can be fixed and loaded again.
+
+"""
+
+# standard imports
+from typing import Dict, Iterable
+
+# third party imports
+from openpyxl import Workbook
+
+# local imports
+from mapping import *
+
+
+# sheets in load order, the attribute sheets are optional
+SHEETS = ["Attribute", "Attribute Group", "Indicator", "Indicator Group", "Model Template", "Model",
+    "Equipment"]
+
+# sheet -> (sheet it depends on, column holding the reference)
+DEPENDENCIES = {
+    "Attribute Group": ("Attribute", AG_ATTRIBUTE),
+    "Indicator Group": ("Indicator", IG_INDICATOR),
+    "Model Template": ("Indicator Group", TEM_INDICATOR_GROUP),
+    "Model": ("Model Template", MOD_TEMPLATE),
+    "Equipment": ("Model", EQU_MODEL),
+}
+
+# sheet -> [(sheet, column)] of the references besides DEPENDENCIES
+OTHER_DEPENDENCIES = {
+    "Model Template": [("Attribute Group", TEM_ATTRIBUTE_GROUP)],
+}
+
+REFERENCE = "reference only, already loaded"
+
+
+class Quarantine():
+    """ Failed objects and their dependents, keyed by sheet and internal id """
+
+    def __init__(self):
+        self.reasons: Dict[str, Dict[str, str]] = {sheet: {} for sheet in SHEETS}
+
+    def __len__(self):
+        return sum(len(reasons) for reasons in self.reasons.values())
+
+    def fail(self, sheet: str, internal_id: str, reason):
+        """ record an object that failed to load """
+        self.reasons[sheet][internal_id] = str(reason)
+
+    def is_quarantined(self, sheet: str, internal_id: str):
+        return internal_id in self.reasons[sheet]
+
+    def skip_dependent(self, sheet: str, internal_id: str, references: Iterable[str],
+            parent_sheet: str = None):
+        """ quarantine an object if anything it references is quarantined
+
+        Args:
+            sheet - sheet of the object
+            internal_id - internal id of the object
+            references - internal ids of the objects it depends on
+            parent_sheet - sheet of the references, default the one in DEPENDENCIES
+
+        Returns:
+            True if the object was quarantined and must not be loaded
+        """
+        parent_sheet = parent_sheet or DEPENDENCIES[sheet][0]
+        for ref in references:
+            if ref in self.reasons[parent_sheet]:
+                self.reasons[sheet][internal_id] = f"depends on {parent_sheet} {ref} which was not loaded"
+                return True
+        return False
+
+    def save(self, wb, filename: str):
+        """ Write the quarantined rows to a new workbook
+
+        The workbook has the same sheets and columns as the source so it can be
+        loaded again after fixing the problems. Objects that were loaded and are
+        referenced by quarantined rows are copied with their ids so that the
+        references resolve; the loader does not insert rows that already have an id.
+
+        Args:
+            wb - the source workbook (with the ids written back)
+            filename - xlsx file to write
+        """
+        # work back from equipment to find the rows needed for the references
+        needed = {sheet: set(reasons) for sheet, reasons in self.reasons.items()}
+        sheets = [sheet for sheet in SHEETS if sheet in wb.sheetnames]
+        for sheet in reversed(sheets):
+            dependencies = [DEPENDENCIES[sheet]] if sheet in DEPENDENCIES else []
+            for parent_sheet, column in dependencies + OTHER_DEPENDENCIES.get(sheet, []):
+                if parent_sheet not in wb.sheetnames:
+                    continue
+                for row in wb[sheet].iter_rows(min_row=2, max_col=column + 1, values_only=True):
+                    if row[INTERNAL_ID] in needed[sheet] and row[column]:
+                        needed[parent_sheet].add(row[column])
+
+        out = Workbook()
+        out.remove(out.active)
+        for sheet in sheets:
+            ws = out.create_sheet(sheet)
+            reasons = self.reasons[sheet]
+            for iteration, row in enumerate(wb[sheet].iter_rows(values_only=True)):
+                if iteration == 0:
+                    ws.append(list(row) + ["Quarantine Reason"])
+                elif row[INTERNAL_ID] in needed[sheet]:
+                    ws.append(list(row) + [reasons.get(row[INTERNAL_ID], REFERENCE)])
+        out.save(filename=filename)
@@ -0,0 +1,153 @@
+"""Token bucket rate limiting of the ACAPI requests
+
+The tenant has separate quotas for e.g. creates and reads, so the limiter has
+one bucket per quota key:
+
+    "POST:equipment"  POST requests to the equipment collection
+    "POST"            all other POST requests
+    "*:indicators"    any request to the indicators collection
+    "*"               everything else
+
+A request is counted against the most specific key that has a quota. Each
+request takes a token from the bucket; when the bucket is empty the request
+waits until the bucket has refilled at the quota rate. The buckets can be kept
+in a file that is locked while it is updated, so several threads and processes
+(e.g. parallel acload runs) share one budget.
+
+"""
+
+# standard imports
+import json
+import re
+import threading
+import time
+from typing import Dict, Tuple
+
+# fcntl is not available on Windows, the buckets are then only shared within the process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# local imports
+from profiling import collection_of
+
+
+# 10/s, 600/min, 5/s@20 (burst of 20)
+QUOTA = re.compile(r"^\s*([^=]+?)\s*=\s*([\d.]+)\s*/\s*(s|sec|m|min)\s*(?:@\s*(\d+))?\s*$")
+
+
+def parse_quotas(spec: str) -> Dict[str, Tuple[float, float]]:
+    """ Parse quotas like "POST=5/s,GET=600/min,POST:equipment=2/s@10"
+
+    Returns:
+        {key: (requests per second, burst)}, the burst defaults to one
+        second of requests (at least 1)
+    """
+    quotas = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        match = QUOTA.match(item)
+        if not match:
+            raise ValueError(f"invalid quota '{item}', expected e.g. POST=5/s or GET:models=600/min")
+        key, count, unit, burst = match.groups()
+        rate = float(count) / (60 if unit.startswith("m") else 1)
+        verb, _, collection = key.partition(":")
+        key = verb.upper() + (":" + collection if collection else "")
+        quotas[key] = (rate, float(burst) if burst else max(1.0, rate))
+    return quotas
+
+
+class RateLimiter():
+    """ Token buckets for the requests to AC, keyed by verb and collection
+
+    Attributes:
+        quotas: {key: (requests per second, burst)}, see parse_quotas
+        path: optional file with the buckets, shared by all limiters using it
+        waited: {key: seconds that requests waited for a token}
+        throttled: number of 429 responses
+    """
+
+    def __init__(self, quotas: Dict[str, Tuple[float, float]], path: str = None):
+        for key, (rate, burst) in quotas.items():
+            if rate <= 0 or burst < 1:
+                raise ValueError(f"quota {key} needs a positive rate and a burst of at least 1")
+        self.quotas = dict(quotas)
+        self.path = path
+        self.waited = {}
+        self.throttled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def key(self, method: str, url: str):
+        """ the quota key of a request, None if no quota applies """
+        collection = collection_of(url)
+        for key in (f"{method}:{collection}", method, f"*:{collection}", "*"):
+            if key in self.quotas:
+                return key
+        return None
+
+    def _update(self, key: str, change):
+        """ apply change(tokens, seconds since the last update) -> tokens to the bucket """
+        with self._lock:
+            if self.path is None:
+                tokens, updated = self._buckets.get(key, (self.quotas[key][1], None))
+                now = time.time()
+                tokens = change(tokens, now - updated if updated else 0.0)
+                self._buckets[key] = (tokens, now)
+                return tokens
+            with open(self.path, "a+") as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    buckets = json.loads(content) if content else {}
+                    tokens, updated = buckets.get(key, (self.quotas[key][1], None))
+                    now = time.time()
+                    tokens = change(tokens, now - updated if updated else 0.0)
+                    buckets[key] = (tokens, now)
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(buckets, f)
+                    f.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                return tokens
+
+    def acquire(self, method: str, url: str):
+        """ Wait until the request may be sent
+
+        The token is taken right away and the request waits for the deficit,
+        so the waiting requests go out in order at the quota rate.
+
+        Returns:
+            the seconds waited
+        """
+        key = self.key(method, url)
+        if key is None:
+            return 0.0
+        rate, burst = self.quotas[key]
+        tokens = self._update(key, lambda tokens, elapsed: min(burst, tokens + elapsed * rate) - 1)
+        wait = -tokens / rate if tokens < 0 else 0.0
+        if wait:
+            with self._lock:
+                self.waited[key] = self.waited.get(key, 0.0) + wait
+            time.sleep(wait)
+        return wait
+
+    def throttle(self, method: str, url: str, seconds: float):
+        """ AC answered 429, hold back the requests of the key for the given seconds
+
+        The bucket is emptied so that the next requests (in any process sharing
+        it) wait; without a quota for the request this waits itself.
+        """
+        key = self.key(method, url)
+        with self._lock:
+            self.throttled += 1
+        if key is None:
+            time.sleep(seconds)
+            return
+        rate, burst = self.quotas[key]
+        self._update(key, lambda tokens, elapsed:
+            min(min(burst, tokens + elapsed * rate), -seconds * rate))
@@ -6,7 +6,19 @@ setup(
         py_modules=[
             "ac_api",
             "acload",
-            "mapping"
+            "autotune",
+            "builder",
+            "catalog",
+            "daemon",
+            "diff",
+            "ingest",
+            "loader",
+            "mapping",
+            "profiling",
+            "quarantine",
+            "ratelimit",
+            "validation",
+            "xlsx_patch",
             ],
         install_requires=[
             "Click",
@@ -16,6 +28,12 @@ setup(
             "requests",
             "requests-oauthlib",
             ],
+        extras_require={
+            "fast": ["orjson"],
+            "http2": ["httpx[http2]"],
+            "pandas": ["pandas"],
+            "parquet": ["pyarrow"],
+            },
         entry_points="""
             [console_scripts]
             acload=acload:cli
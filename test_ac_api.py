@@ -1,7 +1,11 @@
 import json
+import time
+
 import pytest
 
+import ac_api
 from ac_api import *
+from ratelimit import RateLimiter, parse_quotas
 
 
 org_id = "BC0D934611A24E28A7B56888E55BB9F5"
@@ -47,6 +51,7 @@ def create_equipment():
     return equip
 
 # make sure the authorization code works
+@pytest.mark.live
 def test_auth():
     oauth = get_oauth_session()
     assert oauth.authorized == True
@@ -106,6 +111,29 @@ def test_indicator_group():
     assert status == 200
 
 
+def test_attribute(mock_tenant):
+    objects = mock_tenant.state.objects
+    attribute = Attribute(internalId="ATT1", description=Description("rated power"),
+        dimension1="VOLTAG", attributeUom="V")
+    status = attribute.insert()
+    assert status == 200
+    assert len(attribute.id) == 32
+    attribute_group = AttributeGroup(internalId="AG1", description=Description("nameplate"),
+        attributes=[attribute.id])
+    assert attribute_group.insert() == 200
+    # update attribute
+    attribute.description.short = "Rated Power"
+    assert attribute.update() == 200
+    attribute_load = Attribute.load("ATT1")
+    assert attribute_load.description.short == "Rated Power"
+    assert AttributeGroup.load("AG1").attributes == [attribute.id]
+    assert objects["attributes"][attribute.id]["attributeUom"] == "V"
+    # delete
+    assert attribute_group.delete() == 200
+    assert attribute.delete() == 200
+    assert not objects["attributes"] and not objects["attributegroups"]
+
+
 def test_template():
     template = create_template()
     template.indicatorGroups = [ IdString("ED5D78C2A79F4EE6A54714E87496ADB4") ]
@@ -145,9 +173,11 @@ def test_model():
     status = model.insert()
     assert status == 200
     assert len(model.modelId) == 32
-    # update
-    with pytest.raises(NotImplementedError):
-        model.update()
+    # update, nothing is sent if nothing changed
+    assert model.update() is None
+    model.description = "model description 2"
+    status = model.update()
+    assert status in (200, 204)
     # publish
     status = model.publish()
     assert status == 200
@@ -174,9 +204,11 @@ def test_equipment():
     status = equip.insert()
     assert status == 200
     assert len(equip.equipmentId) == 32
-    # update
-    with pytest.raises(NotImplementedError):
-        equip.update()
+    # update, nothing is sent if nothing changed
+    assert equip.update() is None
+    equip.description.short = "equipment description 2"
+    status = equip.update()
+    assert status in (200, 204)
     # load
     load = Equipment.load(equip_internal_id)
     assert load.internalId == equip_internal_id
@@ -315,3 +347,284 @@ def test_dimensions():
     for u in uom:
         print(u.dimensionId, u.dimensionDescription, u.unitId, u.unitShortDescription)
 
+
+def test_response_cache(fake_transport, monkeypatch, tmp_path):
+    payload = [{"id": "A" * 32, "internalId": ind_internal_id}]
+    def respond(method, url, data, headers):
+        if headers and headers.get("If-None-Match") == '"v1"':
+            return 304, None
+        return 200, payload, {"ETag": '"v1"'}
+    fake_transport.respond = respond
+    path = str(tmp_path / "cache.json")
+    cache = enable_response_cache(max_entries=10, path=path)
+    try:
+        assert Indicator.load(ind_internal_id).id == "A" * 32
+        assert Indicator.load(ind_internal_id).id == "A" * 32
+        assert [headers for _, _, _, headers in fake_transport.requests] == \
+            [{}, {"If-None-Match": '"v1"'}]
+        assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1,
+            "bytes": len(json.dumps(payload)), "hit_rate": 0.5}
+        # the saved cache is used by the next run
+        cache.save()
+        assert len(ResponseCache(path=path)) == 1
+        # the entry is evicted by another thread while the conditional request is sent
+        entry, headers = cache.validators(ac_api._base_url() + "/x")
+        assert entry is None and headers == {}
+        small = enable_response_cache(max_entries=1)
+        Indicator.load(ind_internal_id)
+        def evict(method, url, data, headers):
+            if headers:
+                small.store("https://ac/other", CassetteResponse(200, b"[]", {"ETag": '"v2"'}))
+            return respond(method, url, data, headers)
+        fake_transport.respond = evict
+        assert Indicator.load(ind_internal_id).id == "A" * 32
+        assert small.hits == 1 and len(small) == 1
+        # the bodies are bounded by size, a body larger than the cache is not kept
+        sized = ResponseCache(max_bytes=10)
+        sized.store("https://ac/a", CassetteResponse(200, b"[1,2,3]", {"ETag": '"a"'}))
+        sized.store("https://ac/b", CassetteResponse(200, b"[4,5]", {"ETag": '"b"'}))
+        assert sized.validators("https://ac/a")[0] is None and sized.stats()["bytes"] == 5
+        sized.store("https://ac/c", CassetteResponse(200, b"[" + b"1," * 10 + b"1]", {"ETag": '"c"'}))
+        assert len(sized) == 1 and sized.validators("https://ac/c")[0] is None
+    finally:
+        disable_response_cache()
+
+def test_load_many(fake_transport):
+    def respond(method, url, data, headers):
+        ids = [term.split("'")[1] for term in url.split("$filter=")[1].split("+or+")]
+        # EQU7 does not exist in AC
+        return 200, [{"internalId": i, "equipmentId": "ID" + i, "class": "x"}
+            for i in ids if i != "EQU7"]
+    fake_transport.respond = respond
+    internal_ids = [f"EQU{i}" for i in range(500)] + ["EQU1"]
+    equipment = Equipment.load_many(internal_ids)
+    urls = [url for _, url, _, _ in fake_transport.requests]
+    assert len(urls) == 10
+    assert all(len(url) < 2000 for url in urls)
+    assert len(equipment) == 499
+    assert equipment["EQU42"].equipmentId == "IDEQU42"
+    assert "EQU7" not in equipment
+
+def test_filter_chunks():
+    chunks = ac_api._filter_chunks(["a'b", "c d"], max_ids=1)
+    assert chunks == ["internalId+eq+'a%27%27b'", "internalId+eq+'c%20d'"]
+
+def test_update_sends_changed_fields(fake_transport):
+    def respond(method, url, data, headers):
+        if method == "GET":
+            return 200, [{"internalId": equip_internal_id, "equipmentId": "E" * 32,
+                "class": "x", "lifeCycle": "2", "description": {"short": "equipment", "long": ""}}]
+        return 204, None
+    fake_transport.respond = respond
+    equip = Equipment.load(equip_internal_id)
+    assert equip.update() is None
+    equip.lifeCycle = "3"
+    assert equip.update() == 204
+    assert [(method, url, json.loads(data)) for method, url, data, _ in fake_transport.requests[1:]] \
+        == [("PATCH", f"https://ac/equipment({'E' * 32})", {"lifeCycle": "3"})]
+    # the new state is the base for the next update
+    assert equip.update() is None
+    # PUT replaces the object, the whole indicator is sent when a field changed
+    fake_transport.respond = lambda method, url, data, headers: \
+        (200, [{"id": "I" * 32, "internalId": ind_internal_id, "dataType": "numeric",
+            "indicatorColorCode": "#fff", "description": {"short": "old", "long": ""}}])
+    indicator = Indicator.load(ind_internal_id)
+    assert indicator.update() is None
+    indicator.description.short = "new"
+    assert indicator.update() == 200
+    method, url, data, _ = fake_transport.requests[-1]
+    assert (method, url) == ("PUT", f"https://ac/indicators/{'I' * 32}")
+    full = json.loads(indicator.to_json())
+    del full["dimension1"], full["indicatorUom"]
+    assert json.loads(data) == full and full["indicatorColorCode"] == "#fff"
+
+def test_update_ignores_unknown_nested_keys(mock_tenant):
+    model = Model(internalId=mod_internal_id, description=Description("model"),
+        templates=[PrimaryTemplate("T" * 32)])
+    model.insert()
+    # AC returns keys that the nested dataclasses do not have
+    stored = mock_tenant.state.objects["models"][model.modelId]
+    stored["templates"] = [{"id": "T" * 32, "primary": True, "name": "template"}]
+    stored["description"] = {"short": "model", "long": "", "language": "en"}
+    loaded = Model.load(mod_internal_id)
+    requests = mock_tenant.state.requests
+    assert loaded.update() is None
+    assert mock_tenant.state.requests == requests
+
+def test_load_select(fake_transport):
+    fake_transport.respond = lambda method, url, data, headers: \
+        (200, [{"modelId": "M" * 32, "internalId": mod_internal_id}])
+    model = Model.load(mod_internal_id, fields=["description", "internalId"])
+    assert fake_transport.requests[0][1].endswith("&$select=modelId,internalId,description")
+    assert model.modelId == "M" * 32
+    assert model.manufacturer == ""
+    # load escapes the internal id like load_many
+    Indicator.load("a'b c")
+    assert fake_transport.requests[1][1] == \
+        "https://ac/indicators?$filter=internalId+eq+'a%27%27b%20c'"
+
+def test_decode():
+    indicator = ac_api.decode_objects(Indicator, {"id": "I" * 32, "internalId": ind_internal_id,
+        "description": {"short": "Output Voltage", "long": ""},
+        "indicatorType": [{"type": "IndicatorType", "code": "2", "languageIsoCode": "en",
+            "description": "calculated"}], "unknownField": 1})
+    assert indicator.description == Description("Output Voltage", "")
+    assert indicator.indicatorType[0].code == "2"
+    # the snapshot matches the decoded object, update has nothing to send
+    assert ac_api._changes(indicator) == {}
+    models = ac_api.decode_objects(Model, [{"modelId": "M" * 32, "class": "models",
+        "templates": [{"id": "T" * 32, "primary": True}]}] * 2)
+    assert [m.class_ for m in models] == ["models", "models"]
+    assert models[0].templates == [PrimaryTemplate("T" * 32)]
+    assert json.loads(models[0].to_json())["class"] == "models"
+    # the decoder is built once per class
+    assert ac_api._decoder(Model) is ac_api._decoder(Model)
+
+def test_transport_compression(monkeypatch, mock_tenant):
+    monkeypatch.setattr("ac_api.transport", SessionTransport(compress=True))
+    indicator = create_indicator()
+    indicator.description.long = "x" * 5000
+    assert indicator.insert() == 200
+    # the body was sent compressed and the token was fetched once
+    assert mock_tenant.state.bytes_in < 1000
+    assert Indicator.load(ind_internal_id).id == indicator.id
+    assert indicator.delete() == 200
+    assert mock_tenant.state.requests == 3
+
+def test_cassette_record_and_replay(monkeypatch, tmp_path, mock_tenant):
+    mock_tenant.state.latency = 0.05
+    path = str(tmp_path / "cassette.json")
+    recorder = CassetteTransport(path, "record", inner=SessionTransport())
+    monkeypatch.setattr("ac_api.transport", recorder)
+    indicator = create_indicator()
+    assert indicator.insert() == 200
+    assert Indicator.load(ind_internal_id).id == indicator.id
+    recorder.save()
+    mock_tenant.shutdown()
+    # replay without the server, the ids are the recorded ones
+    for keep_latency in [False, True]:
+        monkeypatch.setattr("ac_api.transport", CassetteTransport(path, keep_latency=keep_latency))
+        replayed = create_indicator()
+        start = time.perf_counter()
+        assert replayed.insert() == 200
+        assert replayed.id == indicator.id
+        assert Indicator.load(ind_internal_id).id == indicator.id
+        assert (time.perf_counter() - start >= 0.1) == keep_latency
+        with pytest.raises(CassetteMiss):
+            replayed.delete()
+    # replayed for a client of another tenant
+    client = ACClient("https://other", transport=CassetteTransport(path))
+    with use_client(client):
+        assert Indicator.load(ind_internal_id).id == indicator.id
+
+def test_parse_quotas():
+    assert parse_quotas("post=5/s, GET=600/min,POST:equipment=2/s@10") == {
+        "POST": (5.0, 5.0), "GET": (10.0, 10.0), "POST:equipment": (2.0, 10.0)}
+    with pytest.raises(ValueError):
+        parse_quotas("POST=fast")
+
+def test_rate_limiter_shared_file(tmp_path):
+    path = str(tmp_path / "buckets.json")
+    # two limiters on the same file, like two acload processes
+    limiters = [RateLimiter({"POST:equipment": (20.0, 1.0), "*": (1000.0, 1000.0)}, path)
+        for _ in range(2)]
+    assert limiters[0].key("POST", "https://ac/equipment") == "POST:equipment"
+    assert limiters[0].key("GET", "https://ac/equipment?$filter=x") == "*"
+    start = time.perf_counter()
+    for i in range(6):
+        limiters[i % 2].acquire("POST", "https://ac/equipment")
+    # the first request takes the burst, the other five wait for 1/20 s each (less the
+    # time spent between the requests)
+    assert time.perf_counter() - start >= 0.2
+    assert sum(limiter.waited["POST:equipment"] for limiter in limiters) >= 0.2
+
+def test_throttled_request_is_retried(fake_transport, monkeypatch):
+    statuses = [429, 429, 200]
+    fake_transport.respond = lambda method, url, data, headers: \
+        (statuses.pop(0), {}, {"Retry-After": "0"})
+    limiter = RateLimiter({"GET": (100.0, 100.0)})
+    monkeypatch.setattr("ac_api.rate_limiter", limiter)
+    assert ac_api._request("GET", "https://ac/models").status_code == 200
+    assert limiter.throttled == 2
+
+def test_clients(monkeypatch):
+    import pickle
+    import threading
+    import mock_server
+    monkeypatch.setenv("OAUTHLIB_INSECURE_TRANSPORT", "1")
+    servers = [mock_server.start() for _ in range(2)]
+    clients = [ACClient(f"http://localhost:{s.server_port}", f"http://localhost:{s.server_port}/oauth/token",
+        "mock", "secret") for s in servers]
+    try:
+        # two tenants used by threads at the same time
+        def load(client, n):
+            with use_client(client):
+                for i in range(5):
+                    Indicator(internalId=f"IND{n}_{i}").insert()
+                assert current_client() is client
+                # the threads of load_many use the client of the caller
+                assert len(Indicator.load_many([f"IND{n}_{i}" for i in range(5)], max_workers=2)) == 5
+        threads = [threading.Thread(target=load, args=(client, n)) for n, client in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [sorted(o["internalId"] for o in s.state.objects["indicators"].values()) for s in servers] \
+            == [[f"IND{n}_{i}" for i in range(5)] for n in range(2)]
+        assert current_client() is ac_api._default_client
+        # create and remove return the result and leave the object as it is
+        with use_client(clients[0]):
+            equip = Equipment(internalId=equip_internal_id, modelId=model_id)
+            result = equip.create()
+            assert result.ok and len(result.id) == 32 and equip.equipmentId == ""
+            equip = Equipment(equipmentId=result.id, modelId=model_id)
+            assert equip.remove() == Result(204, "")
+            assert equip.equipmentId == result.id
+            # delete clears the id, not the model
+            equip.insert()
+            assert equip.delete() == 204
+            assert (equip.equipmentId, equip.modelId) == ("", model_id)
+        # a client sent to another process opens its own connections
+        copy = pickle.loads(pickle.dumps(clients[1]))
+        assert copy.transport is None and copy.base_url == clients[1].base_url
+        with use_client(copy):
+            assert Indicator.load("IND1_0").internalId == "IND1_0"
+    finally:
+        for server in servers:
+            server.shutdown()
+
+def test_auto_tune(fake_transport):
+    import threading
+    from autotune import AutoTuner, AdaptiveTransport
+    in_flight = [0]
+    lock = threading.Lock()
+    def respond(method, url, data, headers):
+        """ the tenant gets slower above 8 requests in flight and throttles above 12 """
+        with lock:
+            in_flight[0] += 1
+            n = in_flight[0]
+        try:
+            if n > 12:
+                return 429, None
+            time.sleep(0.002 * max(1, n / 8))
+            return 200, None
+        finally:
+            with lock:
+                in_flight[0] -= 1
+    fake_transport.respond = respond
+    tuner = AutoTuner(initial=2, maximum=64)
+    transport = AdaptiveTransport(fake_transport, tuner)
+    def work():
+        for _ in range(60):
+            transport.request("POST", "https://ac/equipment")
+    threads = [threading.Thread(target=work) for _ in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    limit = tuner.limits["POST:equipment"]
+    # the limit grew from 2 to just below the throttling and stayed there
+    assert 6 <= tuner.settings()["POST:equipment"] <= 13
+    assert limit.requests == 1920
+    assert limit.throttled < 200
+    assert "POST:equipment: " in tuner.summary()
@@ -0,0 +1,734 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import pytest
+import time
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font
+
+import ac_api
+import acload
+from catalog import Catalog
+from ac_api import AttributeGroup, Dimension, Indicator, IndicatorGroup, Template, Model, Equipment
+from mapping import EQU_INTERNAL_ID, EQU_MODEL, IG_ID, IG_INTERNAL_ID, IG_DESCRIPTION, IG_INDICATOR
+from quarantine import Quarantine
+from validation import validate_workbook
+from xlsx_patch import IdWriter, patch_ids
+
+
+# packages that acload only imports when a command needs them
+HEAVY_MODULES = ["ac_api", "catalog", "dataclasses_json", "dotenv", "loader", "marshmallow",
+    "oauthlib", "openpyxl", "requests", "requests_oauthlib"]
+
+# rows for a small workbook in the ac_sample.xlsx layout
+sheets = {
+    "Indicator": [
+        ["ID", "Indicator ID", "Indicator Description", "Data Type", "Dimension",
+            "Indicator UOM", "Expected Behaviour", "Color"],
+        [None, "voltage_out", "Output Voltage", "numeric", "VOLTAG", "V", 3, "#f2c637"],
+        [None, "temp_ambient", "Ambient Temperature", "numeric", "TEMP", "GC", 3, "#4965a3"],
+    ],
+    "Indicator Group": [
+        ["ID", "Indicator Group ID", "Indicator Group Description", "Indicators"],
+        [None, "TIG", "Transformer", "voltage_out"],
+        [None, "TIG", "Transformer", "temp_ambient"],
+    ],
+    "Model Template": [
+        ["ID", "Model Template ID", "Model Template Description", "Indicator Groups"],
+        [None, "SDT", "Single Phase Dist Transformers", "TIG"],
+    ],
+    "Model": [
+        ["ID", "Internal Id", "Model Description", "Tracking", "Parent Subclass/Model Template",
+            "Manufacturer"],
+        [None, "SDT_Model", "SDT Equipment Model", 1, "SDT", "757A046B716F46F499A94A95C70EFE0A"],
+    ],
+    "Equipment": [
+        ["ID", "Internal Id", "Equipment Description", "Model Id", "Operator", "Life Cycle"],
+        [None, "SDT0002", "SDT 0002", "SDT_Model", "BC0D934611A24E28A7B56888E55BB9F5", 2],
+    ],
+}
+
+def create_workbook(changes=None):
+    """ create the sample workbook, changes is {sheet: [rows to append]} """
+    wb = Workbook()
+    wb.remove(wb.active)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        for row in rows + (changes or {}).get(name, []):
+            ws.append(row)
+    return wb
+
+
+def test_validate_sample():
+    dims = [Dimension(dimensionId="VOLTAG", unitId="V"), Dimension(dimensionId="TEMP", unitId="GC")]
+    report = validate_workbook(create_workbook(), dims)
+    assert report.ok
+    assert report.issues == []
+
+def test_validate_errors():
+    wb = create_workbook({
+        "Indicator": [[None, "voltage_out", "Duplicate", "text", None, "V", 3, None]],
+        "Indicator Group": [[None, "IG2", "Group", "missing_indicator"]],
+        "Model": [[None, "M2", "Model 2", 7, "NOPE", None]],
+        "Equipment": [[None, "E2", "Equipment 2", "SDT_Model", "op", "9"]],
+    })
+    report = validate_workbook(wb, [Dimension(dimensionId="VOLTAG", unitId="V")])
+    messages = {(i.sheet, i.row, i.message) for i in report.errors}
+    assert ("Indicator", 2, "duplicate internal id") in messages
+    assert ("Indicator", 4, "duplicate internal id") in messages
+    assert ("Indicator", 3, "unknown dimension/UoM pair TEMP/GC") in messages
+    assert any(m.startswith("data type 'text'") for s, r, m in messages)
+    assert ("Indicator Group", 4, "'missing_indicator' is not defined in the Indicator sheet") in messages
+    assert ("Model", 3, "missing organization") in messages
+    assert ("Model", 3, "'NOPE' is not defined in the Model Template sheet") in messages
+    assert any(m.startswith("tracking '7'") for s, r, m in messages)
+    assert any(m.startswith("life cycle '9'") for s, r, m in messages)
+    assert len(report.warnings) == 1
+    assert report.rejected_rows()["Model"] == {3}
+
+def test_validate_non_contiguous_group():
+    wb = create_workbook({"Indicator Group": [[None, "IG2", "Group", "voltage_out"],
+        [None, "TIG", "Transformer", "voltage_out"]]})
+    report = validate_workbook(wb)
+    # the rows are grouped by internal id, only the repeated member is reported
+    assert [(i.row, i.severity) for i in report.issues] == [(5, "warning")]
+
+def test_group_rows():
+    ws = Workbook().active
+    for row in sheets["Indicator Group"] + [[None, "IG2", "Group", "voltage_out"],
+            ["ID2", "TIG", "Other", "temp_ambient"], [None, "TIG", "Transformer", "new"]]:
+        ws.append(row)
+    assert acload.group_rows(ws, IG_ID, IG_INTERNAL_ID, IG_DESCRIPTION, IG_INDICATOR) == {
+        "TIG": ("ID2", "Transformer", ["voltage_out", "temp_ambient", "new"]),
+        "IG2": ("", "Group", ["voltage_out"]),
+    }
+
+def test_quarantine_skips_dependents(monkeypatch, tmp_path):
+    inserted = []
+    def fake_insert(self):
+        if self.internalId == "voltage_out":
+            raise ValueError("bad indicator")
+        inserted.append(self.internalId)
+        self.id = "ID_" + self.internalId
+        return 200
+    for cls in [Indicator, IndicatorGroup, Template, Model, Equipment]:
+        monkeypatch.setattr(cls, "insert", fake_insert)
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook({"Indicator": [[None, "voltage_in", "Input", "numeric", None, None, 3, None]]}
+        ).save(datafile)
+    wb = acload.open_workbook(datafile)
+    quarantine = Quarantine()
+    indicators = acload.load_indicators(wb["Indicator"], quarantine)
+    acload.write_ids(IdWriter(datafile), indicators, wb["Indicator"])
+    indicator_groups = acload.load_indicator_groups(indicators, wb["Indicator Group"], quarantine)
+    templates = acload.load_templates(indicator_groups, wb["Model Template"], quarantine)
+    acload.load_models_and_equipment(templates, wb["Model"], wb["Equipment"], quarantine, workers=1)
+    # nothing after the failed indicator is sent to AC
+    assert inserted == ["temp_ambient", "voltage_in"]
+    assert len(quarantine) == 5
+    assert quarantine.reasons["Equipment"]["SDT0002"] == \
+        "depends on Model SDT_Model which was not loaded"
+    # the quarantine file has the failed rows and the loaded indicator they reference
+    filename = str(tmp_path / "quarantine.xlsx")
+    quarantine.save(acload.open_workbook(datafile), filename)
+    out = load_workbook(filename)
+    rows = list(out["Indicator"].iter_rows(min_row=2, values_only=True))
+    assert [(r[0], r[1], r[-1]) for r in rows] == [
+        (None, "voltage_out", "bad indicator"),
+        ("ID_temp_ambient", "temp_ambient", "reference only, already loaded")]
+    assert out["Equipment"].max_row == 2
+
+def test_models_and_equipment_pipeline(monkeypatch):
+    events = []
+    lock = threading.Lock()
+    first_equipment = threading.Event()
+    def fake_model_insert(self):
+        # the second model waits until the equipment of the first one is in
+        if self.internalId == "M2":
+            assert first_equipment.wait(5)
+        self.modelId = "ID_" + self.internalId
+        with lock:
+            events.append(("insert", self.internalId))
+        return 200
+    def fake_publish(self):
+        if self.internalId == "M3":
+            raise ValueError("not published")
+        with lock:
+            events.append(("publish", self.internalId))
+        return 200
+    def fake_equipment_insert(self):
+        with lock:
+            events.append(("equipment", self.internalId, self.modelId))
+        self.equipmentId = "ID_" + self.internalId
+        first_equipment.set()
+        return 200
+    monkeypatch.setattr(Model, "insert", fake_model_insert)
+    monkeypatch.setattr(Model, "publish", fake_publish)
+    monkeypatch.setattr(Equipment, "insert", fake_equipment_insert)
+    wb = create_workbook({
+        "Model": [[None, "M2", "Model 2", 1, "SDT", "org"], [None, "M3", "Model 3", 1, "SDT", "org"]],
+        "Equipment": [[None, "E2", "Equipment 2", "M2", "op", 2], [None, "E3", "Equipment 3", "M3", "op", 2]],
+    })
+    templates = [Template(id="TEM", internalId="SDT")]
+    quarantine = Quarantine()
+    models, equipment = acload.load_models_and_equipment(templates, wb["Model"], wb["Equipment"],
+        quarantine, workers=4)
+    # the equipment of the first model was inserted before the second model
+    assert events.index(("equipment", "SDT0002", "ID_SDT_Model")) < events.index(("insert", "M2"))
+    assert ("equipment", "E2", "ID_M2") in events
+    # the model that could not be published holds back its equipment
+    assert [e for e in events if e[0] == "equipment" and e[1] == "E3"] == []
+    assert quarantine.is_quarantined("Model", "M3")
+    assert quarantine.is_quarantined("Equipment", "E3")
+    assert [m.modelId for m in models] == ["ID_SDT_Model", "ID_M2", "ID_M3"]
+    assert len(equipment) == 3
+
+def test_failed_publish(mock_tenant):
+    mock_tenant.state.faults[r"^PUT .*/publish$"] = 500
+    wb = create_workbook()
+    quarantine = Quarantine()
+    models, equipment = acload.load_models_and_equipment([Template(id="TEM", internalId="SDT")],
+        wb["Model"], wb["Equipment"], quarantine, workers=2)
+    # the model was inserted but not published, its equipment is not inserted
+    assert models[0].modelId in mock_tenant.state.objects["models"]
+    assert quarantine.reasons["Model"]["SDT_Model"].startswith(
+        f"inserted as {models[0].modelId} but not published")
+    assert quarantine.is_quarantined("Equipment", "SDT0002")
+    assert not mock_tenant.state.objects["equipment"] and not equipment[0].equipmentId
+    results = Model.publish_many(models)
+    assert isinstance(results[models[0].modelId], ac_api.ElementCouldNotBePublished)
+
+def test_template_unresolved_attribute_group(monkeypatch):
+    inserted = []
+    def fake_insert(self):
+        inserted.append(self.internalId)
+        self.id = "ID_" + self.internalId
+        return 200
+    monkeypatch.setattr(Template, "insert", fake_insert)
+    wb = create_workbook()
+    wb["Model Template"]["E1"] = "Attribute Groups"
+    wb["Model Template"]["E2"] = "NAMEPLATE"
+    quarantine = Quarantine()
+    templates = acload.load_templates([IndicatorGroup(id="IG", internalId="TIG")],
+        wb["Model Template"], quarantine, [])
+    # the template is not created with the internal id as its attribute group
+    assert not inserted
+    assert quarantine.reasons["Model Template"]["SDT"] == "attribute group NAMEPLATE was not loaded"
+    acload.load_templates([IndicatorGroup(id="IG", internalId="TIG")], wb["Model Template"],
+        Quarantine(), [AttributeGroup(id="AG", internalId="NAMEPLATE")])
+    assert inserted == ["SDT"]
+
+def test_stream_equipment(monkeypatch, tmp_path):
+    workers = 3
+    lock = threading.Lock()
+    counts = {"read": 0, "inserted": 0, "ahead": 0}
+    def fake_resolve(equipment):
+        with lock:
+            counts["read"] += 1
+            counts["ahead"] = max(counts["ahead"], counts["read"] - counts["inserted"])
+        equipment.modelId = "ID_" + equipment.modelId
+    def fake_insert(self):
+        time.sleep(0.0002)
+        if self.internalId == "E7":
+            raise ValueError("bad equipment")
+        self.equipmentId = "ID_" + self.internalId
+        with lock:
+            counts["inserted"] += 1
+        return 200
+    monkeypatch.setattr(Equipment, "insert", fake_insert)
+    path = str(tmp_path / "data.xlsx")
+    wb = create_workbook({"Equipment": [[None, f"E{i}", f"Equipment {i}", "SDT_Model", "op", 2]
+        for i in range(6000)] + [["OLD", "E6000", "Equipment 6000", "SDT_Model", "op", 2]]})
+    wb.save(path)
+    ids = IdWriter(path)
+    quarantine = Quarantine()
+    assert acload.stream_equipment(acload.open_workbook(path)["Equipment"], fake_resolve,
+        quarantine, ids, workers) == []
+    ids.flush()
+    # the reading never got further ahead of the inserts than the queues allow
+    assert counts["read"] == 6002
+    assert counts["ahead"] <= 4 * workers + 2
+    # the file of the large sheet is rewritten once at the end, not every few thousand rows
+    assert ids.flushes == 1
+    column = [c.value for c in load_workbook(path)["Equipment"]["A"]]
+    assert column[1] == "ID_SDT0002"
+    assert column[2:4] == ["ID_E0", "ID_E1"]
+    assert column[9] is None and quarantine.is_quarantined("Equipment", "E7")
+    assert column[-1] == "OLD"
+    # without a writer the equipment is returned in the order of the sheet
+    index = acload.model_index([Model(internalId="SDT_Model", modelId="M")])
+    quarantine = Quarantine()
+    equipment = acload.stream_equipment(acload.open_workbook(path)["Equipment"],
+        lambda e: acload.resolve_equipment_model(e, index, quarantine), quarantine, workers=workers)
+    assert [e.internalId for e in equipment[:3]] == ["SDT0002", "E0", "E1"]
+    assert equipment[0].modelId == "M"
+
+def test_profile(mock_tenant, tmp_path, capsys):
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    prefix = str(tmp_path / "profile")
+    acload.cli.main(["--profile", "--profile-output", prefix, "load", datafile],
+        standalone_mode=False)
+    # the report has the stages and the requests
+    report = capsys.readouterr().out
+    assert re.search(r"^indicators +1 ", report, re.M)
+    assert re.search(r"^models and equipment +1 ", report, re.M)
+    assert re.search(r"^POST indicators +2 ", report, re.M)
+    assert re.search(r"^PUT models +1 ", report, re.M)
+    assert (tmp_path / "profile.prof").exists()
+    # folded stacks are "frame;frame;... count"
+    for line in open(prefix + ".folded"):
+        assert line.rsplit(" ", 1)[1].strip().isdigit()
+
+def test_patch_ids(tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    wb = create_workbook()
+    wb["Indicator"]["A2"].font = Font(bold=True)
+    wb["Indicator"]["A3"] = "OLD"
+    wb.save(path)
+    patch_ids(path, {"Indicator": {2: "ID<1>", 3: ""}, "Equipment": {2: "E1"}})
+    out = load_workbook(path)
+    assert [c.value for c in out["Indicator"]["A"]] == ["ID", "ID<1>", None]
+    assert out["Indicator"]["A2"].font.bold
+    assert out["Indicator"]["B2"].value == "voltage_out"
+    assert out["Equipment"]["A2"].value == "E1"
+    assert out["Model"]["A2"].value is None
+    # the streamed workbook reads the patched file and closes it at the end of the block
+    with acload.stream_workbook(path) as wb:
+        assert [row[0] for row in wb["Indicator"].iter_rows(min_row=2, values_only=True)] == \
+            ["ID<1>", None]
+        archive = wb._archive
+    assert archive.fp is None
+
+def test_id_writer_flushes(tmp_path, monkeypatch):
+    import xlsx_patch
+    path = str(tmp_path / "data.xlsx")
+    create_workbook().save(path)
+    ids = IdWriter(path)
+    ids.add("Indicator", {2: "A"})
+    assert ids.flushes == 0
+    ids.add("Indicator", {3: "B"})
+    ids.flush()
+    assert ids.flushes == 1
+    assert [c.value for c in load_workbook(path)["Indicator"]["A"]] == ["ID", "A", "B"]
+    # a checkpoint patches in the background and the next one waits ten times the patch time
+    patch_ids = xlsx_patch.patch_ids
+    def slow_patch(path, updates):
+        time.sleep(0.2)
+        patch_ids(path, updates)
+    monkeypatch.setattr(xlsx_patch, "patch_ids", slow_patch)
+    ids = IdWriter(path, checkpoint_interval=0)
+    start = time.monotonic()
+    for n in range(1000):
+        ids.add("Indicator", {2 + n % 2: f"I{n}"})
+        if n == 0:
+            # the first add starts a checkpoint
+            time.sleep(0.3)
+    assert time.monotonic() - start < 1.0
+    ids.flush()
+    assert ids.flushes == 2
+    assert [c.value for c in load_workbook(path)["Indicator"]["A"]] == ["ID", "I998", "I999"]
+
+def test_load_and_delete_write_ids(mock_tenant, tmp_path):
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    wb = load_workbook(datafile)
+    objects = mock_tenant.state.objects
+    assert {wb["Indicator"]["A2"].value, wb["Indicator"]["A3"].value} == set(objects["indicators"])
+    # both rows of the indicator group have its id
+    assert wb["Indicator Group"]["A2"].value == wb["Indicator Group"]["A3"].value
+    assert wb["Equipment"]["A2"].value in objects["equipment"]
+    acload.cli.main(["delete", datafile], standalone_mode=False)
+    wb = load_workbook(datafile)
+    assert all(not objects[name] for name in objects)
+    assert all(wb[sheet]["A2"].value is None for sheet in sheets)
+
+def test_catalog(mock_tenant, tmp_path):
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    catalog_file = str(tmp_path / "catalog.db")
+    acload.cli.main(["catalog", catalog_file, "--page-size", "1"], standalone_mode=False)
+    cat = Catalog(catalog_file)
+    assert cat.counts() == {"indicators": 2, "indicatorgroups": 1, "templates": 1, "models": 1,
+        "equipment": 1}
+    model_id = cat.lookup("models", "SDT_Model")
+    assert model_id in mock_tenant.state.objects["models"]
+    assert cat.get("models", "SDT_Model").modelId == model_id
+    assert len(cat.dimensions()) == 2
+    # only the objects changed since the last refresh are read again
+    assert cat.refresh(["equipment"]) == {"equipment": 1}
+    # equipment for a model that is in AC but not in the workbook
+    wb = create_workbook()
+    wb["Model"].delete_rows(2)
+    wb["Equipment"].delete_rows(2)
+    wb["Equipment"].append([None, "SDT0003", "SDT 0003", "SDT_Model", "op", 2])
+    assert not validate_workbook(wb).ok
+    report = validate_workbook(wb, catalog=cat)
+    assert report.ok
+    assert any(i.message.startswith("already in AC as ") for i in report.warnings)
+    known_models = acload.with_catalog([], cat, "models", wb["Equipment"], EQU_MODEL)
+    _, equipment = acload.load_models_and_equipment([], wb["Model"], wb["Equipment"],
+        Quarantine(), 2, known_models)
+    assert equipment[0].modelId == model_id
+    assert equipment[0].equipmentId in mock_tenant.state.objects["equipment"]
+    # the ids of the equipment that the workbook references and that is only in the catalog
+    equipment_ids = acload.with_catalog_ids({"SDT0003": equipment[0].equipmentId}, cat, "equipment",
+        create_workbook()["Equipment"], EQU_INTERNAL_ID)
+    assert equipment_ids == {"SDT0003": equipment[0].equipmentId,
+        "SDT0002": cat.lookup("equipment", "SDT0002")}
+
+def test_startup_imports():
+    # acload --help must not import the heavy packages or read the .env file
+    code = ("import json, sys, acload\n"
+        "acload.cli.main(['--help'], standalone_mode=False)\n"
+        "print(json.dumps(sorted(m for m in sys.modules if m.split('.')[0] in %r)))" % (HEAVY_MODULES,))
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(acload.__file__))).stdout
+    assert json.loads(out.splitlines()[-1]) == []
+
+def test_daemon(mock_tenant, tmp_path):
+    from daemon import Daemon, LimitedTransport, submit
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    socket_path = str(tmp_path / "acload.sock")
+    daemon = Daemon(max_jobs=2, max_requests=4)
+    try:
+        assert isinstance(ac_api.transport, LimitedTransport)
+        daemon.warm()
+        daemon.serve_socket(socket_path)
+        result = submit({"command": "load", "args": [datafile]}, socket_path)
+        assert result["exit_code"] == 0, result["output"]
+        assert result["output"].startswith(f"Opening {datafile}")
+        assert load_workbook(datafile)["Equipment"]["A2"].value in mock_tenant.state.objects["equipment"]
+        assert submit({"command": "export", "args": []}, socket_path)["exit_code"] == 2
+        # a job file in the watched folder
+        drop_dir = tmp_path / "jobs"
+        drop_dir.mkdir()
+        daemon.watch(str(drop_dir), interval=0.05)
+        (drop_dir / "delete.tmp").write_text(json.dumps({"command": "delete", "args": [datafile]}))
+        os.replace(drop_dir / "delete.tmp", drop_dir / "delete.json")
+        for _ in range(200):
+            if (drop_dir / "delete.done").exists():
+                break
+            time.sleep(0.05)
+        result = json.loads((drop_dir / "delete.result.json").read_text())
+        assert result["exit_code"] == 0, result["output"]
+        assert not mock_tenant.state.objects["equipment"]
+        assert daemon.jobs == 2
+        # bad job files are moved aside and the folder is still polled
+        (drop_dir / "broken.json").write_text("{")
+        (drop_dir / "list.json").write_text("[]")
+        (drop_dir / "validate.json").write_text(json.dumps({"command": "validate", "args": [datafile]}))
+        for _ in range(200):
+            if (drop_dir / "validate.done").exists():
+                break
+            time.sleep(0.05)
+        assert (drop_dir / "broken.failed").exists() and (drop_dir / "list.failed").exists()
+        assert json.loads((drop_dir / "broken.result.json").read_text())["exit_code"] == 2
+        assert json.loads((drop_dir / "validate.result.json").read_text())["exit_code"] == 0
+        # the requests of a job are counted in its metrics
+        result = submit({"command": "load", "args": [datafile], "priority": "high"}, socket_path)
+        assert result["exit_code"] == 0, result["output"]
+        assert result["metrics"]["priority"] == "high"
+        assert result["metrics"]["requests"] >= 5
+        assert submit({"command": "load", "args": [datafile], "priority": "urgent"},
+            socket_path)["exit_code"] == 2
+    finally:
+        daemon.close()
+    assert ac_api.transport is None
+    assert not os.path.exists(socket_path)
+
+def test_fair_scheduler():
+    from daemon import FairScheduler, JobStats
+    scheduler = FairScheduler(max_requests=2)
+    jobs = {"bulk": JobStats(1, "load", "low"), "light": JobStats(2, "load", "normal"),
+        "heavy": JobStats(3, "load", "normal", weight=3.0)}
+    stop = threading.Event()
+
+    def send(job, count=None):
+        n = 0
+        while not stop.is_set() and (count is None or n < count):
+            scheduler.acquire(job)
+            time.sleep(0.002)
+            scheduler.release(job)
+            n += 1
+
+    threads = [threading.Thread(target=send, args=(job,)) for job in jobs.values() for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.3)
+    # a small urgent job gets the next free slots
+    urgent = JobStats(4, "validate", "high")
+    send(urgent, 10)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert urgent.request_wait / urgent.requests < 0.01
+    # the low priority job only gets the slots that the others do not wait for
+    assert jobs["bulk"].requests < jobs["light"].requests
+    # the weights share the slots of the same priority
+    assert 2.0 < jobs["heavy"].requests / jobs["light"].requests < 4.5
+
+def test_scheduler_aging(mock_tenant):
+    from daemon import Daemon, FairScheduler, JobStats
+    # the low priority job still gets slots while the high one keeps them all busy
+    scheduler = FairScheduler(max_requests=1, aging=0.02)
+    high, low = JobStats(1, "load", "high"), JobStats(2, "load", "low")
+    stop = threading.Event()
+    def send(job):
+        while not stop.is_set():
+            scheduler.acquire(job)
+            time.sleep(0.002)
+            scheduler.release(job)
+    threads = [threading.Thread(target=send, args=(job,)) for job in [high] * 4 + [low] * 2]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.4)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert 0 < low.requests < high.requests
+    # a queued job moves up while it waits and a job waiting for its workbook does not hold a thread
+    daemon = Daemon(max_jobs=2, job_aging=0.05)
+    try:
+        started = []
+        release = threading.Event()
+        def job(name, block=False):
+            def run():
+                started.append(name)
+                if block:
+                    assert release.wait(5)
+            return run
+        first = [daemon._enqueue("normal", job(f"busy{n}", True)) for n in range(2)]
+        low = daemon._enqueue("low", job("low"))
+        time.sleep(0.15)
+        high = daemon._enqueue("high", job("high"))
+        release.set()
+        for future in first + [low, high]:
+            future.result(5)
+        assert started.index("low") < started.index("high")
+        release.clear()
+        book = daemon._enqueue("normal", job("book1", True), "a.xlsx")
+        same = daemon._enqueue("normal", job("book2"), "a.xlsx")
+        other = daemon._enqueue("normal", job("other"), "b.xlsx")
+        other.result(5)
+        assert "book2" not in started
+        release.set()
+        book.result(5), same.result(5)
+        assert started[-1] == "book2"
+    finally:
+        daemon.close()
+
+def test_builder(mock_tenant):
+    from builder import Builder
+    builder = Builder(workers=4, batch_size=2)
+    builder.add("Indicator", [
+        {"internalId": "voltage_out", "description": "Output Voltage", "dataType": "numeric",
+            "dimension1": "VOLTAG", "indicatorUom": "V", "expectedBehaviour": 3},
+        {"internalId": "temp_ambient", "description": "Ambient Temperature", "dataType": "numeric"},
+    ])
+    # one member per record, merged by internal id
+    builder.add("Indicator Group", [
+        {"internalId": "TIG", "description": "Transformer", "indicators": "voltage_out"},
+        {"internalId": "TIG", "indicators": ["temp_ambient", "voltage_out"]},
+        {"internalId": "BAD", "description": "Unknown", "indicators": "missing"},
+    ])
+    builder.add("Model Template", [
+        {"internalId": "SDT", "description": "Transformers", "indicatorGroups": "TIG"},
+        {"internalId": "BAD_T", "description": "Bad", "indicatorGroups": "BAD"},
+    ])
+    builder.add("Model", [{"internalId": "SDT_Model", "description": "SDT Model", "templates": "SDT"}])
+    builder.add("Equipment", [
+        {"internalId": f"SDT{n:04}", "description": f"SDT {n}", "modelId": "SDT_Model"}
+        for n in range(5)])
+    result = builder.build()
+    objects = mock_tenant.state.objects
+    assert len(objects["indicators"]) == 2 and len(objects["indicatorgroups"]) == 1
+    group = objects["indicatorgroups"][result.ids("Indicator Group")["TIG"]]
+    assert len(group["indicators"]) == 2
+    assert set(result.ids("Equipment").values()) == set(objects["equipment"])
+    errors = {row["internalId"]: row["error"] for row in result.errors()}
+    assert errors == {"BAD": "Indicator missing is not in AC",
+        "BAD_T": "depends on Indicator Group BAD which was not loaded"}
+    with pytest.raises(ValueError):
+        Builder().add("Equipment", [{"internalId": "E", "serial": "1"}])
+    # a model that AC does not publish holds back its equipment
+    mock_tenant.state.faults[r"^PUT .*/publish$"] = 503
+    builder = Builder()
+    builder.add("Model Template", [{"internalId": "SDT", "id": result.ids("Model Template")["SDT"]}])
+    builder.add("Model", [{"internalId": "M2", "description": "Model 2", "templates": "SDT"}])
+    builder.add("Equipment", [{"internalId": "E2", "description": "E 2", "modelId": "M2"}])
+    result = builder.build()
+    errors = {row["internalId"]: row["error"] for row in result.errors()}
+    assert errors["M2"].startswith(f"inserted as {result.ids('Model')['M2']} but not published")
+    assert errors["E2"] == "depends on Model M2 which was not loaded"
+    assert len(objects["equipment"]) == 5
+
+def test_load_attributes(mock_tenant, tmp_path):
+    wb = create_workbook()
+    ws = wb.create_sheet("Attribute")
+    for row in [["ID", "Attribute ID", "Attribute Description", "Data Type", "Dimension", "UOM"],
+            [None, "rated_voltage", "Rated Voltage", "numeric", "VOLTAG", "V"],
+            [None, "vendor", "Vendor", "string", None, None]]:
+        ws.append(row)
+    ws = wb.create_sheet("Attribute Group")
+    for row in [["ID", "Attribute Group ID", "Attribute Group Description", "Attribute"],
+            [None, "NAMEPLATE", "Nameplate", "rated_voltage"],
+            [None, "NAMEPLATE", "Nameplate", "vendor"]]:
+        ws.append(row)
+    wb["Model Template"]["E1"] = "Attribute Groups"
+    wb["Model Template"].append([None, "SDT", "Single Phase Dist Transformers", None, "NAMEPLATE"])
+    wb["Equipment"].append([None, "SDT0003", "SDT 0003", "SDT_Model", "op", 2])
+    ws = wb.create_sheet("Attribute Value")
+    ws.append(["Equipment", "Attribute Group", "Attribute", "Value"])
+    for equipment in ["SDT0002", "SDT0003"]:
+        ws.append([equipment, "NAMEPLATE", "rated_voltage", 230])
+        ws.append([equipment, "NAMEPLATE", "vendor", "ACME"])
+    assert validate_workbook(wb).ok
+    datafile = str(tmp_path / "data.xlsx")
+    wb.save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    state = mock_tenant.state
+    objects = state.objects
+    assert len(objects["attributes"]) == 2 and len(objects["attributegroups"]) == 1
+    group_id = next(iter(objects["attributegroups"]))
+    template = next(iter(objects["templates"].values()))
+    assert template["attributeGroups"] == [{"id": group_id}]
+    wb = load_workbook(datafile)
+    assert wb["Attribute Group"]["A2"].value == wb["Attribute Group"]["A3"].value == group_id
+    # the values of both equipment in one request
+    voltage = next(id for id, a in objects["attributes"].items() if a["internalId"] == "rated_voltage")
+    assert {id: values[(group_id, voltage)] for id, values in state.values.items()} == \
+        {wb["Equipment"]["A2"].value: "230", wb["Equipment"]["A3"].value: "230"}
+    requests = state.requests
+    acload.load_attribute_values(acload.read_equipment_ids(wb["Equipment"]),
+        acload.load_attribute_groups([], wb["Attribute Group"]), acload.load_attributes(wb["Attribute"]),
+        wb["Attribute Value"])
+    assert state.requests == requests + 1
+    acload.cli.main(["delete", datafile], standalone_mode=False)
+    assert not objects["attributes"] and not objects["attributegroups"]
+
+def test_validate_attribute_values():
+    wb = create_workbook()
+    ws = wb.create_sheet("Attribute")
+    ws.append(["ID", "Attribute ID", "Attribute Description", "Data Type", "Dimension", "UOM"])
+    ws.append([None, "vendor", "Vendor", "string", None, None])
+    ws = wb.create_sheet("Attribute Group")
+    ws.append(["ID", "Attribute Group ID", "Attribute Group Description", "Attribute"])
+    ws.append([None, "NAMEPLATE", "Nameplate", "vendor"])
+    ws = wb.create_sheet("Attribute Value")
+    ws.append(["Equipment", "Attribute Group", "Attribute", "Value"])
+    ws.append(["SDT0002", "NAMEPLATE", "vendor", "ACME"])
+    ws.append(["SDT0002", "NAMEPLATE", "vendor", "ACME Corp"])
+    ws.append(["SDT0009", "NAMEPLATE", "color", "red"])
+    report = validate_workbook(wb)
+    messages = sorted((i.row, i.message) for i in report.issues if i.sheet == "Attribute Value")
+    assert messages == [(3, "'vendor' has more than one value, the last one is written"),
+        (4, "'SDT0009' is not defined in the Equipment sheet"),
+        (4, "'color' is not defined in the Attribute sheet"),
+        (4, "'color' is not in attribute group 'NAMEPLATE'")]
+    assert not report.ok
+
+def test_ingest(mock_tenant, tmp_path, monkeypatch):
+    import ingest
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    readings = tmp_path / "readings.csv"
+    with open(readings, "w") as f:
+        f.write("timestamp,equipment,indicator,value\n")
+        for n in range(2500):
+            f.write(f"2024-01-01T00:{n // 60 % 60:02}:{n % 60:02}Z,SDT0002,voltage_out,{230 + n % 5}\n")
+        f.write("2024-01-01T00:00:00Z,SDT9999,voltage_out,1\n")
+        # a block of blank rows longer than a chunk, then a short row
+        f.write("\n" * 1200)
+        f.write("2024-01-01T01:00:00Z,SDT0002\n")
+        f.write("2024-01-01T01:00:01Z,SDT0002,voltage_out,231\n")
+    # the first request fails and is retried
+    calls = []
+    post_readings = ingest.post_readings
+    def flaky_post(readings):
+        calls.append(len(readings))
+        return 503 if len(calls) == 1 else post_readings(readings)
+    monkeypatch.setattr(ingest, "post_readings", flaky_post)
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    rejects = tmp_path / "rejects.csv"
+    stats = ingest.ingest(str(readings), batch_size=500, workers=2, chunk_size=1000,
+        rejects=str(rejects))
+    assert (stats.read, stats.posted, stats.skipped, stats.failed, stats.retries) == (2503, 2501, 2, 0, 1)
+    state = mock_tenant.state
+    assert len(state.readings) == 2501
+    assert {r["equipmentId"] for r in state.readings} == set(state.objects["equipment"])
+    assert state.readings[0]["value"] == 230.0
+    lines = rejects.read_text().splitlines()
+    assert lines[1].startswith("SDT9999,voltage_out,")
+    assert lines[2] == "2024-01-01T01:00:00Z,SDT0002,malformed row"
+
+def test_response_cache_option(mock_tenant, tmp_path, capsys):
+    import ac_api
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    cache_file = tmp_path / "cache.json"
+    try:
+        for _ in range(2):
+            acload.cli.main(["--response-cache-file", str(cache_file), "diff", datafile],
+                standalone_mode=False)
+        # the second run revalidates the lookups of the first one
+        out = capsys.readouterr().out
+        assert "response cache: 0 hit(s)" in out
+        assert re.search(r"response cache: [1-9]\d* hit\(s\), 0 miss\(es\), hit rate 100%", out)
+        assert json.loads(cache_file.read_text())
+    finally:
+        ac_api.disable_response_cache()
+
+def test_diff(mock_tenant, tmp_path, capsys):
+    import json
+    from openpyxl import load_workbook
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook().save(datafile)
+    acload.cli.main(["load", datafile], standalone_mode=False)
+    acload.cli.main(["diff", datafile], standalone_mode=False)
+    assert "Equipment: 1 in sync, 0 missing, 0 different, 0 orphaned" in capsys.readouterr().out
+    # change an indicator and a group in AC, add an object that is not in the workbook
+    objects = mock_tenant.state.objects
+    indicator = next(o for o in objects["indicators"].values() if o["internalId"] == "voltage_out")
+    indicator["dataType"] = "string"
+    group = next(iter(objects["indicatorgroups"].values()))
+    group["indicators"] = [indicator["id"]]
+    objects["models"]["X"] = {"modelId": "X", "internalId": "OTHER_Model", "description": "Other"}
+    wb = load_workbook(datafile)
+    wb["Equipment"].append([None, "SDT0003", "SDT 0003", "SDT_Model", "op", 2])
+    wb.save(datafile)
+    changes = tmp_path / "changes.jsonl"
+    with pytest.raises(SystemExit):
+        acload.cli.main(["diff", datafile, "--changes", str(changes)], standalone_mode=False)
+    out = capsys.readouterr().out
+    assert "Indicator: different voltage_out: dataType 'string' in AC, 'numeric' in the workbook" in out
+    assert "Indicator Group: different TIG: indicators [voltage_out] in AC, " \
+        "[temp_ambient, voltage_out] in the workbook" in out
+    assert "Model: orphaned OTHER_Model (id X)" in out
+    assert "Equipment: 1 in sync, 1 missing, 0 different, 0 orphaned" in out
+    lines = [json.loads(line) for line in changes.read_text().splitlines()]
+    assert [(c["action"], c["internalId"]) for c in lines] == [("update", "voltage_out"),
+        ("update", "TIG"), ("delete", "OTHER_Model"), ("insert", "SDT0003")]
+    assert lines[0]["values"] == {"dataType": "numeric"}
+    assert lines[3]["values"]["modelId"] == ["SDT_Model"]
+
+def test_load_auto_tune(mock_tenant, tmp_path, capsys):
+    datafile = str(tmp_path / "data.xlsx")
+    create_workbook({"Equipment": [[None, f"E{n}", f"Equipment {n}", "SDT_Model", "op", 2]
+        for n in range(20)]}).save(datafile)
+    acload.cli.main(["--auto-tune", "--max-workers", "16", "load", datafile, "--workers", "2"],
+        standalone_mode=False)
+    out = capsys.readouterr().out
+    assert len(mock_tenant.state.objects["equipment"]) == 21
+    # the summary has the limit of each entity type
+    assert "auto-tuned concurrency:" in out
+    assert re.search(r"POST:equipment: \d+ in flight \(\d+-\d+\), 21 request\(s\)", out)
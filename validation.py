@@ -0,0 +1,307 @@
+"""Pre-flight validation of an ACLoad workbook
+
+Checks every sheet of the workbook before anything is sent to Asset Central
+so that bad rows are reported together instead of failing one POST at a time.
+No calls are made to the ACAPI; dimensions are checked against a cached list
+and, with a local catalog (see catalog.py), references to objects that are
+already in AC are accepted.
+
+"""
+
+# standard imports
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+
+# local imports
+from mapping import *
+
+
+# allowed codes for the coded fields in the workbook
+DATA_TYPES = {"numeric", "numericflexible", "string", "boolean", "date"}
+LIFE_CYCLES = {"1", "2", "3", "4"}
+EQUIPMENT_TRACKING = {"1", "2"}
+
+ERROR = "error"
+WARNING = "warning"
+
+
+@dataclass
+class ValidationIssue():
+    """ A single problem found in the workbook
+    Attributes:
+        sheet: name of the worksheet
+        row: 1-based row number in the worksheet
+        internal_id: internal id of the row (if any)
+        message: description of the problem
+        severity: error or warning
+    """
+    sheet: str
+    row: int
+    internal_id: str
+    message: str
+    severity: str = ERROR
+
+    def __str__(self):
+        return f"{self.severity}: {self.sheet} row {self.row} ({self.internal_id}): {self.message}"
+
+
+@dataclass
+class ValidationReport():
+    """ Result of validating a workbook """
+    issues: List[ValidationIssue] = field(default_factory=list)
+
+    @property
+    def errors(self):
+        return [issue for issue in self.issues if issue.severity == ERROR]
+
+    @property
+    def warnings(self):
+        return [issue for issue in self.issues if issue.severity == WARNING]
+
+    @property
+    def ok(self):
+        """ true if there is nothing that would make the load fail """
+        return not self.errors
+
+    def add(self, sheet, row, internal_id, message, severity=ERROR):
+        self.issues.append(ValidationIssue(sheet, row, internal_id, message, severity))
+
+    def rejected_rows(self) -> Dict[str, Set[int]]:
+        """ rows with errors, keyed by sheet name """
+        rejected = {}
+        for issue in self.errors:
+            rejected.setdefault(issue.sheet, set()).add(issue.row)
+        return rejected
+
+    def summary(self):
+        lines = [str(issue) for issue in sorted(self.issues, key=lambda i: (i.sheet, i.row))]
+        lines.append(f"{len(self.errors)} error(s), {len(self.warnings)} warning(s)")
+        return "\n".join(lines)
+
+
+def normalize_code(value):
+    """ normalize a coded cell value (openpyxl returns 2 or 2.0 for '2') """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "" if value is None else str(value).strip()
+
+
+def _read_columns(worksheet, width):
+    """ read the sheet into columns, skipping blank rows
+
+    Returns:
+        list of row numbers and a list of columns (one list of values per column)
+    """
+    rows = []
+    columns = [[] for _ in range(width)]
+    for row_number, row in enumerate(worksheet.iter_rows(min_row=2, max_col=width, values_only=True), 2):
+        if all(value is None or value == "" for value in row):
+            continue
+        rows.append(row_number)
+        for column, value in zip(columns, row):
+            column.append(value)
+    return rows, columns
+
+
+def _check_required(report, sheet, rows, ids, columns, required):
+    for name, column in required.items():
+        for row, internal_id, value in zip(rows, ids, columns[column]):
+            if value is None or str(value).strip() == "":
+                report.add(sheet, row, internal_id, f"missing {name}")
+
+
+def _check_codes(report, sheet, rows, ids, values, allowed, name):
+    for row, internal_id, value in zip(rows, ids, values):
+        code = normalize_code(value)
+        if code and code not in allowed:
+            report.add(sheet, row, internal_id, f"{name} '{code}' is not one of {sorted(allowed)}")
+
+
+def _check_unique(report, sheet, rows, ids):
+    counts = Counter(i for i in ids if i)
+    for row, internal_id in zip(rows, ids):
+        if counts[internal_id] > 1:
+            report.add(sheet, row, internal_id, "duplicate internal id")
+
+
+def _check_references(report, sheet, rows, ids, refs, known: Set, target_sheet, remote=None):
+    for row, internal_id, ref in zip(rows, ids, refs):
+        if ref and ref not in known and (remote is None or ref not in remote):
+            report.add(sheet, row, internal_id, f"'{ref}' is not defined in the {target_sheet} sheet")
+
+
+def _check_dimensions(report, sheet, rows, ids, dims, uoms, pairs):
+    """ checks the dimension and UoM pairs, against the known pairs if there are any """
+    for row, internal_id, dim, uom in zip(rows, ids, dims, uoms):
+        if bool(dim) != bool(uom):
+            report.add(sheet, row, internal_id,
+                "dimension and UoM must be given together (neither will be loaded)", WARNING)
+        elif dim and pairs is not None and (dim, uom) not in pairs:
+            report.add(sheet, row, internal_id, f"unknown dimension/UoM pair {dim}/{uom}")
+
+
+def _check_existing(report, sheet, rows, ids, row_ids, remote):
+    """ warn about rows without an id for objects that are already in AC """
+    if remote is None:
+        return
+    for row, internal_id, row_id in zip(rows, ids, row_ids):
+        if not row_id and internal_id in remote:
+            report.add(sheet, row, internal_id,
+                f"already in AC as {remote[internal_id]}, the insert will fail", WARNING)
+
+
+def _check_groups(report, sheet, rows, ids, members, descriptions):
+    """ checks the one-row-per-member sheets (indicator groups and templates) """
+    # the rows of an object may be anywhere in the sheet, the loader groups them by internal id
+    seen_members = set()
+    first_description = {}
+    for row, internal_id, member, desc in zip(rows, ids, members, descriptions):
+        if (internal_id, member) in seen_members:
+            report.add(sheet, row, internal_id, f"'{member}' is listed more than once", WARNING)
+        seen_members.add((internal_id, member))
+        if first_description.setdefault(internal_id, desc) != desc:
+            report.add(sheet, row, internal_id,
+                "description differs from the first row and will be ignored", WARNING)
+
+
+def validate_workbook(wb, dimensions: Optional[Iterable] = None, catalog=None) -> ValidationReport:
+    """ Validate all of the sheets in the workbook
+
+    Args:
+        wb - the workbook to be loaded
+        dimensions - optional list of Dimension objects (e.g. from read_dimensions)
+            used to check the indicator dimension and UoM pairs
+        catalog - optional Catalog of the objects in AC, references to them are
+            accepted and its dimensions are used if none are given
+
+    Returns:
+        ValidationReport with every issue that was found
+    """
+    report = ValidationReport()
+    remote = {}
+    if catalog is not None:
+        remote = {collection: catalog.ids(collection) for collection in
+            ["indicators", "indicatorgroups", "templates", "models", "equipment"]}
+        if dimensions is None:
+            # an empty list means the dimensions were never refreshed
+            dimensions = catalog.dimensions() or None
+
+    pairs = None
+    if dimensions is not None:
+        pairs = {(d.dimensionId, d.unitId) for d in dimensions}
+
+    # attributes and attribute groups, the sheets are optional
+    att_ids = []
+    ag_ids = []
+    ag_members = {}
+    sheet = "Attribute"
+    if sheet in wb.sheetnames:
+        rows, cols = _read_columns(wb[sheet], ATT_UOM + 1)
+        att_ids = cols[ATT_INTERNAL_ID]
+        _check_required(report, sheet, rows, att_ids, cols, {"internal id": ATT_INTERNAL_ID,
+            "description": ATT_DESCRIPTION, "data type": ATT_DATA_TYPE})
+        _check_unique(report, sheet, rows, att_ids)
+        _check_codes(report, sheet, rows, att_ids, cols[ATT_DATA_TYPE], DATA_TYPES, "data type")
+        _check_dimensions(report, sheet, rows, att_ids, cols[ATT_DIMENSION], cols[ATT_UOM], pairs)
+    sheet = "Attribute Group"
+    if sheet in wb.sheetnames:
+        rows, cols = _read_columns(wb[sheet], AG_ATTRIBUTE + 1)
+        ag_ids = cols[AG_INTERNAL_ID]
+        _check_required(report, sheet, rows, ag_ids, cols, {"internal id": AG_INTERNAL_ID,
+            "description": AG_DESCRIPTION, "attribute": AG_ATTRIBUTE})
+        _check_references(report, sheet, rows, ag_ids, cols[AG_ATTRIBUTE], set(att_ids), "Attribute")
+        _check_groups(report, sheet, rows, ag_ids, cols[AG_ATTRIBUTE], cols[AG_DESCRIPTION])
+        for internal_id, attribute in zip(ag_ids, cols[AG_ATTRIBUTE]):
+            ag_members.setdefault(internal_id, set()).add(attribute)
+
+    # indicators
+    sheet = "Indicator"
+    rows, cols = _read_columns(wb[sheet], IND_COLOR + 1)
+    ind_ids = cols[IND_INTERNAL_ID]
+    _check_required(report, sheet, rows, ind_ids, cols, {"internal id": IND_INTERNAL_ID,
+        "description": IND_DESCRIPTION, "data type": IND_DATA_TYPE})
+    _check_unique(report, sheet, rows, ind_ids)
+    _check_existing(report, sheet, rows, ind_ids, cols[IND_ID], remote.get("indicators"))
+    _check_codes(report, sheet, rows, ind_ids, cols[IND_DATA_TYPE], DATA_TYPES, "data type")
+    _check_dimensions(report, sheet, rows, ind_ids, cols[IND_DIMENSION], cols[IND_UOM], pairs)
+
+    # indicator groups
+    sheet = "Indicator Group"
+    rows, cols = _read_columns(wb[sheet], IG_INDICATOR + 1)
+    ig_ids = cols[IG_INTERNAL_ID]
+    _check_required(report, sheet, rows, ig_ids, cols, {"internal id": IG_INTERNAL_ID,
+        "description": IG_DESCRIPTION, "indicator": IG_INDICATOR})
+    _check_references(report, sheet, rows, ig_ids, cols[IG_INDICATOR], set(ind_ids), "Indicator",
+        remote.get("indicators"))
+    _check_existing(report, sheet, rows, ig_ids, cols[IG_ID], remote.get("indicatorgroups"))
+    _check_groups(report, sheet, rows, ig_ids, cols[IG_INDICATOR], cols[IG_DESCRIPTION])
+
+    # templates
+    sheet = "Model Template"
+    rows, cols = _read_columns(wb[sheet], TEM_ATTRIBUTE_GROUP + 1)
+    tem_ids = cols[TEM_INTERNAL_ID]
+    _check_required(report, sheet, rows, tem_ids, cols, {"internal id": TEM_INTERNAL_ID,
+        "description": TEM_DESCRIPTION})
+    # a row lists an indicator group, an attribute group (optional column E) or both
+    for row, internal_id, ig, ag in zip(rows, tem_ids, cols[TEM_INDICATOR_GROUP],
+            cols[TEM_ATTRIBUTE_GROUP]):
+        if not ig and not ag:
+            report.add(sheet, row, internal_id, "missing indicator group or attribute group")
+    _check_references(report, sheet, rows, tem_ids, cols[TEM_INDICATOR_GROUP], set(ig_ids),
+        "Indicator Group", remote.get("indicatorgroups"))
+    _check_references(report, sheet, rows, tem_ids, cols[TEM_ATTRIBUTE_GROUP], set(ag_ids),
+        "Attribute Group")
+    _check_existing(report, sheet, rows, tem_ids, cols[TEM_ID], remote.get("templates"))
+    _check_groups(report, sheet, rows, tem_ids, cols[TEM_INDICATOR_GROUP], cols[TEM_DESCRIPTION])
+
+    # models
+    sheet = "Model"
+    rows, cols = _read_columns(wb[sheet], MOD_ORG + 1)
+    mod_ids = cols[MOD_INTERNAL_ID]
+    _check_required(report, sheet, rows, mod_ids, cols, {"internal id": MOD_INTERNAL_ID,
+        "description": MOD_DESCRIPTION, "tracking": MOD_TRACKING, "template": MOD_TEMPLATE,
+        "organization": MOD_ORG})
+    _check_unique(report, sheet, rows, mod_ids)
+    _check_codes(report, sheet, rows, mod_ids, cols[MOD_TRACKING], EQUIPMENT_TRACKING, "tracking")
+    _check_references(report, sheet, rows, mod_ids, cols[MOD_TEMPLATE], set(tem_ids),
+        "Model Template", remote.get("templates"))
+    _check_existing(report, sheet, rows, mod_ids, cols[MOD_ID], remote.get("models"))
+
+    # equipment
+    sheet = "Equipment"
+    rows, cols = _read_columns(wb[sheet], EQU_LIFECYCLE + 1)
+    equ_ids = cols[EQU_INTERNAL_ID]
+    _check_required(report, sheet, rows, equ_ids, cols, {"internal id": EQU_INTERNAL_ID,
+        "description": EQU_DESCRIPTION, "model": EQU_MODEL, "operator": EQU_OPERATOR,
+        "life cycle": EQU_LIFECYCLE})
+    _check_unique(report, sheet, rows, equ_ids)
+    _check_codes(report, sheet, rows, equ_ids, cols[EQU_LIFECYCLE], LIFE_CYCLES, "life cycle")
+    _check_references(report, sheet, rows, equ_ids, cols[EQU_MODEL], set(mod_ids), "Model",
+        remote.get("models"))
+    _check_existing(report, sheet, rows, equ_ids, cols[EQU_ID], remote.get("equipment"))
+
+    # attribute values, one row per equipment and attribute
+    sheet = "Attribute Value"
+    if sheet in wb.sheetnames:
+        rows, cols = _read_columns(wb[sheet], VAL_VALUE + 1)
+        val_equipment = cols[VAL_EQUIPMENT]
+        _check_required(report, sheet, rows, val_equipment, cols, {"equipment": VAL_EQUIPMENT,
+            "attribute group": VAL_ATTRIBUTE_GROUP, "attribute": VAL_ATTRIBUTE})
+        _check_references(report, sheet, rows, val_equipment, val_equipment, set(equ_ids),
+            "Equipment", remote.get("equipment"))
+        _check_references(report, sheet, rows, val_equipment, cols[VAL_ATTRIBUTE_GROUP],
+            set(ag_ids), "Attribute Group")
+        _check_references(report, sheet, rows, val_equipment, cols[VAL_ATTRIBUTE], set(att_ids),
+            "Attribute")
+        seen = set()
+        for row, equipment, ag, attribute in zip(rows, val_equipment, cols[VAL_ATTRIBUTE_GROUP],
+                cols[VAL_ATTRIBUTE]):
+            if ag in ag_members and attribute and attribute not in ag_members[ag]:
+                report.add(sheet, row, equipment, f"'{attribute}' is not in attribute group '{ag}'")
+            if (equipment, ag, attribute) in seen:
+                report.add(sheet, row, equipment,
+                    f"'{attribute}' has more than one value, the last one is written", WARNING)
+            seen.add((equipment, ag, attribute))
+
+    return report
@@ -0,0 +1,191 @@
+"""Writes the AC ids back into the xlsx file without saving the whole workbook
+
+openpyxl has to hold the whole workbook in memory and rewrites every part of
+it on save. The loader only changes the id column, so patch_ids copies the
+xlsx zip member by member and only replaces the column A cells of the updated
+rows in the sheet XML. The sheets are streamed in chunks and everything else
+is copied unchanged.
+
+"""
+
+# standard imports
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from typing import Dict
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+CHUNK_SIZE = 1 << 20
+
+# a complete row and the cell in column A of a row
+ROW = re.compile(rb'<row\b[^>]*?\sr="(\d+)"[^>]*(?<!/)>(.*?)</row>', re.S)
+CELL_A = re.compile(rb'<c\b[^>]*?\sr="A\d+"[^>]*?(?:/>|(?<!/)>.*?</c>)', re.S)
+STYLE = re.compile(rb'^<c\b[^>]*?\ss="(\d+)"')
+
+
+def sheet_parts(zf: zipfile.ZipFile):
+    """ sheet name -> name of the sheet xml in the xlsx zip """
+    rels = ElementTree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+    workbook = ElementTree.fromstring(zf.read("xl/workbook.xml"))
+    parts = {}
+    for sheet in workbook.iter(f"{{{MAIN_NS}}}sheet"):
+        target = targets[sheet.get(REL_ID)]
+        parts[sheet.get("name")] = target[1:] if target.startswith("/") else "xl/" + target
+    return parts
+
+
+def _cell(row: int, value, style):
+    """ the xml of the id cell, an inline string so the shared strings are left alone """
+    attributes = f'r="A{row}"' + (f' s="{style.decode()}"' if style else "")
+    if value is None or value == "":
+        return f"<c {attributes}/>".encode()
+    return f'<c {attributes} t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'.encode()
+
+
+def _patch_row(match, updates: Dict[int, str]):
+    row = int(match.group(1))
+    if row not in updates:
+        return match.group(0)
+    content = match.group(2)
+    cell = CELL_A.search(content)
+    if cell:
+        style = STYLE.match(cell.group(0))
+        content = content[:cell.start()] + _cell(row, updates[row], style and style.group(1)) + \
+            content[cell.end():]
+    else:
+        # column A is the first cell of the row
+        content = _cell(row, updates[row], None) + content
+    return match.group(0)[:match.start(2) - match.start()] + content + b"</row>"
+
+
+def _patch_sheet(src, dst, updates: Dict[int, str]):
+    """ copy the sheet xml in chunks, cut after the last complete row """
+    buffer = b""
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        buffer += chunk
+        if chunk:
+            end = buffer.rfind(b"</row>")
+            end = end + len(b"</row>") if end >= 0 else 0
+        else:
+            end = len(buffer)
+        dst.write(ROW.sub(lambda match: _patch_row(match, updates), buffer[:end]))
+        buffer = buffer[end:]
+        if not chunk:
+            return
+
+
+def patch_ids(path: str, updates: Dict[str, Dict[int, str]]):
+    """ Write ids into column A of the sheets of a xlsx file
+
+    The patched file is written next to the original and replaces it, so the
+    file is never left half written.
+
+    Args:
+        path - the xlsx file
+        updates - {sheet name: {row number: id}}, an empty id clears the cell
+    """
+    updates = {sheet: rows for sheet, rows in updates.items() if rows}
+    if not updates:
+        return
+    fd, tmp = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path) as zin, zipfile.ZipFile(tmp, "w") as zout:
+            parts = sheet_parts(zin)
+            missing = set(updates) - set(parts)
+            if missing:
+                raise ValueError(f"{path} has no sheet {', '.join(sorted(missing))}")
+            sheets = {parts[sheet]: rows for sheet, rows in updates.items()}
+            for info in zin.infolist():
+                with zin.open(info) as src, \
+                        zout.open(info, "w", force_zip64=info.file_size > 1 << 30) as dst:
+                    if info.filename in sheets:
+                        _patch_sheet(src, dst, sheets[info.filename])
+                    else:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class IdWriter():
+    """ Collects the ids of the loaded rows and patches them into the xlsx file
+
+    Every patch rewrites the whole file, so add() only keeps the updates and
+    the callers flush() at the end of a stage. So that the ids of a long load
+    are in the file if the load is interrupted, add() also starts a checkpoint
+    every checkpoint_interval seconds, or ten times the duration of the last
+    patch if that is longer, so rewriting a large file takes a small share of
+    the load. A checkpoint patches the file in a background thread and does
+    not hold up the thread that adds the ids.
+
+    Attributes:
+        path: the xlsx file
+        checkpoint_interval: seconds after which pending rows are patched in the background
+        flushes: number of times the file was patched
+    """
+
+    def __init__(self, path: str, checkpoint_interval: float = 300.0):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.flushes = 0
+        self._pending = defaultdict(dict)
+        self._last_flush = time.monotonic()
+        self._patch_seconds = 0.0
+        self._checkpoint = None
+        self._lock = threading.Lock()
+        # held while the file is patched, so the patches are written in order
+        self._patch_lock = threading.Lock()
+
+    def add(self, sheet: str, updates: Dict[int, str]):
+        """ queue {row number: id} updates for a sheet """
+        with self._lock:
+            self._pending[sheet].update(updates)
+            interval = max(self.checkpoint_interval, 10 * self._patch_seconds)
+            if time.monotonic() - self._last_flush < interval or \
+                    (self._checkpoint is not None and self._checkpoint.is_alive()):
+                return
+            self._last_flush = time.monotonic()
+            self._checkpoint = threading.Thread(target=self._write_checkpoint, daemon=True)
+            self._checkpoint.start()
+
+    def _write_checkpoint(self):
+        try:
+            self._patch()
+        except Exception as ex:
+            # the updates are pending again and written by the next flush
+            print(f"could not write the ids to {self.path}...error: {ex}")
+
+    def _patch(self):
+        with self._patch_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(dict)
+                self._last_flush = time.monotonic()
+            if any(pending.values()):
+                start = time.monotonic()
+                try:
+                    patch_ids(self.path, pending)
+                except BaseException:
+                    with self._lock:
+                        for sheet, rows in pending.items():
+                            self._pending[sheet] = {**rows, **self._pending[sheet]}
+                    raise
+                self._patch_seconds = time.monotonic() - start
+                self.flushes += 1
+
+    def flush(self):
+        """ patch the pending updates into the file, after a running checkpoint """
+        self._patch()